@@ -0,0 +1,218 @@
+# bench_tabs.py
+"""
+Banco de pruebas del cambio de pestaña del navegador.
+
+Abre el navegador con N pestañas (100 por defecto) y mide cuánto tarda
+select_tab() en dejar visible otra pestaña, contando el trabajo de GTK que
+provoca (estilos, tamaños y dibujado) hasta que no quedan eventos
+pendientes. Da p50, p95, p99 y máximo en ms.
+
+Por defecto todas las pestañas tienen ya su WebView (cargado con
+about:blank), que es el caso caro; con --lazy las de fondo se quedan en
+reposo y se mide también crearlo en el primer cambio.
+
+Presupuesto de arranque (--restore-budget): escribe un diario de sesión
+con N pestañas (con historial de unos KB cada una), arranca el navegador
+restaurándolo y comprueba que leer el diario no pase de
+JOURNAL_BUDGET_MS ni el arranque completo, hasta no quedar eventos
+pendientes, de RESTORE_BUDGET_MS. Si se pasa, sale con código 2.
+
+El navegador se abre con un perfil temporal (sesión, base de datos y
+configuración en una carpeta que se borra al terminar) y sin
+extensiones, así que no toca el perfil del usuario ni la red.
+
+Necesita GTK y WebKit2GTK y una pantalla (o Xvfb):
+    python3 bench_tabs.py
+    python3 bench_tabs.py --tabs 100 --switches 500 --json
+    python3 bench_tabs.py --restore-budget
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import main as navia_main
+import session
+from main import Gtk, Navia, process_tree_rss_mb
+
+JOURNAL_BUDGET_MS = 50
+RESTORE_BUDGET_MS = 1500
+
+
+class BenchNavia(Navia):
+    # Sin extensiones: el bloqueador descargaría sus listas y añadiría ruido
+    def load_active_extensions(self):
+        self.loaded_extensions = {}
+        self.extension_apis = {}
+
+
+@contextlib.contextmanager
+def temporary_profile():
+    """Apunta los archivos del perfil a una carpeta temporal mientras dura."""
+    names = ("SESSION_FILE", "DB_FILE", "CONFIG_FILE", "DATA_FILE")
+    saved = {name: getattr(navia_main, name) for name in names}
+    with tempfile.TemporaryDirectory(prefix="navia-bench-") as tmp_dir:
+        for name in names:
+            setattr(navia_main, name, os.path.join(tmp_dir, os.path.basename(saved[name])))
+        try:
+            yield tmp_dir
+        finally:
+            for name, value in saved.items():
+                setattr(navia_main, name, value)
+
+
+def close_app(app):
+    # Lo mismo que on_destroy pero sin Gtk.main_quit (aquí no hay bucle principal)
+    app.flush_session()
+    app.write_session(app.session.close)
+    app.writer.close()
+    app.store.close()
+    app.disconnect_by_func(app.on_destroy)
+    app.destroy()
+    pump()
+
+
+def pump():
+    # Procesa todo lo pendiente (estilos, tamaños, dibujado)
+    while Gtk.events_pending():
+        Gtk.main_iteration_do(False)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(tabs, switches, lazy, seed):
+    with temporary_profile():
+        return _run(tabs, switches, lazy, seed)
+
+
+def _run(tabs, switches, lazy, seed):
+    app = BenchNavia()
+    app.show_all()
+    pump()
+    for _ in range(tabs - len(app.tabs)):
+        app.create_tab(url="about:blank", background=True)
+    if not lazy:
+        for i in range(len(app.tabs)):
+            app.select_tab(i)
+            pump()
+    app.select_tab(0)
+    pump()
+
+    rng = random.Random(seed)
+    times_ms = []
+    current = 0
+    for _ in range(switches):
+        target = rng.randrange(len(app.tabs) - 1)
+        target += target >= current   # siempre a otra pestaña
+        start = time.perf_counter()
+        app.select_tab(target)
+        pump()
+        times_ms.append((time.perf_counter() - start) * 1000)
+        current = target
+
+    report = {
+        "tabs": len(app.tabs),
+        "switches": switches,
+        "lazy": lazy,
+        "p50_ms": percentile(times_ms, 0.50),
+        "p95_ms": percentile(times_ms, 0.95),
+        "p99_ms": percentile(times_ms, 0.99),
+        "max_ms": max(times_ms),
+        "mean_ms": statistics.fmean(times_ms),
+        "rss_mb": process_tree_rss_mb(),
+    }
+    close_app(app)
+    return report
+
+
+def restore_budget(tabs, state_bytes, journal_budget_ms, restore_budget_ms):
+    with temporary_profile():
+        return _restore_budget(tabs, state_bytes, journal_budget_ms, restore_budget_ms)
+
+
+def _restore_budget(tabs, state_bytes, journal_budget_ms, restore_budget_ms):
+    path = navia_main.SESSION_FILE
+    journal = session.SessionJournal(path)
+    journal.load()
+    rng = random.Random(1)
+    for tab_id in range(1, tabs + 1):
+        journal.tab(tab_id, "about:blank", f"Pestaña {tab_id}")
+        journal.state(tab_id, rng.randbytes(state_bytes))
+    journal.set_current(tabs // 2)
+    journal.close()
+
+    start = time.perf_counter()
+    saved, current, _ = session.read_session(path)
+    journal_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    app = BenchNavia()
+    pump()
+    restore_ms = (time.perf_counter() - start) * 1000
+    live = sum(1 for tab, _, _ in app.tabs if tab.webview is not None)
+    report = {
+        "tabs": len(saved),
+        "restored": len(app.tabs),
+        "live_webviews": live,
+        "journal_bytes": os.path.getsize(path),
+        "journal_ms": journal_ms,
+        "restore_ms": restore_ms,
+        "journal_budget_ms": journal_budget_ms,
+        "restore_budget_ms": restore_budget_ms,
+        "ok": journal_ms <= journal_budget_ms and restore_ms <= restore_budget_ms and live == 1,
+    }
+    close_app(app)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mide la latencia del cambio de pestaña.")
+    parser.add_argument("--tabs", type=int, default=100, help="pestañas abiertas")
+    parser.add_argument("--switches", type=int, default=300, help="cambios de pestaña a medir")
+    parser.add_argument("--lazy", action="store_true", help="deja en reposo las pestañas de fondo")
+    parser.add_argument("--seed", type=int, default=1, help="semilla del orden de los cambios")
+    parser.add_argument("--json", action="store_true", help="informe en JSON")
+    parser.add_argument("--restore-budget", action="store_true",
+                        help="comprueba el presupuesto de arranque con la sesión y sale")
+    parser.add_argument("--state-bytes", type=int, default=4096,
+                        help="tamaño del historial de cada pestaña para --restore-budget")
+    parser.add_argument("--max-journal-ms", type=float, default=JOURNAL_BUDGET_MS,
+                        help="presupuesto de lectura del diario (ms)")
+    parser.add_argument("--max-restore-ms", type=float, default=RESTORE_BUDGET_MS,
+                        help="presupuesto del arranque restaurando la sesión (ms)")
+    args = parser.parse_args(argv)
+
+    if args.restore_budget:
+        report = restore_budget(max(1, args.tabs), args.state_bytes,
+                                args.max_journal_ms, args.max_restore_ms)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print(f"{report['restored']}/{report['tabs']} pestañas restauradas, "
+                  f"{report['live_webviews']} con WebView, diario de {report['journal_bytes'] / 1024:.0f} KB")
+            print(f"  leer diario {report['journal_ms']:.1f} ms (máx {report['journal_budget_ms']:g})  "
+                  f"arranque {report['restore_ms']:.0f} ms (máx {report['restore_budget_ms']:g})")
+            print("  OK" if report["ok"] else "  FUERA DE PRESUPUESTO")
+        return 0 if report["ok"] else 2
+
+    report = run(max(2, args.tabs), args.switches, args.lazy, args.seed)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{report['tabs']} pestañas, {report['switches']} cambios"
+              f"{' (perezosas)' if report['lazy'] else ''}")
+        print(f"  p50 {report['p50_ms']:.2f} ms  p95 {report['p95_ms']:.2f} ms  "
+              f"p99 {report['p99_ms']:.2f} ms  máx {report['max_ms']:.2f} ms")
+        print(f"  RSS navegador + procesos web: {report['rss_mb']:.0f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
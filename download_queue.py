@@ -0,0 +1,250 @@
+# download_queue.py
+"""
+Cola de descargas: decide cuándo empieza cada una.
+
+Todas las descargas (las de WebKit y las manuales de downloader.py) pasan
+por DownloadQueue. Como mucho hay 'max_active' a la vez y 'per_host' del
+mismo servidor; el resto espera en cola, por prioridad y después por su
+puesto en la lista (que se puede cambiar con move). Una manual en pausa
+deja su hueco a la siguiente.
+
+WebKit no deja retrasar una descarga ya creada: si no hay hueco se
+cancela y, cuando le toca, se vuelve a pedir a WebKit con start_webkit
+(misma URL, mismas cookies). El límite de ancho de banda es un cubo de
+fichas (RateLimiter) que frena las manuales; lo que bajan las de WebKit no
+se puede frenar, pero cuenta en el cubo, así que las manuales ceden ese
+ancho.
+
+Todo salvo RateLimiter se usa desde el hilo de GTK.
+"""
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+DEFAULT_MAX_ACTIVE = 3
+DEFAULT_PER_HOST = 2
+THROUGHPUT_WINDOW = 3.0   # segundos que se promedian para la velocidad total
+
+
+class RateMeter:
+    """Velocidad (bytes/s) en una ventana deslizante de 'window' segundos."""
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        self.window = window
+        self._samples = deque()   # (momento, bytes totales)
+
+    def add(self, total, now=None):
+        """Apunta el total de bytes de ahora y devuelve la velocidad de la ventana."""
+        now = time.monotonic() if now is None else now
+        self._samples.append((now, total))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+        start, start_total = self._samples[0]
+        return (total - start_total) / (now - start) if now > start else 0.0
+
+    def reset(self):
+        self._samples.clear()
+
+
+class RateLimiter:
+    """Cubo de fichas global en bytes/s (0 = sin límite); lo usan varios hilos."""
+
+    def __init__(self, rate=0):
+        self.total = 0          # bytes contados desde el principio
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = max(0, int(rate))
+            self._tokens = self.rate   # ráfaga de como mucho un segundo
+            self._stamp = time.monotonic()
+
+    def _take(self, n):
+        # Fichas que faltan tras gastar n, en segundos de espera
+        self.total += n
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate) - n
+        self._stamp = now
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def consume(self, n, stop=None):
+        """Gasta n bytes y espera lo que haga falta (o hasta que 'stop' se active)."""
+        with self._lock:
+            wait = self._take(n)
+        if wait:
+            if stop is not None:
+                stop.wait(wait)
+            else:
+                time.sleep(wait)
+
+    def record(self, n):
+        """Cuenta n bytes que ya llegaron sin esperar (descargas de WebKit)."""
+        with self._lock:
+            self._take(n)
+
+
+class QueuedDownload:
+    """Una descarga de la cola. job es la SegmentedDownload o la Download de WebKit."""
+
+    __slots__ = ("kind", "url", "host", "job", "priority", "state", "decide")
+
+    def __init__(self, kind, url, job, priority=0, decide=None):
+        self.kind = kind            # "manual" o "webkit"
+        self.url = url
+        self.host = (urlsplit(url).hostname or "") if url else ""
+        self.job = job              # None mientras una de WebKit espera
+        self.priority = priority
+        self.state = "queued"       # queued, active o paused
+        self.decide = decide        # manejador de decide-destination de las de WebKit
+
+    def __repr__(self):
+        return f"QueuedDownload({self.kind!r}, {self.url!r}, {self.state!r})"
+
+
+class DownloadQueue:
+    """
+    start_webkit(item) vuelve a pedir a WebKit una descarga que esperaba y
+    devuelve el Download nuevo; on_change() avisa de cualquier cambio.
+    """
+
+    def __init__(self, max_active=DEFAULT_MAX_ACTIVE, per_host=DEFAULT_PER_HOST, rate=0,
+                 start_webkit=None, on_change=None):
+        self.max_active = max_active
+        self.per_host = per_host
+        self.limiter = RateLimiter(rate)
+        self.start_webkit = start_webkit
+        self.on_change = on_change
+        self.items = []                 # en el orden de la lista
+        self._meter = RateMeter()
+
+    def configure(self, max_active, per_host, rate):
+        self.max_active = max(1, int(max_active))
+        self.per_host = max(0, int(per_host))   # 0 = sin límite por servidor
+        self.limiter.set_rate(rate)
+        self.pump()
+
+    # --- altas y bajas ---------------------------------------------------
+
+    def add_manual(self, job, url, priority=0):
+        item = QueuedDownload("manual", url, job, priority)
+        self.items.append(item)
+        self.pump()
+        self._changed()
+        return item
+
+    def add_webkit(self, download, url, decide=None, priority=0):
+        """Una descarga que WebKit ya empezó: sigue si hay hueco y si no, espera."""
+        item = QueuedDownload("webkit", url, download, priority, decide)
+        self.items.append(item)
+        if self._has_room(item) or not url:
+            item.state = "active"
+        else:
+            item.job = None
+            download.cancel()
+            print(f"[Descargas] En cola: {url}")
+        self._changed()
+        return item
+
+    def find(self, job):
+        for item in self.items:
+            if item.job is job:
+                return item
+        return None
+
+    def finished(self, job):
+        """La descarga 'job' terminó, falló o se canceló: deja su hueco."""
+        item = self.find(job)
+        if item is None:
+            return
+        self.items.remove(item)
+        self.pump()
+        self._changed()
+
+    def paused(self, job):
+        item = self.find(job)
+        if item is not None and item.state == "active":
+            item.state = "paused"
+            self.pump()
+            self._changed()
+
+    def resume(self, item):
+        """Vuelve a la cola una descarga en pausa; empieza cuando haya hueco."""
+        if item.state == "paused":
+            item.state = "queued"
+            self.pump()
+            self._changed()
+
+    def cancel(self, item):
+        if item.job is not None:
+            item.job.cancel()   # su aviso de fin la quita de la lista
+        if item.state == "queued" or (item.kind == "manual" and item.state == "paused"):
+            if item in self.items:
+                self.items.remove(item)
+            self.pump()
+            self._changed()
+
+    def move(self, item, offset):
+        """Mueve la descarga 'offset' puestos en la lista (para reordenar la cola)."""
+        if item not in self.items:
+            return
+        i = self.items.index(item)
+        j = max(0, min(len(self.items) - 1, i + offset))
+        if i != j:
+            self.items.insert(j, self.items.pop(i))
+            self.pump()
+            self._changed()
+
+    def set_priority(self, item, priority):
+        item.priority = priority
+        self.pump()
+        self._changed()
+
+    # --- planificación ---------------------------------------------------
+
+    def active(self):
+        return [item for item in self.items if item.state == "active"]
+
+    def queued(self):
+        # Estable: a igual prioridad, el orden de la lista
+        return sorted((item for item in self.items if item.state == "queued"), key=lambda item: -item.priority)
+
+    def _has_room(self, item):
+        active = self.active()
+        if len(active) >= self.max_active:
+            return False
+        if self.per_host and item.host:
+            return sum(1 for other in active if other.host == item.host) < self.per_host
+        return True
+
+    def pump(self):
+        """Empieza lo que quepa de la cola."""
+        for item in self.queued():
+            if len(self.active()) >= self.max_active:
+                break
+            if self._has_room(item):
+                self._start(item)
+
+    def _start(self, item):
+        item.state = "active"
+        try:
+            if item.kind == "manual":
+                item.job.start()
+            else:
+                item.job = self.start_webkit(item)
+        except Exception as e:
+            print(f"[Descargas] No se pudo empezar {item.url}: {e}")
+            self.items.remove(item)
+
+    # --- estado ----------------------------------------------------------
+
+    def throughput(self):
+        """Bytes/s de todas las descargas juntas en los últimos THROUGHPUT_WINDOW segundos."""
+        return self._meter.add(self.limiter.total)
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
@@ -0,0 +1,434 @@
+# downloader.py
+"""
+Descargas por rangos HTTP en paralelo y reanudables (la descarga manual,
+cuando WebKit no da un objeto de descarga).
+
+Primero se pide el byte 0 (Range: bytes=0-0). Si el servidor contesta 206
+acepta rangos y dice el tamaño total: el archivo se parte en hasta
+'segments' trozos (de al menos MIN_SEGMENT_BYTES) y cada uno se baja en
+su hilo, con una requests.Session compartida (conexiones reutilizadas).
+Si contesta 200 no acepta rangos y se baja de una vez con esa misma
+respuesta.
+
+Lo descargado va a <destino>.part y el avance de cada trozo a
+<destino>.part.json (escrito de golpe, ver persist.write_atomic, después
+de un fsync de los datos). Al volver a pedir la misma URL al mismo
+destino (tras pausar, un error o cerrar el navegador) se sigue desde ahí,
+siempre que el tamaño y el ETag/Last-Modified no hayan cambiado; If-Range
+protege además de un cambio a mitad. Al terminar se comprueba la suma
+(la que se pasa o la que ofrezca el servidor en Repr-Digest, Digest o
+Content-MD5) y el .part pasa a ser el destino.
+
+Se puede probar sin el navegador:
+    python3 downloader.py URL DESTINO [--segments N] [--checksum sha256:HEX]
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+from persist import write_atomic
+
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_BYTES = 1024 * 1024
+CHUNK_BYTES = 64 * 1024
+RETRIES = 3                 # reintentos de cada trozo antes de fallar
+TIMEOUT = 30
+SIDECAR_INTERVAL = 1.0      # segundos entre escrituras del avance
+PROGRESS_INTERVAL = 0.25    # segundos entre avisos de progreso
+
+# Nombres de los algoritmos en las cabeceras -> hashlib
+_DIGEST_NAMES = {"sha-256": "sha256", "sha-512": "sha512", "sha": "sha1", "md5": "md5"}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _Stopped(Exception):
+    pass
+
+
+def shared_session():
+    """La requests.Session de todas las descargas (con sitio para los trozos en paralelo)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=4 * DEFAULT_SEGMENTS)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def parse_checksum(text):
+    """'sha256:HEX' (o 'sha256=HEX') -> ('sha256', 'hex')."""
+    algo, sep, digest = text.replace("=", ":", 1).partition(":")
+    algo = algo.strip().lower().replace("-", "")
+    if not sep or algo not in hashlib.algorithms_available:
+        raise ValueError(f"suma de comprobación no válida: {text}")
+    return algo, digest.strip().lower()
+
+
+def offered_checksum(headers, partial=False):
+    """La suma que ofrece el servidor para el archivo entero, como (algoritmo, hex), o None."""
+    for header in ("Repr-Digest", "Digest"):
+        for item in (headers.get(header) or "").split(","):
+            name, sep, value = item.strip().partition("=")
+            algo = _DIGEST_NAMES.get(name.strip().lower())
+            if sep and algo:
+                try:
+                    return algo, base64.b64decode(value.strip().strip(":")).hex()
+                except ValueError:
+                    continue
+    # Content-MD5 es del cuerpo de esa respuesta: en un 206 sería solo del trozo
+    md5 = headers.get("Content-MD5")
+    if md5 and not partial:
+        try:
+            return "md5", base64.b64decode(md5.strip()).hex()
+        except ValueError:
+            pass
+    return None
+
+
+class SegmentedDownload:
+    """
+    Una descarga de 'url' a 'dest'. start() la lanza en un hilo; pause()
+    la para guardando el avance y cancel() la para y borra lo bajado.
+    on_progress(descarga) se llama desde los hilos de la descarga. Con
+    'limiter' (download_queue.RateLimiter) cada trozo espera sus fichas.
+    """
+
+    def __init__(self, url, dest, segments=DEFAULT_SEGMENTS, checksum=None, session=None, on_progress=None,
+                 limiter=None):
+        self.url = url
+        self.dest = dest
+        self.filename = os.path.basename(dest)
+        self.part_path = f"{dest}.part"
+        self.sidecar_path = f"{dest}.part.json"
+        self.max_segments = max(1, segments)
+        self.checksum = parse_checksum(checksum) if checksum else None
+        self.session = session
+        self.on_progress = on_progress
+        self.limiter = limiter
+        self.total = None
+        self.ranges = False
+        self.validator = None       # ETag o Last-Modified del archivo
+        self.segments = []          # [inicio, fin (sin incluir), bytes hechos]
+        self.state = "pending"      # pending, running, paused, done, cancelled, failed
+        self.error = None
+        self.resumed_bytes = 0      # lo que ya estaba bajado al empezar esta vez
+        self._lock = threading.Lock()
+        self._sidecar_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._discard = False
+        self._thread = None
+        self._fd = None
+        self._sidecar_at = 0.0
+        self._progress_at = 0.0
+
+    @property
+    def downloaded(self):
+        with self._lock:
+            return sum(done for _, _, done in self.segments)
+
+    @property
+    def progress(self):
+        return self.downloaded / self.total if self.total else 0.0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._discard = False
+        self.state = "running"
+        self.error = None
+        self._thread = threading.Thread(target=self.run, name="navia-download", daemon=True)
+        self._thread.start()
+
+    def pause(self):
+        self._stop.set()
+
+    def cancel(self):
+        self._discard = True
+        self._stop.set()
+        if self._thread is None or not self._thread.is_alive():
+            self.state = "cancelled"
+            self._remove_files()
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        """La descarga entera en el hilo que llama."""
+        self.state = "running"
+        try:
+            self._download()
+            self.state = "done"
+        except _Stopped:
+            self.state = "cancelled" if self._discard else "paused"
+        except Exception as e:
+            self.error = e
+            self.state = "failed"
+        if self._discard:
+            self._remove_files()
+        self._notify(force=True)
+
+    # --- descarga ------------------------------------------------------
+
+    def _download(self):
+        session = self.session or shared_session()
+        whole = self._probe(session)
+        try:
+            resumed = self._load_sidecar()
+            if resumed:
+                self._fd = os.open(self.part_path, os.O_RDWR)
+            else:
+                self._fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+                if self.total:
+                    os.ftruncate(self._fd, self.total)
+            self.resumed_bytes = self.downloaded
+            if whole is not None:
+                self._fetch_whole(whole)
+            else:
+                self._fetch_segments(session)
+        finally:
+            if whole is not None:
+                whole.close()
+            if self._fd is not None:
+                self._write_sidecar(force=True)
+                os.close(self._fd)
+                self._fd = None
+        if self._stop.is_set():
+            raise _Stopped()
+        self._verify()
+        os.replace(self.part_path, self.dest)
+        self._remove_sidecar()
+
+    def _probe(self, session):
+        # Devuelve la respuesta abierta si no hay rangos (se usa para bajarlo todo)
+        res = session.get(self.url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT)
+        if res.status_code == 416:
+            # Archivo vacío: no hay byte 0 que pedir
+            res.close()
+            res = session.get(self.url, stream=True, timeout=TIMEOUT)
+        try:
+            res.raise_for_status()
+        except Exception:
+            res.close()
+            raise
+        self.url = res.url   # tras las redirecciones
+        self.validator = res.headers.get("ETag") or res.headers.get("Last-Modified")
+        content_range = res.headers.get("Content-Range", "")
+        size = content_range.rpartition("/")[2]
+        if res.status_code == 206 and size.isdigit():
+            self.ranges = True
+            self.total = int(size)
+        else:
+            self.ranges = False
+            length = res.headers.get("Content-Length", "")
+            self.total = int(length) if length.isdigit() else None
+        if self.checksum is None:
+            self.checksum = offered_checksum(res.headers, partial=res.status_code == 206)
+        if self.ranges and self.total:
+            res.close()
+            return None
+        if res.status_code == 206:
+            # Rangos pero sin tamaño: se pide entero
+            res.close()
+            res = session.get(self.url, stream=True, timeout=TIMEOUT)
+            res.raise_for_status()
+        return res
+
+    def _load_sidecar(self):
+        """Recupera el avance guardado si es de este mismo archivo; si no, empieza de cero."""
+        try:
+            with open(self.sidecar_path, "r") as f:
+                saved = json.load(f)
+            compatible = (self.ranges and saved.get("url") == self.url and saved.get("total") == self.total
+                          and saved.get("validator") == self.validator
+                          and os.path.getsize(self.part_path) == self.total)
+            segments = [[int(start), int(end), int(done)] for start, end, done in saved["segments"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            compatible = False
+        if compatible:
+            with self._lock:
+                self.segments = segments
+            return True
+        if self.ranges and self.total:
+            count = max(1, min(self.max_segments, self.total // MIN_SEGMENT_BYTES))
+            bounds = [self.total * i // count for i in range(count + 1)]
+            segments = [[bounds[i], bounds[i + 1], 0] for i in range(count)]
+        else:
+            segments = [[0, self.total or 0, 0]]
+        with self._lock:
+            self.segments = segments
+        return False
+
+    def _fetch_segments(self, session):
+        pending = [seg for seg in self.segments if seg[2] < seg[1] - seg[0]]
+        errors = []
+
+        def worker(seg):
+            try:
+                self._fetch_segment(session, seg)
+            except _Stopped:
+                pass
+            except Exception as e:
+                errors.append(e)
+                self._stop.set()   # los demás paran y el avance queda guardado
+        threads = [threading.Thread(target=worker, args=(seg,), daemon=True) for seg in pending[1:]]
+        for thread in threads:
+            thread.start()
+        if pending:
+            worker(pending[0])
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _fetch_segment(self, session, seg):
+        import requests
+        headers = {}
+        if self.validator and not self.validator.startswith("W/"):
+            headers["If-Range"] = self.validator   # si cambió, el servidor manda un 200
+        failures = 0
+        while seg[2] < seg[1] - seg[0]:
+            if self._stop.is_set():
+                raise _Stopped()
+            headers["Range"] = f"bytes={seg[0] + seg[2]}-{seg[1] - 1}"
+            try:
+                with session.get(self.url, headers=headers, stream=True, timeout=TIMEOUT) as res:
+                    if res.status_code == 200:
+                        raise DownloadError("el archivo cambió en el servidor o ya no acepta rangos")
+                    res.raise_for_status()
+                    for chunk in res.iter_content(CHUNK_BYTES):
+                        self._write(seg, chunk)
+                        if seg[2] >= seg[1] - seg[0]:
+                            break
+            except (requests.RequestException, OSError) as e:
+                # Se reintenta desde donde se quedó
+                failures += 1
+                if failures > RETRIES:
+                    raise DownloadError(f"trozo {seg[0]}-{seg[1] - 1}: {e}") from e
+                if self._stop.wait(min(2 ** failures, 10)):
+                    raise _Stopped()
+
+    def _fetch_whole(self, res):
+        seg = self.segments[0]
+        with self._lock:
+            seg[2] = 0
+        for chunk in res.iter_content(CHUNK_BYTES):
+            self._write(seg, chunk, grow=True)
+        if self._stop.is_set():
+            raise _Stopped()
+        if self.total and seg[2] < self.total:
+            raise DownloadError(f"descarga incompleta: {seg[2]} de {self.total} bytes")
+        self.total = seg[1] = seg[2]
+
+    def _write(self, seg, chunk, grow=False):
+        if self._stop.is_set():
+            raise _Stopped()
+        if not grow:
+            chunk = chunk[:seg[1] - seg[0] - seg[2]]
+        if self.limiter is not None:
+            # Esperar aquí frena también la lectura del socket
+            self.limiter.consume(len(chunk), self._stop)
+        os.pwrite(self._fd, chunk, seg[0] + seg[2])
+        with self._lock:
+            seg[2] += len(chunk)
+        self._write_sidecar()
+        self._notify()
+
+    # --- avance y comprobación -----------------------------------------
+
+    def _write_sidecar(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._sidecar_at < SIDECAR_INTERVAL:
+            return
+        if not self.ranges or not self._sidecar_lock.acquire(blocking=force):
+            return
+        try:
+            self._sidecar_at = now
+            with self._lock:
+                saved = {"url": self.url, "total": self.total, "validator": self.validator,
+                         "segments": [list(seg) for seg in self.segments]}
+            # Primero los datos: el avance guardado nunca va por delante de ellos
+            os.fsync(self._fd)
+            write_atomic(self.sidecar_path, json.dumps(saved).encode("utf-8"))
+        except OSError as e:
+            print(f"[Descargas] No se pudo guardar el avance de {self.filename}: {e}")
+        finally:
+            self._sidecar_lock.release()
+
+    def _notify(self, force=False):
+        now = time.monotonic()
+        if self.on_progress is None or (not force and now - self._progress_at < PROGRESS_INTERVAL):
+            return
+        self._progress_at = now
+        self.on_progress(self)
+
+    def _verify(self):
+        if self.checksum is None:
+            return
+        algo, expected = self.checksum
+        digest = hashlib.new(algo)
+        with open(self.part_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        if digest.hexdigest() != expected:
+            self._remove_files()
+            raise DownloadError(f"la suma {algo} no coincide (esperada {expected}, obtenida {digest.hexdigest()})")
+
+    def _remove_sidecar(self):
+        try:
+            os.remove(self.sidecar_path)
+        except OSError:
+            pass
+
+    def _remove_files(self):
+        self._remove_sidecar()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Descarga un archivo por rangos en paralelo (reanudable).")
+    parser.add_argument("url")
+    parser.add_argument("dest")
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS, help="trozos en paralelo")
+    parser.add_argument("--checksum", help="suma esperada, p. ej. sha256:HEX")
+    args = parser.parse_args(argv)
+
+    def report(download):
+        print(f"\r{download.downloaded} / {download.total or '?'} bytes", end="", flush=True)
+    download = SegmentedDownload(args.url, args.dest, args.segments, args.checksum, on_progress=report)
+    download.start()
+    try:
+        while download.state == "running":
+            download.wait(0.5)
+    except KeyboardInterrupt:
+        # Se para guardando el avance: volver a lanzarlo sigue desde ahí
+        download.pause()
+        download.wait()
+    print()
+    if download.state != "done":
+        print(f"{download.state}: {download.error}")
+        return 1
+    print(f"{download.dest}: {download.total} bytes ({download.resumed_bytes} ya estaban)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,148 @@
+# adblock_cache.py
+"""
+Cache binaria de reglas ya indexadas.
+
+Un solo índice para todas las listas activas (INDEX_NAME, en la carpeta
+de la extensión), ligado por tamaño, mtime y sha256 al archivo de fuentes
+(SOURCES_NAME), que apunta cada lista con el sha256 de su contenido. En un
+arranque normal se abre con mmap y se reconstruye el índice a partir de
+tablas planas, sin volver a parsear ni compilar ninguna regla.
+
+Formato (little/big endian según la máquina que lo escribió):
+
+    cabecera   MAGIC, versión del formato, versión del índice, orden de bytes,
+               tamaño y mtime_ns de la fuente, sha256 de la fuente, nº secciones
+    secciones  nombre (16 bytes), tipo, nº de elementos, longitud en bytes,
+               datos alineados a 8 bytes
+
+Tipos de sección:
+    KIND_INTS     array('I') en bruto
+    KIND_STRINGS  texto UTF-8 con los elementos separados por '\\0'
+"""
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+INDEX_NAME = "adblock_index.idx"       # índice compartido ya compilado
+SOURCES_NAME = "adblock_sources.txt"   # listas y sha256 de las que sale ese índice
+
+MAGIC = b"NVADBIDX"
+FORMAT_VERSION = 1
+
+KIND_INTS = 0
+KIND_STRINGS = 1
+
+_HEADER = struct.Struct("=8sHHcxxxQq32sI")
+_SECTION = struct.Struct("=16sBxxxIQ")
+_BYTEORDER = b"l" if sys.byteorder == "little" else b"b"
+
+
+def _pad(n):
+    return (-n) % 8
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def _encode_section(name, value):
+    if isinstance(value, array):
+        kind, count, data = KIND_INTS, len(value), value.tobytes()
+    else:
+        kind, count = KIND_STRINGS, len(value)
+        data = "\0".join(value).encode("utf-8")
+    raw_name = name.encode("ascii")
+    if len(raw_name) > 16:
+        raise ValueError(f"nombre de sección demasiado largo: {name}")
+    header = _SECTION.pack(raw_name, kind, count, len(data))
+    return header + data + b"\0" * _pad(len(data))
+
+
+def save_tables(path, tables, source_path, index_version):
+    """Escribe las tablas de un índice ligadas al archivo fuente (escritura atómica)."""
+    st = os.stat(source_path)
+    digest = file_digest(source_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, index_version, _BYTEORDER,
+                             st.st_size, st.st_mtime_ns, digest, len(tables)))
+        for name, value in tables.items():
+            f.write(_encode_section(name, value))
+    os.replace(tmp_path, path)
+
+
+def _decode_section(mm, pos):
+    raw_name, kind, count, length = _SECTION.unpack_from(mm, pos)
+    pos += _SECTION.size
+    data = mm[pos:pos + length]
+    if kind == KIND_INTS:
+        value = array('I')
+        value.frombytes(data)
+    else:
+        value = data.decode("utf-8").split("\0") if count else []
+        if len(value) != count:
+            raise ValueError(f"sección de texto corrupta ({len(value)} != {count})")
+    return raw_name.rstrip(b"\0").decode("ascii"), value, pos + length + _pad(length)
+
+
+def _read_tables(mm, source_path, index_version):
+    (magic, fmt, idx_version, byteorder, size, mtime_ns, digest,
+     n_sections) = _HEADER.unpack_from(mm, 0)
+    if (magic != MAGIC or fmt != FORMAT_VERSION or idx_version != index_version
+            or byteorder != _BYTEORDER):
+        return None, False
+    st = os.stat(source_path)
+    stale_header = False
+    if st.st_size != size or st.st_mtime_ns != mtime_ns:
+        if st.st_size != size or file_digest(source_path) != digest:
+            return None, False
+        stale_header = True
+    tables = {}
+    pos = _HEADER.size
+    for _ in range(n_sections):
+        name, value, pos = _decode_section(mm, pos)
+        tables[name] = value
+    return tables, stale_header
+
+
+def load_tables(path, source_path, index_version):
+    """
+    Devuelve las tablas guardadas en 'path' si siguen siendo válidas para
+    'source_path', o None si hay que volver a parsear la lista.
+
+    Si cambia el mtime pero el contenido es idéntico (p.ej. una descarga sin
+    cambios), se acepta la cache y se actualiza su cabecera.
+    """
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        tables, stale_header = _read_tables(mm, source_path, index_version)
+    except (struct.error, ValueError, UnicodeDecodeError, OSError):
+        tables, stale_header = None, False
+    finally:
+        mm.close()
+    if stale_header:
+        _touch_header(path, source_path)
+    return tables
+
+
+def _touch_header(path, source_path):
+    try:
+        st = os.stat(source_path)
+        with open(path, "r+b") as f:
+            fields = list(_HEADER.unpack(f.read(_HEADER.size)))
+            fields[4], fields[5] = st.st_size, st.st_mtime_ns
+            f.seek(0)
+            f.write(_HEADER.pack(*fields))
+    except OSError:
+        pass
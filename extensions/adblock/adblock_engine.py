@@ -0,0 +1,1548 @@
+# adblock_engine.py
+"""
+Compilador y motor de filtros tipo EasyList (sintaxis Adblock Plus).
+
+Cada línea de la lista se compila a un Filter (reglas de red) o a una regla
+cosmética (##, #@#). Los filtros de red se reparten en índices para que una
+petición solo mire unos pocos candidatos y cada consulta cueste
+aproximadamente O(longitud de la URL):
+
+- ||host^ sin opciones: conjunto de hosts; se consultan los sufijos del host.
+- ||host/... o ||host^$opciones: tabla por host, mismos sufijos.
+- Resto: cubetas por n-grama de la parte literal del patrón (la menos poblada).
+- Sin parte literal útil: tabla por dominio de la página ($domain=) o lista
+  genérica.
+
+Antes de comparar ninguna cadena se descartan los candidatos por tipo de
+recurso ($script, $image...) y por origen ($third-party, $domain=). Las
+expresiones regulares de los patrones con comodines se compilan la primera
+vez que hacen falta, nunca al cargar la lista.
+
+Un índice ya publicado no se modifica: RuleIndex.updated() devuelve una copia
+con las líneas añadidas y quitadas, que se publica con un cambio de referencia.
+
+Memoria: los conjuntos grandes de cadenas (hosts ||host^, selectores
+cosméticos) se guardan compactados en StringTable (un bloque UTF-8 y arrays
+de hashes y desplazamientos, sin un objeto str por elemento). Los dominios de
+$domain= se internan, y los Filter usan __slots__.
+
+Listas grandes: parse_parallel() reparte el parseo de las líneas entre
+procesos (parse_chunk) y vuelve a indexar los trozos en el orden de la lista,
+así que el índice es el mismo que con add_lines().
+"""
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import accumulate, chain, repeat
+
+# Longitud de los n-gramas usados como clave de las cubetas
+NGRAM = 4
+# Versión de la forma de las tablas exportadas (ver adblock_cache)
+INDEX_VERSION = 4
+# parse_parallel(): líneas por trozo y mínimo de líneas para usar procesos
+CHUNK_LINES = 8192
+PARALLEL_MIN_LINES = 150000
+
+# --- Tipos de recurso (bits) ---
+TYPE_OTHER = 1 << 0
+TYPE_SCRIPT = 1 << 1
+TYPE_IMAGE = 1 << 2
+TYPE_STYLESHEET = 1 << 3
+TYPE_OBJECT = 1 << 4
+TYPE_XHR = 1 << 5
+TYPE_SUBDOCUMENT = 1 << 6
+TYPE_PING = 1 << 7
+TYPE_MEDIA = 1 << 8
+TYPE_FONT = 1 << 9
+TYPE_WEBSOCKET = 1 << 10
+TYPE_WEBRTC = 1 << 11
+TYPE_DOCUMENT = 1 << 12
+TYPE_POPUP = 1 << 13
+
+TYPE_BITS = {
+    "other": TYPE_OTHER,
+    "script": TYPE_SCRIPT,
+    "image": TYPE_IMAGE,
+    "stylesheet": TYPE_STYLESHEET, "css": TYPE_STYLESHEET,
+    "object": TYPE_OBJECT, "object-subrequest": TYPE_OBJECT,
+    "xmlhttprequest": TYPE_XHR, "xhr": TYPE_XHR,
+    "subdocument": TYPE_SUBDOCUMENT, "frame": TYPE_SUBDOCUMENT,
+    "ping": TYPE_PING, "beacon": TYPE_PING,
+    "media": TYPE_MEDIA,
+    "font": TYPE_FONT,
+    "websocket": TYPE_WEBSOCKET,
+    "webrtc": TYPE_WEBRTC,
+    "document": TYPE_DOCUMENT, "doc": TYPE_DOCUMENT,
+    "popup": TYPE_POPUP,
+}
+ALL_TYPES = (1 << 14) - 1
+# Sin opciones de tipo, un filtro no se aplica a documentos ni popups
+DEFAULT_TYPES = ALL_TYPES & ~(TYPE_DOCUMENT | TYPE_POPUP)
+
+# --- Origen de la petición respecto a la página ---
+FIRST_PARTY = 1
+THIRD_PARTY = 2
+ANY_PARTY = FIRST_PARTY | THIRD_PARTY
+
+# --- Opciones que no son de tipo ---
+FLAG_EXCEPTION = 1 << 0
+FLAG_IMPORTANT = 1 << 1
+FLAG_MATCH_CASE = 1 << 2
+FLAG_BADFILTER = 1 << 3
+# Excepciones a nivel de página
+PAGE_DOCUMENT = 1 << 4
+PAGE_ELEMHIDE = 1 << 5
+PAGE_GENERICHIDE = 1 << 6
+PAGE_GENERICBLOCK = 1 << 7
+PAGE_FLAGS = PAGE_DOCUMENT | PAGE_ELEMHIDE | PAGE_GENERICHIDE | PAGE_GENERICBLOCK
+
+_PAGE_OPTIONS = {
+    "elemhide": PAGE_ELEMHIDE, "ehide": PAGE_ELEMHIDE,
+    "generichide": PAGE_GENERICHIDE, "ghide": PAGE_GENERICHIDE,
+    "genericblock": PAGE_GENERICBLOCK,
+}
+
+# --- Cómo se verifica el patrón de un candidato ---
+KIND_HOST = 0        # ||host^ : basta con que el host coincida
+KIND_HOST_REST = 1   # ||host/resto : el resto se compara tras el host
+KIND_PLAIN = 2       # subcadena literal
+KIND_PATTERN = 3     # comodines/anclas -> regex perezosa
+KIND_REGEX = 4       # /regex/ tal cual
+
+# --- Dónde está colocado un filtro dentro de FilterIndex ---
+WHERE_HOST = 0
+WHERE_GRAM = 1
+WHERE_SOURCE = 2
+WHERE_GENERIC = 3
+
+_SEPARATOR = r'(?:[^\w\-.%]|$)'
+_HOST_ANCHOR = r'^[^:/?#]+:(?://)?(?:[^/?#]*\.)?'
+_HOST_CHARS = re.compile(r'[a-z0-9.\-_]+')
+_HOST_END = re.compile(r'[/?#]')
+_LITERAL_SPLIT = re.compile(r'[*^|]+')
+_COSMETIC = re.compile(r'^([^/*|^$\s"]*?)#(@?)([?$%]?)#(.+)$')
+_NEVER = re.compile(r'(?!)')
+# Pseudo-clases procedurales (uBO/ABP) que no son CSS válido para WebKit
+_PROCEDURAL = (":-abp-", ":has-text(", ":upward(", ":xpath(", ":matches-",
+               ":min-text-length(", ":watch-attr(", ":remove(", ":style(",
+               ":others(", ":if(", ":if-not(", ":nth-ancestor(", ":contains(")
+
+# N-gramas que aparecen en casi cualquier URL: solo se usan como clave si no hay otra
+_COMMON_GRAMS = frozenset((
+    "http", "ttp:", "ttps", "tps:", "ps:/", "p://", "s://", "://w", "//ww", "/www", "www.",
+    ".com", "com/", ".net", "net/", ".org", "org/", "html", ".htm", "/js/", ".js?", ".php",
+    "imag", "mage", "ages", "/ima", "stat", "tati", "atic", "cont", "tent", "/wp-", "/api",
+))
+_COMMON_PENALTY = 1 << 20
+
+_EXTENSION_TYPES = {
+    "js": "script", "mjs": "script",
+    "css": "stylesheet",
+    "png": "image", "jpg": "image", "jpeg": "image", "gif": "image", "webp": "image",
+    "svg": "image", "ico": "image", "avif": "image", "bmp": "image",
+    "woff": "font", "woff2": "font", "ttf": "font", "otf": "font", "eot": "font",
+    "mp4": "media", "webm": "media", "mp3": "media", "ogg": "media", "m3u8": "media",
+    "m4a": "media", "wav": "media",
+    "htm": "subdocument", "html": "subdocument",
+}
+
+# Sufijos de segundo nivel habituales (aproximación a la Public Suffix List)
+_SECOND_LEVEL = {"co", "com", "net", "org", "gov", "edu", "ac", "gob", "or", "ne", "go", "mil", "nic"}
+
+
+def split_host(lower):
+    """(hostname, fin del hostname dentro de la uri) de una uri en minúsculas."""
+    start = lower.find('://')
+    if start == -1:
+        return '', 0
+    start += 3
+    m = _HOST_END.search(lower, start)
+    end = m.start() if m else len(lower)
+    at = lower.rfind('@', start, end)
+    if at != -1:
+        start = at + 1
+    if lower.startswith('[', start):
+        close = lower.find(']', start, end)
+        if close != -1:
+            return lower[start + 1:close], close + 1
+    colon = lower.find(':', start, end)
+    if colon != -1:
+        end = colon
+    return lower[start:end].rstrip('.'), end
+
+
+def host_suffixes(host):
+    """'a.b.com' -> ['a.b.com', 'b.com', 'com']"""
+    if not host:
+        return ()
+    suffixes = [host]
+    dot = host.find('.')
+    while dot != -1:
+        suffixes.append(host[dot + 1:])
+        dot = host.find('.', dot + 1)
+    return suffixes
+
+
+@lru_cache(maxsize=2048)
+def registrable_domain(host):
+    """eTLD+1 aproximado: 'www.news.bbc.co.uk' -> 'bbc.co.uk'."""
+    if not host or host.replace('.', '').isdigit() or ':' in host:
+        return host
+    labels = host.split('.')
+    if len(labels) <= 2:
+        return host
+    if len(labels[-1]) == 2 and labels[-2] in _SECOND_LEVEL:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def guess_resource_type(lower):
+    """Tipo de recurso deducido de la URL cuando WebKit no lo indica."""
+    if lower.startswith(('ws:', 'wss:')):
+        return "websocket"
+    end = len(lower)
+    for ch in '?#':
+        pos = lower.find(ch)
+        if pos != -1 and pos < end:
+            end = pos
+    slash = lower.rfind('/', 0, end)
+    dot = lower.rfind('.', slash + 1, end)
+    if dot == -1:
+        return "other"
+    return _EXTENSION_TYPES.get(lower[dot + 1:end], "other")
+
+
+class Request:
+    """Datos de una petición calculados una sola vez y compartidos por los índices."""
+
+    __slots__ = ("url", "lower", "host", "host_end", "suffixes", "type", "party",
+                 "source_host", "source_suffixes")
+
+    def __init__(self, url, resource_type=None, source_url=None):
+        self.url = url
+        self.lower = lower = url.lower()
+        self.host, self.host_end = split_host(lower)
+        self.suffixes = host_suffixes(self.host)
+        if not resource_type:
+            resource_type = guess_resource_type(lower)
+        self.type = TYPE_BITS.get(resource_type, TYPE_OTHER)
+        self.source_host = split_host(source_url.lower())[0] if source_url else ''
+        self.source_suffixes = host_suffixes(self.source_host)
+        if (self.source_host and self.host
+                and registrable_domain(self.host) != registrable_domain(self.source_host)):
+            self.party = THIRD_PARTY
+        else:
+            self.party = FIRST_PARTY
+
+
+class Filter:
+    """Filtro de red compilado. Las regex se construyen al primer uso."""
+
+    __slots__ = ("text", "kind", "types", "party", "flags", "pattern", "host",
+                 "include", "exclude", "_regex")
+
+    def __init__(self, text, kind, types, party, flags, pattern, host, include, exclude):
+        self.text = text
+        self.kind = kind
+        self.types = types
+        self.party = party
+        self.flags = flags
+        self.pattern = pattern
+        self.host = host
+        self.include = include   # frozenset de dominios de la página, o None
+        self.exclude = exclude   # frozenset de dominios excluidos, o None
+        self._regex = None
+
+    def __repr__(self):
+        return f"Filter({self.text!r})"
+
+    def __reduce__(self):
+        # Mucho más rápido que el pickle por defecto de __slots__ (parse_parallel)
+        return _restore_filter, (self.text, self.kind, self.types, self.party, self.flags,
+                                 self.pattern, self.host, self.include, self.exclude)
+
+    @property
+    def is_generic(self):
+        return self.include is None
+
+    def domain_allowed(self, suffixes):
+        """Aplica $domain=: decide la entrada más específica que coincida."""
+        include, exclude = self.include, self.exclude
+        for suffix in suffixes:
+            if exclude is not None and suffix in exclude:
+                return False
+            if include is not None and suffix in include:
+                return True
+        return include is None
+
+    def regex(self):
+        if self._regex is None:
+            try:
+                if self.kind == KIND_REGEX:
+                    flags = 0 if self.flags & FLAG_MATCH_CASE else re.IGNORECASE
+                    self._regex = re.compile(self.pattern, flags)
+                else:
+                    self._regex = re.compile(abp_to_regex(self.pattern))
+            except re.error:
+                self._regex = _NEVER
+        return self._regex
+
+    def matches(self, req):
+        if not (self.types & req.type) or not (self.party & req.party):
+            return False
+        if (self.include is not None or self.exclude is not None) \
+                and not self.domain_allowed(req.source_suffixes):
+            return False
+        kind = self.kind
+        if kind == KIND_HOST:
+            return True
+        text = req.url if self.flags & FLAG_MATCH_CASE else req.lower
+        if kind == KIND_PLAIN:
+            return self.pattern in text
+        if kind == KIND_HOST_REST:
+            return self.regex().match(text, req.host_end) is not None
+        if kind == KIND_REGEX:
+            return self.regex().search(req.url) is not None
+        return self.regex().search(text) is not None
+
+    def literal_segments(self):
+        """Trozos literales del patrón (en minúsculas) aptos para el índice de n-gramas."""
+        if self.kind == KIND_REGEX:
+            if self.flags & FLAG_MATCH_CASE:
+                return ()
+            return [s.lower() for s in _regex_literals(self.pattern) if len(s) >= NGRAM]
+        if self.kind == KIND_PLAIN:
+            return (self.pattern.lower(),)
+        return [s.lower() for s in _LITERAL_SPLIT.split(self.pattern) if len(s) >= NGRAM]
+
+
+def _restore_filter(text, kind, types, party, flags, pattern, host, include, exclude):
+    # Al venir de otro proceso se vuelven a internar host y dominios, como en parse_filter()
+    if include is not None:
+        include = frozenset(map(sys.intern, include))
+    if exclude is not None:
+        exclude = frozenset(map(sys.intern, exclude))
+    return Filter(text, kind, types, party, flags, pattern, sys.intern(host), include, exclude)
+
+
+def _regex_literals(body):
+    """
+    Trozos literales obligatorios de una /regex/: caracteres sueltos del nivel
+    superior y puntuación escapada. Un grupo, clase, '.', ancla o cuantificador
+    corta el trozo; con un '|' en el nivel superior no hay nada obligatorio.
+    """
+    out, cur, depth, i, n = [], [], 0, 0, len(body)
+    while i < n:
+        ch = body[i]
+        if ch == '\\' and i + 1 < n:
+            nxt = body[i + 1]
+            lit = nxt if not nxt.isalnum() else None
+            i += 2 + {'x': 2, 'u': 4, 'U': 8}.get(nxt, 0)
+        elif ch == '[':
+            end = body.find(']', i + 2)
+            i = n if end < 0 else end + 1
+            lit = None
+        elif ch in '()':
+            depth += 1 if ch == '(' else -1
+            lit, i = None, i + 1
+        elif ch == '|':
+            if depth == 0:
+                return []
+            lit, i = None, i + 1
+        else:
+            lit = None if ch in '.^$' or depth else ch
+            i += 1
+        repeat = None
+        if i < n and body[i] in '*+?{':
+            repeat = body[i]
+            if repeat == '{':
+                end = body.find('}', i)
+                i = n if end < 0 else end + 1
+            else:
+                i += 1
+            if i < n and body[i] in '?+':
+                i += 1
+        if lit is None or depth or repeat not in (None, '+'):
+            # Átomo opcional, repetido o no literal: corta el trozo
+            if cur:
+                out.append(''.join(cur))
+            cur = []
+        elif repeat == '+':
+            cur.append(lit)
+            out.append(''.join(cur))
+            cur = [lit]
+        else:
+            cur.append(lit)
+    if cur:
+        out.append(''.join(cur))
+    return out
+
+
+def abp_to_regex(pattern):
+    """Traduce un patrón ABP ('||', '|', '*', '^') a regex de Python."""
+    prefix = suffix = ''
+    if pattern.startswith('||'):
+        prefix, pattern = _HOST_ANCHOR, pattern[2:]
+    elif pattern.startswith('|'):
+        prefix, pattern = '^', pattern[1:]
+    if pattern.endswith('|'):
+        suffix, pattern = '$', pattern[:-1]
+    out = []
+    for ch in pattern:
+        if ch == '*':
+            out.append('.*')
+        elif ch == '^':
+            out.append(_SEPARATOR)
+        else:
+            out.append(re.escape(ch))
+    return prefix + ''.join(out) + suffix
+
+
+def _parse_domains(value, sep):
+    include, exclude = set(), set()
+    for d in value.split(sep):
+        d = d.strip().lower()
+        if not d or '*' in d:
+            continue
+        if d.startswith('~'):
+            exclude.add(sys.intern(d[1:]))
+        else:
+            include.add(sys.intern(d))
+    return frozenset(include) or None, frozenset(exclude) or None
+
+
+def parse_filter(line):
+    """
+    Compila una línea de filtro de red. Devuelve None para comentarios,
+    reglas cosméticas y filtros con opciones no soportadas (csp, redirect...),
+    que es preferible ignorar a aplicar a medias.
+    """
+    text = line.strip()
+    if not text or text.startswith(('!', '[')):
+        return None
+    line = text
+    flags = 0
+    if line.startswith('@@'):
+        flags |= FLAG_EXCEPTION
+        line = line[2:]
+
+    options = None
+    if line.startswith('/') and len(line) > 2:
+        close = line.rfind('/')
+        if close > 0 and (close == len(line) - 1 or line[close + 1] == '$'):
+            if close < len(line) - 1:
+                options = line[close + 2:]
+            regex_body = line[1:close]
+            line = None
+    if line is not None:
+        dollar = line.rfind('$')
+        if dollar != -1:
+            options = line[dollar + 1:]
+            line = line[:dollar]
+
+    types_in = types_out = 0
+    party = ANY_PARTY
+    include = exclude = None
+    if options is not None:
+        for opt in options.split(','):
+            opt = opt.strip()
+            if not opt:
+                continue
+            negated = opt.startswith('~')
+            name, _, value = opt.lstrip('~').partition('=')
+            name = name.lower()
+            if name in TYPE_BITS:
+                if negated:
+                    types_out |= TYPE_BITS[name]
+                else:
+                    types_in |= TYPE_BITS[name]
+            elif name in ("third-party", "3p"):
+                party = FIRST_PARTY if negated else THIRD_PARTY
+            elif name in ("first-party", "1p"):
+                party = THIRD_PARTY if negated else FIRST_PARTY
+            elif name in ("domain", "from") and value:
+                include, exclude = _parse_domains(value, '|')
+            elif name == "match-case":
+                flags |= FLAG_MATCH_CASE
+            elif name == "important":
+                flags |= FLAG_IMPORTANT
+            elif name == "badfilter":
+                flags |= FLAG_BADFILTER
+            elif name == "all":
+                types_in |= ALL_TYPES
+            elif name in _PAGE_OPTIONS and flags & FLAG_EXCEPTION:
+                flags |= _PAGE_OPTIONS[name]
+            else:
+                return None
+
+    if types_in & TYPE_DOCUMENT and flags & FLAG_EXCEPTION:
+        flags |= PAGE_DOCUMENT
+    if types_in:
+        types = types_in & ~types_out
+    elif flags & PAGE_FLAGS:
+        types = 0   # solo afecta a la página (elemhide, generichide...)
+    else:
+        types = DEFAULT_TYPES & ~types_out
+    if not types and not flags & PAGE_FLAGS:
+        return None
+
+    host = ''
+    if line is None:
+        return Filter(text, KIND_REGEX, types, party, flags, regex_body, host, include, exclude)
+
+    pattern = line if flags & FLAG_MATCH_CASE or line.islower() else line.lower()
+    # Los '*' en los extremos no aportan nada (y anulan el ancla de ese lado)
+    if pattern.startswith('*'):
+        pattern = pattern.lstrip('*')
+    if pattern.endswith('*') and not pattern.endswith('|*'):
+        pattern = pattern.rstrip('*')
+
+    if pattern.startswith('||'):
+        m = _HOST_CHARS.match(pattern, 2)
+        rest = pattern[m.end():] if m else None
+        if m and rest[:1] in ('^', '/', ':'):
+            host = sys.intern(m.group().lower().rstrip('.'))
+            if rest == '^':
+                return Filter(text, KIND_HOST, types, party, flags, '', host, include, exclude)
+            return Filter(text, KIND_HOST_REST, types, party, flags, rest, host, include, exclude)
+        return Filter(text, KIND_PATTERN, types, party, flags, pattern, host, include, exclude)
+
+    if pattern.startswith('|') or pattern.endswith('|') or '*' in pattern or '^' in pattern:
+        return Filter(text, KIND_PATTERN, types, party, flags, pattern, host, include, exclude)
+    return Filter(text, KIND_PLAIN, types, party, flags, pattern, host, include, exclude)
+
+
+def _without_badfilter(text):
+    """Texto del filtro al que anula un '$badfilter'."""
+    head, _, options = text.rpartition('$')
+    kept = [o for o in options.split(',') if o.strip().lower() != "badfilter"]
+    return head + ('$' + ','.join(kept) if kept else '')
+
+
+def _pack(strings):
+    joined = ''.join(strings)
+    if joined.isascii():
+        # Lo normal (hosts en punycode, casi todos los selectores): un byte por carácter
+        return joined.encode("ascii"), array('I', accumulate(map(len, strings), initial=0))
+    del joined
+    # Se codifica de una en una para no tener a la vez todas las copias en bytes
+    buf, offsets = bytearray(), array('I', [0])
+    for s in strings:
+        buf += s.encode("utf-8")
+        offsets.append(len(buf))
+    return bytes(buf), offsets
+
+
+class StringTable:
+    """
+    Conjunto de cadenas (o diccionario str -> str) inmutable y compacto: las
+    cadenas van seguidas en un bloque UTF-8 y se localizan por su hash en un
+    array ordenado, sin un objeto str vivo por elemento.
+    """
+
+    __slots__ = ("_hashes", "_keys", "_key_offsets", "_values", "_value_offsets")
+
+    def __init__(self, items=()):
+        """'items': iterable de claves o dict clave -> valor."""
+        keys = sorted(items if isinstance(items, (dict, set, frozenset)) else set(items), key=hash)
+        self._hashes = array('q', map(hash, keys))
+        self._keys, self._key_offsets = _pack(keys)
+        if isinstance(items, dict):
+            self._values, self._value_offsets = _pack([items[k] for k in keys])
+        else:
+            self._values = self._value_offsets = None
+
+    def _find(self, key):
+        hashes = self._hashes
+        h = hash(key)
+        i = bisect_left(hashes, h)
+        n = len(hashes)
+        if i == n or hashes[i] != h:
+            return -1
+        raw = key.encode("utf-8")
+        blob, offsets = self._keys, self._key_offsets
+        while i < n and hashes[i] == h:
+            if blob[offsets[i]:offsets[i + 1]] == raw:
+                return i
+            i += 1
+        return -1
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __iter__(self):
+        blob, offsets = self._keys, self._key_offsets
+        for i in range(len(self._hashes)):
+            yield blob[offsets[i]:offsets[i + 1]].decode("utf-8")
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i < 0 or self._values is None:
+            return default
+        return self._values[self._value_offsets[i]:self._value_offsets[i + 1]].decode("utf-8")
+
+    def items(self):
+        values, offsets = self._values, self._value_offsets
+        for i, key in enumerate(self):
+            yield key, values[offsets[i]:offsets[i + 1]].decode("utf-8")
+
+
+EMPTY_TABLE = StringTable()
+
+
+class FilterIndex:
+    """Filtros de red de un mismo tipo (bloqueo, excepción...) indexados."""
+
+    def __init__(self):
+        self.hosts = set()   # ||host^ sin opciones (solo en el índice de bloqueo)
+        self.host_table = EMPTY_TABLE   # los mismos, ya compactados (ver compact())
+        self.by_host = {}    # host -> [Filter]
+        self.by_gram = {}    # n-grama -> [Filter]
+        self.by_source = {}  # dominio de la página -> [Filter]
+        self.generic = []    # sin nada que indexar
+        self.count = 0
+
+    @staticmethod
+    def _pure_host(f):
+        return (f.kind == KIND_HOST and f.types == DEFAULT_TYPES and f.party == ANY_PARTY
+                and f.include is None and f.exclude is None and not f.flags)
+
+    def add(self, f, pure_hosts=False):
+        if pure_hosts and self._pure_host(f):
+            self.hosts.add(f.host)
+        else:
+            where, key = self._place(f)
+            self._insert(f, where, key)
+        self.count += 1
+
+    def add_hosts(self, hosts):
+        """Lo mismo que add(f, pure_hosts=True) con un ||host^ sin opciones por host."""
+        self.hosts.update(hosts)
+        self.count += len(hosts)
+
+    def remove(self, f, pure_hosts=False):
+        """Quita el filtro con el mismo texto que 'f'. Devuelve True si estaba."""
+        if pure_hosts and self._pure_host(f):
+            self._thaw_hosts()
+            if f.host not in self.hosts:
+                return False
+            self.hosts.discard(f.host)
+            self.count -= 1
+            return True
+        # La cubeta elegida depende del estado del índice al añadirlo: se
+        # buscan todas las que _place() pudo elegir
+        if f.kind in (KIND_HOST, KIND_HOST_REST):
+            places = [(self.by_host, f.host)]
+        else:
+            places = [(self.by_gram, segment[i:i + NGRAM])
+                      for segment in f.literal_segments()
+                      for i in range(len(segment) - NGRAM + 1)]
+            places += [(self.by_source, domain) for domain in f.include or ()]
+        removed = False
+        for table, key in places:
+            bucket = table.get(key)
+            if bucket and any(g.text == f.text for g in bucket):
+                kept = [g for g in bucket if g.text != f.text]
+                if kept:
+                    table[key] = kept
+                else:
+                    del table[key]
+                removed = True
+        if any(g.text == f.text for g in self.generic):
+            self.generic = [g for g in self.generic if g.text != f.text]
+            removed = True
+        if removed:
+            self.count -= 1
+        return removed
+
+    def copy(self):
+        """Copia con contenedores propios; los Filter se comparten."""
+        other = FilterIndex()
+        other.hosts = set(self.hosts)
+        other.host_table = self.host_table   # inmutable: se comparte
+        other.by_host = {k: list(v) for k, v in self.by_host.items()}
+        other.by_gram = {k: list(v) for k, v in self.by_gram.items()}
+        other.by_source = {k: list(v) for k, v in self.by_source.items()}
+        other.generic = list(self.generic)
+        other.count = self.count
+        return other
+
+    def _place(self, f):
+        if f.kind in (KIND_HOST, KIND_HOST_REST):
+            return WHERE_HOST, f.host
+        # Elegir el n-grama con la cubeta más pequeña para repartir la carga,
+        # evitando los que aparecen en casi todas las URLs
+        by_gram = self.by_gram
+        best, best_size = None, -1
+        for segment in f.literal_segments():
+            for i in range(len(segment) - NGRAM + 1):
+                gram = segment[i:i + NGRAM]
+                size = len(by_gram.get(gram, ()))
+                if gram in _COMMON_GRAMS:
+                    size += _COMMON_PENALTY
+                if best_size < 0 or size < best_size:
+                    best, best_size = gram, size
+                    if size == 0:
+                        return WHERE_GRAM, best
+        if best is not None:
+            return WHERE_GRAM, best
+        if f.include is not None:
+            return WHERE_SOURCE, ''
+        return WHERE_GENERIC, ''
+
+    def _insert(self, f, where, key):
+        if where == WHERE_HOST:
+            self.by_host.setdefault(key, []).append(f)
+        elif where == WHERE_GRAM:
+            self.by_gram.setdefault(key, []).append(f)
+        elif where == WHERE_SOURCE:
+            for domain in f.include:
+                self.by_source.setdefault(domain, []).append(f)
+        else:
+            self.generic.append(f)
+
+    def compact(self):
+        """Pasa los hosts añadidos a la tabla compacta."""
+        if self.hosts:
+            hosts, self.hosts = self.hosts, set()
+            if self.host_table:
+                hosts.update(self.host_table)
+            self.host_table = StringTable(hosts)
+
+    def _thaw_hosts(self):
+        # Para quitar hosts se vuelve a un set; compact() los recompacta
+        if self.host_table:
+            self.hosts.update(self.host_table)
+            self.host_table = EMPTY_TABLE
+
+    def pure_hosts(self):
+        """Todos los hosts de reglas ||host^ sin opciones."""
+        return chain(self.host_table, self.hosts)
+
+    def host_hit(self, suffixes):
+        """Sufijo del host que está en el conjunto de hosts bloqueados, o ''."""
+        hosts, table = self.hosts, self.host_table
+        for suffix in suffixes:
+            if suffix in table or suffix in hosts:
+                return suffix
+        return ''
+
+    def _candidates(self, req):
+        """Genera las cubetas de candidatos para la petición."""
+        by_host = self.by_host
+        if by_host:
+            for suffix in req.suffixes:
+                bucket = by_host.get(suffix)
+                if bucket:
+                    yield bucket
+        by_gram = self.by_gram
+        if by_gram:
+            text = req.lower
+            grams = [text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)]
+            yield from [b for b in map(by_gram.get, grams) if b]
+        by_source = self.by_source
+        if by_source:
+            for suffix in req.source_suffixes:
+                bucket = by_source.get(suffix)
+                if bucket:
+                    yield bucket
+        if self.generic:
+            yield self.generic
+
+    def find(self, req, generic=True, host_hit=None):
+        """Primer filtro que coincide con la petición, o None."""
+        if generic and (self.host_table or self.hosts):
+            if host_hit is None:
+                host_hit = self.host_hit(req.suffixes)
+            if host_hit and req.type & DEFAULT_TYPES:
+                return host_filter(host_hit)
+        rtype, party = req.type, req.party
+        for bucket in self._candidates(req):
+            for f in bucket:
+                # Poda por tipo y origen antes de llamar a matches()
+                if (f.types & rtype and f.party & party
+                        and (generic or f.include is not None) and f.matches(req)):
+                    return f
+        return None
+
+    def find_all(self, req):
+        found = []
+        for bucket in self._candidates(req):
+            for f in bucket:
+                if f.matches(req) and f not in found:
+                    found.append(f)
+        return found
+
+    def filters(self):
+        """(filtro, dónde, clave) de cada filtro con objeto propio, sin repetir."""
+        seen = set()
+        for key, bucket in self.by_host.items():
+            for f in bucket:
+                yield f, WHERE_HOST, key
+        for key, bucket in self.by_gram.items():
+            for f in bucket:
+                yield f, WHERE_GRAM, key
+        for bucket in self.by_source.values():
+            for f in bucket:
+                if id(f) not in seen:
+                    seen.add(id(f))
+                    yield f, WHERE_SOURCE, ''
+        for f in self.generic:
+            yield f, WHERE_GENERIC, ''
+
+    def export(self, prefix, tables):
+        cols = {name: [] for name in ("text", "pattern", "host", "include", "exclude", "key")}
+        ints = {name: array('I') for name in ("kind", "types", "party", "flags", "where")}
+        for f, where, key in self.filters():
+            cols["text"].append(f.text)
+            cols["pattern"].append(f.pattern)
+            cols["host"].append(f.host)
+            cols["include"].append('|'.join(sorted(f.include)) if f.include else '')
+            cols["exclude"].append('|'.join(sorted(f.exclude)) if f.exclude else '')
+            cols["key"].append(key)
+            ints["kind"].append(f.kind)
+            ints["types"].append(f.types)
+            ints["party"].append(f.party)
+            ints["flags"].append(f.flags)
+            ints["where"].append(where)
+        for name, value in list(cols.items()) + list(ints.items()):
+            tables[f"{prefix}.{name}"] = value
+        tables[prefix + ".hosts"] = list(self.pure_hosts())
+        tables[prefix + ".count"] = array('I', [self.count])
+
+    @classmethod
+    def from_tables(cls, prefix, tables):
+        index = cls()
+        t = lambda name: tables[f"{prefix}.{name}"]
+        for (text, pattern, host, include, exclude, key, kind, types, party, flags,
+             where) in zip(t("text"), t("pattern"), t("host"), t("include"), t("exclude"),
+                           t("key"), t("kind"), t("types"), t("party"), t("flags"), t("where")):
+            f = Filter(text, kind, types, party, flags, pattern, host,
+                       frozenset(include.split('|')) if include else None,
+                       frozenset(exclude.split('|')) if exclude else None)
+            index._insert(f, where, key)
+        index.host_table = StringTable(t("hosts"))
+        index.count = t("count")[0]
+        return index
+
+
+def host_filter(host):
+    """Filter equivalente a '||host^' (para informar de qué regla bloqueó)."""
+    return Filter(f"||{host}^", KIND_HOST, DEFAULT_TYPES, ANY_PARTY, 0, '', host, None, None)
+
+
+def _pack_entries(entries):
+    """[(selector, excluidos)] -> 'sel\\tex1|ex2\\nsel2' para StringTable."""
+    return '\n'.join(sel + '\t' + '|'.join(sorted(ex)) if ex else sel for sel, ex in entries)
+
+
+def _unpack_entries(packed):
+    for item in packed.split('\n'):
+        sel, _, ex = item.partition('\t')
+        yield sel, frozenset(ex.split('|')) if ex else None
+
+
+class CosmeticIndex:
+    """
+    Reglas de ocultación de elementos (##) y sus excepciones (#@#).
+
+    Lo añadido va a diccionarios; compact() lo pasa a StringTable (selectores
+    genéricos sin exclusiones y selectores por dominio), que es como queda
+    el índice cargado. Para quitar reglas se vuelve a los diccionarios.
+    """
+
+    def __init__(self):
+        self.generic = {}     # selector -> frozenset de dominios excluidos, o None
+        self.by_domain = {}   # dominio -> [(selector, frozenset excluidos o None)]
+        self.exceptions = {}  # dominio ('' = todos) -> set de selectores
+        self.generic_table = EMPTY_TABLE   # selectores genéricos sin exclusiones
+        self.domain_table = EMPTY_TABLE    # dominio -> entradas empaquetadas
+        self.count = 0
+        self._shared = None      # ver shared_generic()
+        self._mentioned = None   # ver site_key()
+
+    def add(self, domains, selector, exception):
+        self._shared = self._mentioned = None
+        include, exclude = _parse_domains(domains, ',') if domains else (None, None)
+        if exception:
+            if include is None and exclude is not None:
+                return
+            for domain in include or ('',):
+                self.exceptions.setdefault(domain, set()).add(selector)
+        elif include is None:
+            if domains and exclude is None:
+                return   # solo había entidades tipo 'example.*' que no soportamos
+            self.generic[selector] = exclude
+        else:
+            for domain in include:
+                self.by_domain.setdefault(domain, []).append((selector, exclude))
+        self.count += 1
+
+    def compact(self):
+        plain = [sel for sel, ex in self.generic.items() if ex is None]
+        if plain:
+            self.generic_table = StringTable(chain(self.generic_table, plain))
+            for sel in plain:
+                del self.generic[sel]
+        if self.by_domain:
+            merged = dict(self.domain_table.items())
+            while self.by_domain:
+                domain, entries = self.by_domain.popitem()
+                packed = _pack_entries(entries)
+                merged[domain] = merged[domain] + '\n' + packed if domain in merged else packed
+            self.domain_table = StringTable(merged)
+
+    def _thaw(self):
+        for sel in self.generic_table:
+            self.generic.setdefault(sel, None)
+        for domain, packed in self.domain_table.items():
+            self.by_domain.setdefault(domain, [])[:0] = _unpack_entries(packed)
+        self.generic_table = self.domain_table = EMPTY_TABLE
+
+    def remove(self, domains, selector, exception):
+        """Deshace un add() con los mismos argumentos. Devuelve True si estaba."""
+        self._shared = self._mentioned = None
+        include, exclude = _parse_domains(domains, ',') if domains else (None, None)
+        if not exception:
+            self._thaw()
+        removed = False
+        if exception:
+            for domain in include or ('',):
+                sels = self.exceptions.get(domain)
+                if sels and selector in sels:
+                    sels.discard(selector)
+                    if not sels:
+                        del self.exceptions[domain]
+                    removed = True
+        elif include is None:
+            if selector in self.generic and self.generic[selector] == exclude:
+                del self.generic[selector]
+                removed = True
+        else:
+            entry = (selector, exclude)
+            for domain in include:
+                entries = self.by_domain.get(domain)
+                if entries and entry in entries:
+                    entries.remove(entry)
+                    if not entries:
+                        del self.by_domain[domain]
+                    removed = True
+        if removed:
+            self.count -= 1
+        return removed
+
+    def copy(self):
+        other = CosmeticIndex()
+        other.generic = dict(self.generic)
+        other.by_domain = {k: list(v) for k, v in self.by_domain.items()}
+        other.exceptions = {k: set(v) for k, v in self.exceptions.items()}
+        other.generic_table = self.generic_table   # inmutables: se comparten
+        other.domain_table = self.domain_table
+        other.count = self.count
+        return other
+
+    def generic_items(self):
+        """(selector, excluidos o None) de todas las reglas genéricas."""
+        return chain(((sel, None) for sel in self.generic_table), self.generic.items())
+
+    def domain_entries(self, domain):
+        """(selector, excluidos o None) de las reglas de un dominio."""
+        packed = self.domain_table.get(domain)
+        entries = self.by_domain.get(domain, ())
+        if packed is None:
+            return entries
+        return chain(_unpack_entries(packed), entries)
+
+    def domain_items(self):
+        """(dominio, selector, excluidos o None) de todas las reglas con dominio."""
+        for domain, packed in self.domain_table.items():
+            for sel, ex in _unpack_entries(packed):
+                yield domain, sel, ex
+        for domain, entries in self.by_domain.items():
+            for sel, ex in entries:
+                yield domain, sel, ex
+
+    def selectors(self, host, generic=True):
+        """Selectores a ocultar en una página de 'host'."""
+        suffixes = host_suffixes(host)
+        disabled = set(self.exceptions.get('', ()))
+        for suffix in suffixes:
+            disabled.update(self.exceptions.get(suffix, ()))
+        result = []
+        for suffix in suffixes:
+            for selector, exclude in self.domain_entries(suffix):
+                if selector in disabled:
+                    continue
+                if exclude is not None and any(s in exclude for s in suffixes):
+                    continue
+                result.append(selector)
+        if generic:
+            for selector, exclude in self.generic_items():
+                if selector in disabled:
+                    continue
+                if exclude is not None and any(s in exclude for s in suffixes):
+                    continue
+                result.append(selector)
+        return result
+
+    def shared_generic(self):
+        """
+        Selectores genéricos que valen para cualquier sitio (sin dominios
+        excluidos ni excepciones #@# de un dominio concreto aparte).
+        """
+        if self._shared is None:
+            disabled = self.exceptions.get('', ())
+            self._shared = [sel for sel, exclude in self.generic_items()
+                            if exclude is None and sel not in disabled]
+        return self._shared
+
+    def _is_shared(self, selector):
+        return selector in self.generic_table or self.generic.get(selector, 0) is None
+
+    def site_key(self, host):
+        """
+        Clave de las reglas de 'host': su eTLD+1 y, si las hay, los
+        subdominios que tienen reglas propias. Todos los hosts con la misma
+        clave reciben los mismos selectores.
+        """
+        if self._mentioned is None:
+            mentioned = set(self.exceptions)
+            mentioned.update(self.domain_table)
+            mentioned.update(self.by_domain)
+            for _, exclude in self.generic_items():
+                if exclude is not None:
+                    mentioned.update(exclude)
+            for _, _, exclude in self.domain_items():
+                if exclude is not None:
+                    mentioned.update(exclude)
+            self._mentioned = mentioned
+        site = registrable_domain(host)
+        deeper = tuple(s for s in host_suffixes(host)[:-1]
+                       if len(s) > len(site) and s in self._mentioned)
+        return (site,) + deeper
+
+    def site_selectors(self, host, generic=True):
+        """
+        Lo mismo que selectors() separado para hojas de estilo:
+        (genéricos, propios del sitio). 'genéricos' es None si no se aplican,
+        True si son los de shared_generic() o la lista ya filtrada para el sitio.
+        """
+        suffixes = host_suffixes(host)
+        disabled = set()
+        for suffix in suffixes:
+            disabled.update(self.exceptions.get(suffix, ()))
+        global_disabled = self.exceptions.get('', ())
+        site = []
+        for suffix in suffixes:
+            for selector, exclude in self.domain_entries(suffix):
+                if selector in disabled or selector in global_disabled:
+                    continue
+                if exclude is not None and any(s in exclude for s in suffixes):
+                    continue
+                site.append(selector)
+        if not generic:
+            return None, site
+        for selector, exclude in self.generic.items():
+            if exclude is None or selector in disabled or selector in global_disabled:
+                continue
+            if not any(s in exclude for s in suffixes):
+                site.append(selector)
+        if any(self._is_shared(sel) for sel in disabled):
+            return [sel for sel in self.shared_generic() if sel not in disabled], site
+        return True, site
+
+    def export(self, prefix, tables):
+        generic = list(self.generic_items())
+        tables[prefix + ".generic"] = [sel for sel, _ in generic]
+        tables[prefix + ".gen_exclude"] = ['|'.join(sorted(e)) if e else '' for _, e in generic]
+        domains, selectors, excludes = [], [], []
+        for domain, selector, exclude in self.domain_items():
+            domains.append(domain)
+            selectors.append(selector)
+            excludes.append('|'.join(sorted(exclude)) if exclude else '')
+        tables[prefix + ".domain"] = domains
+        tables[prefix + ".selector"] = selectors
+        tables[prefix + ".exclude"] = excludes
+        exc_domains, exc_selectors = [], []
+        for domain, sels in self.exceptions.items():
+            for selector in sels:
+                exc_domains.append(domain)
+                exc_selectors.append(selector)
+        tables[prefix + ".exc_domain"] = exc_domains
+        tables[prefix + ".exc_selector"] = exc_selectors
+        tables[prefix + ".count"] = array('I', [self.count])
+
+    @classmethod
+    def from_tables(cls, prefix, tables):
+        index = cls()
+        split = lambda s: frozenset(s.split('|')) if s else None
+        index.generic = dict(zip(tables[prefix + ".generic"],
+                                 map(split, tables[prefix + ".gen_exclude"])))
+        for domain, selector, exclude in zip(tables[prefix + ".domain"],
+                                             tables[prefix + ".selector"],
+                                             tables[prefix + ".exclude"]):
+            index.by_domain.setdefault(domain, []).append((selector, split(exclude)))
+        for domain, selector in zip(tables[prefix + ".exc_domain"], tables[prefix + ".exc_selector"]):
+            index.exceptions.setdefault(domain, set()).add(selector)
+        index.count = tables[prefix + ".count"][0]
+        index.compact()
+        return index
+
+
+def parse_cosmetic(line):
+    """(dominios, selector, es_excepción) de una regla ## / #@#, o None."""
+    m = _COSMETIC.match(line.strip())
+    if not m:
+        return None
+    domains, exception, extended, selector = m.groups()
+    selector = selector.strip()
+    # #?#, #$#, #%# (CSS extendido, snippets, scriptlets) y ##+js / ##^ no se soportan
+    if extended or selector.startswith(('+js(', '^')):
+        return None
+    if any(p in selector for p in _PROCEDURAL):
+        return None
+    return domains, selector, bool(exception)
+
+
+def parse_rule(line):
+    """
+    Compila una línea de la lista: un Filter, una tupla (dominios, selector,
+    es_excepción) si es cosmética, o None si no se usa.
+    """
+    if '#' in line:
+        cosmetic = parse_cosmetic(line)
+        if cosmetic is not None:
+            return cosmetic
+        if _COSMETIC.match(line.strip()):
+            return None
+    f = parse_filter(line)
+    if f is None or f.flags & FLAG_BADFILTER:
+        return None
+    return f
+
+
+# Resultado de parse_chunk() para un trozo de la lista: hosts de los ||host^
+# sin opciones (solo el host: es lo único que se guarda de ellos), el resto de
+# filtros de red y las reglas cosméticas, en el orden de la lista
+PartialIndex = namedtuple("PartialIndex", "hosts filters cosmetic")
+
+
+def parse_chunk(lines, bad=frozenset()):
+    """
+    La parte de add_lines() que no depende del resto de la lista: compila
+    las líneas (ya sin espacios) salvo las anuladas por $badfilter ('bad').
+    RuleIndex.merge() las indexa; el índice depende del orden de inserción,
+    así que los trozos se juntan en el orden de la lista.
+    """
+    hosts, filters, cosmetic = [], [], []
+    pure_host = FilterIndex._pure_host
+    for line in lines:
+        if not line or (bad and line in bad):
+            continue
+        rule = parse_rule(line)
+        if rule is None:
+            continue
+        if not isinstance(rule, Filter):
+            cosmetic.append(rule)
+        elif pure_host(rule):
+            hosts.append(rule.host)
+        else:
+            filters.append(rule)
+    return PartialIndex(hosts, filters, cosmetic)
+
+
+def _badfilters(lines):
+    return {_without_badfilter(line) for line in lines if 'badfilter' in line}
+
+
+def _pool_context():
+    # Sin fork: el plugin parsea desde un hilo de un proceso con GTK
+    import multiprocessing
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def parse_parallel(lines, workers=None, chunk_lines=CHUNK_LINES, min_lines=PARALLEL_MIN_LINES):
+    """
+    RuleIndex de las líneas con el parseo repartido en 'workers' procesos
+    (por defecto, uno por núcleo). El resultado es idéntico al de
+    RuleIndex().add_lines(lines); con pocas líneas o un solo núcleo se hace
+    así directamente.
+    """
+    lines = [line.strip() for line in lines]
+    workers = workers or os.cpu_count() or 1
+    chunks = [lines[i:i + chunk_lines] for i in range(0, len(lines), chunk_lines)]
+    if workers <= 1 or len(chunks) <= 1 or len(lines) < min_lines:
+        return RuleIndex().add_lines(lines)
+    index = RuleIndex()
+    bad = frozenset(_badfilters(lines))
+    index.badfilters |= bad
+    with ProcessPoolExecutor(min(workers, len(chunks)), mp_context=_pool_context()) as pool:
+        # map() entrega en orden: se indexa cada trozo mientras se parsean los siguientes
+        for partial in pool.map(parse_chunk, chunks, repeat(bad)):
+            index.merge(partial)
+    index.compact()
+    return index
+
+
+Match = namedtuple("Match", "blocked filter")
+NO_MATCH = Match(False, None)
+
+
+class RuleIndex:
+    """Lista de filtros compilada: bloqueos, excepciones y reglas cosméticas."""
+
+    def __init__(self):
+        self.blocks = FilterIndex()
+        self.important = FilterIndex()
+        self.exceptions = FilterIndex()
+        self.page_exceptions = FilterIndex()
+        self.cosmetic = CosmeticIndex()
+        self.badfilters = set()   # textos anulados por un $badfilter de la lista
+        self._last_page = (None, (0, None))
+
+    @property
+    def rule_count(self):
+        return self.blocks.count + self.important.count
+
+    @property
+    def exception_count(self):
+        return self.exceptions.count + self.page_exceptions.count
+
+    @property
+    def cosmetic_count(self):
+        return self.cosmetic.count
+
+    def add_rule(self, line):
+        """Añade una línea de la lista (red o cosmética). Devuelve True si se usó."""
+        rule = parse_rule(line)
+        if rule is None:
+            return False
+        if isinstance(rule, Filter):
+            self.add_filter(rule)
+        else:
+            self.cosmetic.add(*rule)
+        return True
+
+    def remove_rule(self, line):
+        """Deshace add_rule(line). Devuelve True si la regla estaba en el índice."""
+        f = parse_rule(line)
+        if f is None:
+            return False
+        if not isinstance(f, Filter):
+            return self.cosmetic.remove(*f)
+        if f.flags & FLAG_EXCEPTION:
+            removed = False
+            if f.flags & PAGE_FLAGS:
+                removed = self.page_exceptions.remove(f)
+            if f.types:
+                removed = self.exceptions.remove(f) or removed
+            return removed
+        if f.flags & FLAG_IMPORTANT:
+            return self.important.remove(f)
+        return self.blocks.remove(f, pure_hosts=True)
+
+    def add_filter(self, f):
+        if f.flags & FLAG_EXCEPTION:
+            if f.flags & PAGE_FLAGS:
+                # Se compara contra la URL de la página, que es de tipo documento
+                self.page_exceptions.add(Filter(f.text, f.kind, TYPE_DOCUMENT, f.party, f.flags,
+                                                f.pattern, f.host, f.include, f.exclude))
+            if f.types:
+                self.exceptions.add(f)
+        elif f.flags & FLAG_IMPORTANT:
+            self.important.add(f)
+        else:
+            self.blocks.add(f, pure_hosts=True)
+
+    def add_lines(self, lines):
+        lines = [line.strip() for line in lines]
+        self.badfilters |= _badfilters(lines)
+        self.merge(parse_chunk(lines, self.badfilters))
+        self.compact()
+        return self
+
+    def merge(self, partial):
+        """Indexa un PartialIndex (ver parse_chunk). No compacta."""
+        self.blocks.add_hosts(partial.hosts)
+        for f in partial.filters:
+            self.add_filter(f)
+        cosmetic = self.cosmetic
+        for rule in partial.cosmetic:
+            cosmetic.add(*rule)
+
+    def compact(self):
+        """Compacta lo añadido (ver StringTable); las consultas no cambian."""
+        for filter_index in (self.blocks, self.important, self.exceptions, self.page_exceptions):
+            filter_index.compact()
+        self.cosmetic.compact()
+
+    def copy(self):
+        other = RuleIndex()
+        other.blocks = self.blocks.copy()
+        other.important = self.important.copy()
+        other.exceptions = self.exceptions.copy()
+        other.page_exceptions = self.page_exceptions.copy()
+        other.cosmetic = self.cosmetic.copy()
+        other.badfilters = set(self.badfilters)
+        return other
+
+    def updated(self, added, removed):
+        """
+        Copia del índice con las líneas 'removed' quitadas y 'added' añadidas;
+        este índice no se toca y puede seguir atendiendo consultas mientras
+        tanto. Devuelve None si el cambio incluye algún $badfilter (anula o
+        restaura filtros ya compilados): entonces hay que reconstruirlo entero.
+        """
+        added = [line.strip() for line in added]
+        removed = [line.strip() for line in removed]
+        if any('badfilter' in line for line in added + removed):
+            return None
+        index = self.copy()
+        bad = index.badfilters
+        for line in removed:
+            if line and line not in bad:
+                index.remove_rule(line)
+        for line in added:
+            if line and line not in bad:
+                index.add_rule(line)
+        index.compact()
+        return index
+
+    def page_flags(self, page_url):
+        """(PAGE_* activos, excepción $document que aplica) para la página."""
+        if not page_url or not (self.page_exceptions.count):
+            return 0, None
+        last_url, last = self._last_page
+        if last_url == page_url:
+            return last
+        req = Request(page_url, "document", page_url)
+        flags, document = 0, None
+        for f in self.page_exceptions.find_all(req):
+            flags |= f.flags & PAGE_FLAGS
+            if f.flags & PAGE_DOCUMENT and document is None:
+                document = f
+        result = (flags, document)
+        self._last_page = (page_url, result)
+        return result
+
+    def check(self, url, resource_type=None, source_url=None, host_hit=None):
+        """
+        Decide una petición. 'resource_type' es un nombre de TYPE_BITS (si no
+        se indica se deduce de la URL) y 'source_url' la página que la hace.
+        Devuelve Match(bloqueado, filtro que decidió o None).
+        """
+        if not url:
+            return NO_MATCH
+        page, document = self.page_flags(source_url)
+        if page & PAGE_DOCUMENT:
+            return Match(False, document)
+        req = Request(url, resource_type, source_url)
+        generic = not page & PAGE_GENERICBLOCK
+        f = self.important.find(req, generic)
+        if f is not None:
+            return Match(True, f)
+        f = self.blocks.find(req, generic, host_hit)
+        if f is None:
+            return NO_MATCH
+        exception = self.exceptions.find(req)
+        if exception is not None:
+            return Match(False, exception)
+        return Match(True, f)
+
+    def match(self, url, resource_type=None, source_url=None):
+        """True si la petición debe bloquearse."""
+        return self.check(url, resource_type, source_url).blocked
+
+    def cosmetic_selectors(self, page_url):
+        """Selectores de ocultación que aplican a la página (respeta $elemhide/$generichide)."""
+        flags, _ = self.page_flags(page_url)
+        if flags & (PAGE_DOCUMENT | PAGE_ELEMHIDE):
+            return []
+        host = split_host(page_url.lower())[0] if page_url else ''
+        return self.cosmetic.selectors(host, generic=not flags & PAGE_GENERICHIDE)
+
+    def cosmetic_site_key(self, page_url):
+        """Clave de caché de la hoja de ocultación de la página (ver CosmeticIndex.site_key)."""
+        flags, _ = self.page_flags(page_url)
+        host = split_host(page_url.lower())[0] if page_url else ''
+        flags &= PAGE_DOCUMENT | PAGE_ELEMHIDE | PAGE_GENERICHIDE
+        return (flags,) + self.cosmetic.site_key(host)
+
+    def cosmetic_site_selectors(self, page_url):
+        """(genéricos, propios del sitio) como CosmeticIndex.site_selectors, o (None, [])."""
+        flags, _ = self.page_flags(page_url)
+        if flags & (PAGE_DOCUMENT | PAGE_ELEMHIDE):
+            return None, []
+        host = split_host(page_url.lower())[0] if page_url else ''
+        return self.cosmetic.site_selectors(host, generic=not flags & PAGE_GENERICHIDE)
+
+    def export_tables(self):
+        """Vuelca el índice en tablas planas (listas de str y array('I'))."""
+        tables = {}
+        self.blocks.export('blk', tables)
+        self.important.export('imp', tables)
+        self.exceptions.export('exc', tables)
+        self.page_exceptions.export('pag', tables)
+        self.cosmetic.export('cos', tables)
+        tables["bad.text"] = sorted(self.badfilters)
+        return tables
+
+    @classmethod
+    def from_tables(cls, tables):
+        """Reconstruye el índice desde export_tables() sin volver a parsear."""
+        index = cls()
+        index.blocks = FilterIndex.from_tables('blk', tables)
+        index.important = FilterIndex.from_tables('imp', tables)
+        index.exceptions = FilterIndex.from_tables('exc', tables)
+        index.page_exceptions = FilterIndex.from_tables('pag', tables)
+        index.cosmetic = CosmeticIndex.from_tables('cos', tables)
+        index.badfilters = set(tables["bad.text"])
+        index.compact()
+        return index
+
+
+class CacheStats:
+    """Contadores acumulados de una cache; sobreviven a las recargas de reglas."""
+
+    __slots__ = ("hits", "misses", "evictions", "invalidations")
+
+    def __init__(self):
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class DecisionCache:
+    """LRU acotada de decisiones."""
+
+    def __init__(self, capacity, stats=None):
+        self.capacity = capacity
+        self.stats = stats if stats is not None else CacheStats()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.stats.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def put(self, key, value):
+        data = self._data
+        data[key] = value
+        if len(data) > self.capacity:
+            data.popitem(last=False)
+            self.stats.evictions += 1
+
+    def clear(self):
+        self.stats.invalidations += 1
+        self._data.clear()
+
+
+class CachedMatcher:
+    """
+    RuleIndex con dos caches de decisiones delante:
+    - por petición (URL, tipo y página de origen),
+    - por host, para las reglas ||host^ sin opciones.
+
+    Las caches pertenecen a este objeto: al cambiar de reglas se crea otro
+    CachedMatcher, así que nunca se mezclan decisiones de dos listas.
+    """
+
+    def __init__(self, index, url_capacity=4096, host_capacity=1024,
+                 url_stats=None, host_stats=None):
+        self.index = index
+        self.urls = DecisionCache(url_capacity, url_stats)
+        self.hosts = DecisionCache(host_capacity, host_stats)
+
+    def check(self, url, resource_type=None, source_url=None):
+        if not url:
+            return NO_MATCH
+        key = (url, resource_type, source_url)
+        verdict = self.urls.get(key)
+        if verdict is not None:
+            return verdict
+        host = split_host(url.lower())[0]
+        host_hit = self.hosts.get(host)
+        if host_hit is None:
+            host_hit = self.index.blocks.host_hit(host_suffixes(host))
+            self.hosts.put(host, host_hit)
+        verdict = self.index.check(url, resource_type, source_url, host_hit)
+        self.urls.put(key, verdict)
+        return verdict
+
+    def match(self, url, resource_type=None, source_url=None):
+        return self.check(url, resource_type, source_url).blocked
+
+    def invalidate(self):
+        """Marca las caches como descartadas (el objeto deja de usarse)."""
+        self.urls.clear()
+        self.hosts.clear()
+
+    def stats(self):
+        return {
+            "url": dict(self.urls.stats.as_dict(), size=len(self.urls), capacity=self.urls.capacity),
+            "host": dict(self.hosts.stats.as_dict(), size=len(self.hosts), capacity=self.hosts.capacity),
+        }
+
+
+def run_conformance(path):
+    """
+    Comprueba el motor contra un corpus de casos. El archivo tiene una
+    sección [filters] con la lista a compilar y una sección [cases] con
+    líneas 'block|allow  url  tipo  origen' ('-' si no hay tipo/origen).
+    Devuelve (nº de casos, [(línea, esperado, obtenido)]).
+    """
+    filters, cases, section = [], [], None
+    with open(path, encoding="utf-8") as f:
+        for raw in f:
+            line = raw.strip()
+            if line in ("[filters]", "[cases]"):
+                section = line
+            elif section == "[filters]":
+                filters.append(line)
+            elif section == "[cases]" and line and not line.startswith('#'):
+                cases.append(line)
+    index = RuleIndex().add_lines(filters)
+    failures = []
+    for line in cases:
+        expected, url, rtype, origin = (line.split() + ['-', '-'])[:4]
+        blocked = index.match(url, None if rtype == '-' else rtype,
+                              None if origin == '-' else origin)
+        got = "block" if blocked else "allow"
+        if got != expected:
+            failures.append((line, expected, got))
+    return len(cases), failures
+
+
+if __name__ == "__main__":
+    import pathlib
+    corpus = sys.argv[1] if len(sys.argv) > 1 else pathlib.Path(__file__).with_name("conformance.txt")
+    total, failures = run_conformance(corpus)
+    for line, expected, got in failures:
+        print(f"FALLO: esperado {expected}, obtenido {got}: {line}")
+    print(f"{total - len(failures)}/{total} casos correctos")
+    sys.exit(1 if failures else 0)
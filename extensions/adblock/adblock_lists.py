@@ -0,0 +1,238 @@
+# adblock_lists.py
+"""
+Suscripciones a listas de filtros.
+
+Las listas se declaran en manifest.json ("subscriptions") y el usuario puede
+activarlas, desactivarlas o añadir otras en subscriptions.json, junto al
+plugin:
+
+    {"easyprivacy": {"enabled": true},
+     "mi-lista": {"name": "Mi lista", "url": "https://.../lista.txt", "ttl_hours": 12}}
+
+Cada lista tiene su copia local, su estado de descarga (ETag, última
+comprobación...) y su TTL. Todas comparten un único índice: una línea que
+está en varias listas se indexa una sola vez, y al activar, desactivar o
+actualizar una lista solo se añaden o quitan las líneas que no tiene
+ninguna otra lista activa (effective_changes).
+
+Las estadísticas por lista (list_stats) se calculan a partir de las copias
+en disco cuando se piden, sin guardar en memoria a qué listas pertenece
+cada regla.
+"""
+import json
+import os
+
+import adblock_cache
+import adblock_update
+
+DEFAULT_TTL_HOURS = 24
+SETTINGS_NAME = "subscriptions.json"
+LISTS_DIR = "lists"   # copias locales de las listas que no dicen otra cosa
+
+
+class Subscription:
+    """Una lista suscrita: de dónde se descarga, dónde se guarda y cada cuánto."""
+
+    def __init__(self, ext_dir, list_id, spec, custom=False):
+        self.id = list_id
+        self.name = spec.get("name") or list_id
+        self.url = spec["url"]
+        self.ttl = float(spec.get("ttl_hours", DEFAULT_TTL_HOURS)) * 3600
+        self.enabled = bool(spec.get("enabled", True))
+        self.custom = custom   # añadida en subscriptions.json, no en el manifest
+        self.cache_path = ext_dir / (spec.get("cache") or f"{LISTS_DIR}/{list_id}.txt")
+        self.state_path = self.cache_path.with_suffix(".json")
+
+    def __repr__(self):
+        return f"Subscription({self.id!r})"
+
+    def due(self, now):
+        """True si toca comprobar si hay una versión nueva."""
+        if not self.cache_path.exists():
+            return True
+        state = adblock_update.load_state(self.state_path)
+        if state.get("url", self.url) != self.url:
+            return True
+        return now - adblock_update.last_checked(state, self.cache_path) >= self.ttl
+
+    def update(self, timeout=20):
+        """Pone al día la copia local (ver adblock_update.update_list)."""
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        return adblock_update.update_list(self.url, self.cache_path, self.state_path, timeout)
+
+    def read_lines(self):
+        """Líneas de la copia local, sin espacios; [] si todavía no hay copia."""
+        try:
+            text = self.cache_path.read_text(encoding="utf-8", errors="ignore")
+        except OSError:
+            return []
+        return [line.strip() for line in text.splitlines()]
+
+    def spec(self):
+        spec = {"name": self.name, "url": self.url, "ttl_hours": self.ttl / 3600,
+                "enabled": self.enabled}
+        if self.cache_path.name != f"{self.id}.txt":
+            spec["cache"] = self.cache_path.name
+        return spec
+
+
+def load_settings(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            settings = json.load(f)
+        return settings if isinstance(settings, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def load_subscriptions(ext_dir, declared, settings):
+    """
+    Suscripciones del manifest ('declared', lista de specs con "id") con lo
+    que cambie el usuario en 'settings' (id -> spec parcial o completa).
+    """
+    subs, seen = [], set()
+    for spec in declared:
+        list_id = spec.get("id")
+        if not list_id or list_id in seen or not spec.get("url"):
+            continue
+        seen.add(list_id)
+        subs.append(Subscription(ext_dir, list_id, {**spec, **settings.get(list_id, {})}))
+    for list_id, spec in settings.items():
+        if list_id in seen or not isinstance(spec, dict) or not spec.get("url"):
+            continue
+        seen.add(list_id)
+        subs.append(Subscription(ext_dir, list_id, spec, custom=True))
+    return subs
+
+
+def save_settings(path, subs):
+    """Guarda el estado de cada lista (y las listas propias enteras)."""
+    settings = {sub.id: sub.spec() if sub.custom else {"enabled": sub.enabled} for sub in subs}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(settings, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def union_lines(subs):
+    """Líneas de las listas, cada una una sola vez y en el orden de las listas."""
+    seen = set()
+    lines = []
+    for sub in subs:
+        for line in sub.read_lines():
+            if line and line not in seen:
+                seen.add(line)
+                lines.append(line)
+    return lines
+
+
+def effective_changes(changes, enabled):
+    """
+    Cambios del índice compartido. 'changes': id de lista -> (añadidas,
+    quitadas) de esa lista, con la copia en disco ya nueva; 'enabled': las
+    listas activas tras el cambio (una lista que se desactiva va en
+    'changes' con todas sus líneas como quitadas y no va en 'enabled').
+    Una línea solo entra si antes no la tenía ninguna lista activa, y solo
+    sale si ya no la tiene ninguna.
+    """
+    lines = {sub.id: set(sub.read_lines()) for sub in enabled}
+    candidates = {}
+    for added, removed in changes.values():
+        for line in added:
+            candidates.setdefault(line, None)
+        for line in removed:
+            candidates.setdefault(line, None)
+    changed = {list_id: (set(added), set(removed)) for list_id, (added, removed) in changes.items()}
+
+    def present_before(line):
+        for list_id, current in lines.items():
+            if list_id in changed:
+                added, removed = changed[list_id]
+                if line in removed or (line in current and line not in added):
+                    return True
+            elif line in current:
+                return True
+        # Listas que se desactivan: la tenían si la quitan
+        return any(line in removed for list_id, (_, removed) in changed.items()
+                   if list_id not in lines)
+
+    def present_after(line):
+        return any(line in current for current in lines.values())
+
+    eff_added, eff_removed = [], []
+    for line in candidates:
+        if not line:
+            continue
+        before, after = present_before(line), present_after(line)
+        if after and not before:
+            eff_added.append(line)
+        elif before and not after:
+            eff_removed.append(line)
+    return eff_added, eff_removed
+
+
+def sources_text(subs):
+    """Identifica el contenido del índice compartido: listas activas y su sha256."""
+    return "".join(f"{sub.id}\t{adblock_cache.file_digest(sub.cache_path).hex()}\n"
+                   for sub in subs if sub.cache_path.exists())
+
+
+def write_sources(path, subs):
+    """
+    Escribe el archivo de fuentes del índice si cambió. El índice
+    precompilado (y el filtro nativo) se ligan a este archivo.
+    """
+    text = sources_text(subs)
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read() == text:
+                return
+    except OSError:
+        pass
+    adblock_update.write_atomic(path, text)
+
+
+def _is_rule(line):
+    return bool(line) and not line.startswith(('!', '['))
+
+
+def list_stats(subs, hits):
+    """
+    Estadísticas por lista: reglas, reglas que solo aporta ella (entre las
+    activas), peticiones bloqueadas por reglas suyas y las que solo ella
+    habría bloqueado. 'hits': texto de regla -> peticiones que bloqueó.
+    """
+    lines = {sub.id: {line for line in sub.read_lines() if _is_rule(line)} for sub in subs}
+    enabled = [sub for sub in subs if sub.enabled]
+    owners = {}
+    for sub in enabled:
+        for text in hits:
+            if text in lines[sub.id]:
+                owners.setdefault(text, []).append(sub.id)
+    stats = []
+    for sub in subs:
+        own = lines[sub.id]
+        others = [lines[o.id] for o in enabled if o is not sub]
+        unique = sum(1 for line in own if not any(line in other for other in others))
+        blocked = exclusive = 0
+        if sub.enabled:
+            for text, count in hits.items():
+                ids = owners.get(text, ())
+                if sub.id in ids:
+                    blocked += count
+                    if len(ids) == 1:
+                        exclusive += count
+        state = adblock_update.load_state(sub.state_path)
+        stats.append({
+            "id": sub.id,
+            "name": sub.name,
+            "url": sub.url,
+            "enabled": sub.enabled,
+            "rules": len(own),
+            "unique_rules": unique,
+            "blocked": blocked,
+            "exclusive_blocked": exclusive,
+            "checked": state.get("checked"),
+            "ttl_hours": sub.ttl / 3600,
+        })
+    return stats
@@ -0,0 +1,152 @@
+# adblock_stats.py
+"""
+Estadísticas por petición de los manejadores de señales del plugin.
+
+Con las estadísticas desactivadas (lo normal) los manejadores solo miran
+RequestStats.enabled; activadas, cada petición apunta cuánto tardó el
+manejador, si se bloqueó, la página y la pestaña. Se guarda:
+
+- histograma de tiempos por manejador (cubetas fijas en µs),
+- bloqueadas/permitidas por página (las últimas PAGE_CAPACITY páginas) y
+  por pestaña,
+- reglas que más bloquean (el contador lo lleva el plugin, ver rule_hits).
+
+Todo se llama desde el hilo de GTK, así que no hace falta ningún cerrojo.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+
+# Límites superiores de las cubetas del histograma, en µs (la última, sin límite)
+BUCKETS_US = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+_BUCKETS_NS = tuple(b * 1000 for b in BUCKETS_US)
+PAGE_CAPACITY = 200
+
+
+def bucket_labels():
+    labels = [f"≤{b} µs" if b < 1000 else f"≤{b // 1000} ms" for b in BUCKETS_US]
+    return labels + [f">{BUCKETS_US[-1] // 1000} ms"]
+
+
+class Counts:
+    """Bloqueadas, permitidas y tiempo total de un grupo de peticiones."""
+
+    __slots__ = ("blocked", "allowed", "time_ns")
+
+    def __init__(self):
+        self.blocked = self.allowed = self.time_ns = 0
+
+    def add(self, elapsed_ns, blocked):
+        if blocked:
+            self.blocked += 1
+        else:
+            self.allowed += 1
+        self.time_ns += elapsed_ns
+
+    @property
+    def requests(self):
+        return self.blocked + self.allowed
+
+    def as_dict(self):
+        n = self.requests
+        return {
+            "requests": n,
+            "blocked": self.blocked,
+            "allowed": self.allowed,
+            "total_ms": self.time_ns / 1e6,
+            "mean_us": self.time_ns / n / 1000 if n else 0.0,
+        }
+
+
+class Timing:
+    """Histograma y totales de un manejador."""
+
+    __slots__ = ("counts", "histogram", "max_ns")
+
+    def __init__(self):
+        self.counts = Counts()
+        self.histogram = [0] * (len(BUCKETS_US) + 1)
+        self.max_ns = 0
+
+    def add(self, elapsed_ns, blocked):
+        self.counts.add(elapsed_ns, blocked)
+        self.histogram[bisect_left(_BUCKETS_NS, elapsed_ns)] += 1
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def percentile_us(self, fraction):
+        """Límite de la cubeta donde cae el percentil (cota superior)."""
+        total = sum(self.histogram)
+        if not total:
+            return 0
+        target = fraction * total
+        seen = 0
+        for i, n in enumerate(self.histogram):
+            seen += n
+            if seen >= target:
+                return BUCKETS_US[i] if i < len(BUCKETS_US) else self.max_ns / 1000
+        return self.max_ns / 1000
+
+    def as_dict(self):
+        return dict(self.counts.as_dict(),
+                    p50_us=self.percentile_us(0.50),
+                    p99_us=self.percentile_us(0.99),
+                    max_us=self.max_ns / 1000,
+                    histogram=list(self.histogram))
+
+
+class RequestStats:
+    """Contadores de las señales; record() solo se llama con enabled a True."""
+
+    def __init__(self, page_capacity=PAGE_CAPACITY):
+        self.enabled = False
+        self.page_capacity = page_capacity
+        self.reset()
+
+    def reset(self):
+        self.handlers = {}            # nombre del manejador -> Timing
+        self.pages = OrderedDict()    # URL de la página -> Counts (LRU)
+        self.tabs = {}                # id de la pestaña -> [Counts, última página]
+
+    def record(self, handler, tab, page, elapsed_ns, blocked):
+        timing = self.handlers.get(handler)
+        if timing is None:
+            timing = self.handlers[handler] = Timing()
+        timing.add(elapsed_ns, blocked)
+        if page:
+            page = page.split('#', 1)[0]
+            counts = self.pages.get(page)
+            if counts is None:
+                counts = self.pages[page] = Counts()
+                if len(self.pages) > self.page_capacity:
+                    self.pages.popitem(last=False)
+            else:
+                self.pages.move_to_end(page)
+            counts.add(elapsed_ns, blocked)
+        entry = self.tabs.get(tab)
+        if entry is None:
+            entry = self.tabs[tab] = [Counts(), page]
+        entry[0].add(elapsed_ns, blocked)
+        if page:
+            entry[1] = page
+
+    def forget_tab(self, tab):
+        self.tabs.pop(tab, None)
+
+    def snapshot(self, rule_hits=None, top=10, pages=20):
+        """Todo en tipos simples (para la API y la vista del gestor)."""
+        total = Counts()
+        for timing in self.handlers.values():
+            total.blocked += timing.counts.blocked
+            total.allowed += timing.counts.allowed
+            total.time_ns += timing.counts.time_ns
+        recent = list(self.pages.items())[-pages:]
+        return {
+            "enabled": self.enabled,
+            "total": total.as_dict(),
+            "handlers": {name: timing.as_dict() for name, timing in self.handlers.items()},
+            "buckets": bucket_labels(),
+            "pages": [dict(counts.as_dict(), page=page) for page, counts in reversed(recent)],
+            "tabs": [dict(counts.as_dict(), tab=tab, page=page)
+                     for tab, (counts, page) in self.tabs.items()],
+            "top_rules": (rule_hits.most_common(top) if rule_hits is not None else []),
+        }
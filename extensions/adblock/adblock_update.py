@@ -0,0 +1,262 @@
+# adblock_update.py
+"""
+Actualización incremental de la lista de filtros.
+
+- Descarga condicional: se guardan ETag y Last-Modified de la última
+  respuesta y se envían como If-None-Match / If-Modified-Since; un 304 no
+  vuelve a bajar ni a parsear nada.
+- Parches: si la lista trae una cabecera '! Diff-Path:', se pide primero ese
+  parche (diff estilo RCS, el que publica EasyList) y se aplica sobre la
+  copia local. Si el parche no existe (404) la lista sigue al día; si no se
+  puede aplicar o la suma no cuadra, se descarga la lista completa. Cada
+  FULL_CHECK_INTERVAL se pide además la lista completa (condicional).
+- En todos los casos se devuelven las líneas añadidas y quitadas, para que
+  el índice se actualice sin volver a parsear la lista entera.
+
+El estado (ETag, Last-Modified, hora de la última comprobación) se guarda en
+un JSON junto a la lista.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from collections import namedtuple
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urldefrag
+from urllib.request import Request, urlopen
+
+# Resultado de update_list():
+#   status   'not-modified', 'patched', 'downloaded' o 'error'
+#   added    líneas nuevas, removed  líneas que ya no están (None = se desconoce)
+#   text     texto completo de la lista nueva (None si no cambió)
+ListUpdate = namedtuple("ListUpdate", "status added removed text")
+
+_DIFF_PATH = re.compile(r"^!\s*Diff-Path:\s*(\S+)", re.IGNORECASE | re.MULTILINE)
+_DIFF_HEADER = re.compile(r"^diff\s+(.*)$")
+_RCS_COMMAND = re.compile(r"^([ad])(\d+)\s+(\d+)$")
+
+USER_AGENT = "Navia-AdBlock/1.0"
+# Aunque haya parches, cada tanto se pide la lista completa (condicional) por
+# si el servidor dejó de publicarlos
+FULL_CHECK_INTERVAL = 4 * 24 * 60 * 60
+
+
+class PatchError(ValueError):
+    """El parche no se puede aplicar sobre la copia local."""
+
+
+def load_state(state_path):
+    try:
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_path, state):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def write_atomic(path, text):
+    """Escribe la lista entera o no la toca (nunca queda a medias)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def last_checked(state, list_path):
+    """Hora de la última comprobación (o el mtime de la lista si no consta)."""
+    checked = state.get("checked")
+    if isinstance(checked, (int, float)):
+        return checked
+    try:
+        return os.stat(list_path).st_mtime
+    except OSError:
+        return 0
+
+
+def _fetch(url, headers=None, timeout=20):
+    """(código, cabeceras, texto) de un GET; 304 y 404 no son errores."""
+    req = Request(url, headers={"User-Agent": USER_AGENT, **(headers or {})})
+    try:
+        with urlopen(req, timeout=timeout) as resp:
+            body = resp.read().decode("utf-8", errors="ignore")
+            return resp.status, resp.headers, body
+    except HTTPError as e:
+        if e.code in (304, 404):
+            return e.code, e.headers, None
+        raise
+
+
+def diff_path(text):
+    """Valor de la cabecera '! Diff-Path:' de la lista, o None."""
+    # Las cabeceras están al principio; no hace falta mirar toda la lista
+    m = _DIFF_PATH.search(text, 0, 4096)
+    return m.group(1) if m else None
+
+
+def _select_diff(patch_text, name):
+    """
+    Líneas del diff para la lista 'name' dentro de un archivo de parches, y
+    sus campos de cabecera ('lines', 'checksum'...). Un parche sin cabeceras
+    'diff ...' es un único diff RCS.
+    """
+    lines = patch_text.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    if not lines or not _DIFF_HEADER.match(lines[0]):
+        return lines, {}
+    i = 0
+    while i < len(lines):
+        m = _DIFF_HEADER.match(lines[i])
+        if not m:
+            raise PatchError(f"se esperaba una cabecera 'diff' en la línea {i + 1}")
+        fields = dict(f.split(":", 1) for f in m.group(1).split() if ":" in f)
+        try:
+            count = int(fields.get("lines", ""))
+        except ValueError:
+            raise PatchError("cabecera 'diff' sin 'lines:'")
+        body = lines[i + 1:i + 1 + count]
+        if name is None or fields.get("name") == name:
+            return body, fields
+        i += 1 + count
+    raise PatchError(f"el parche no trae la lista '{name}'")
+
+
+def apply_rcs_diff(old_lines, diff_lines):
+    """
+    Aplica un diff RCS ('aN M' añade M líneas tras la N, 'dN M' borra M
+    líneas desde la N; los números se refieren a la versión original).
+    Devuelve (líneas nuevas, añadidas, quitadas).
+    """
+    new_lines, added, removed = [], [], []
+    pos = 0   # líneas originales ya copiadas
+    i = 0
+    while i < len(diff_lines):
+        m = _RCS_COMMAND.match(diff_lines[i])
+        if not m:
+            raise PatchError(f"orden RCS inválida: {diff_lines[i]!r}")
+        op, line_no, count = m.group(1), int(m.group(2)), int(m.group(3))
+        i += 1
+        if op == "d":
+            start = line_no - 1
+            if start < pos or start + count > len(old_lines):
+                raise PatchError(f"borrado fuera de rango: d{line_no} {count}")
+            new_lines.extend(old_lines[pos:start])
+            removed.extend(old_lines[start:start + count])
+            pos = start + count
+        else:
+            if line_no < pos or line_no > len(old_lines) or i + count > len(diff_lines):
+                raise PatchError(f"inserción fuera de rango: a{line_no} {count}")
+            new_lines.extend(old_lines[pos:line_no])
+            pos = line_no
+            chunk = diff_lines[i:i + count]
+            new_lines.extend(chunk)
+            added.extend(chunk)
+            i += count
+    new_lines.extend(old_lines[pos:])
+    return new_lines, added, removed
+
+
+def _checksum_ok(text, expected):
+    # Los parches llevan el sha1 (en hex, a menudo truncado) de la lista resultante
+    return hashlib.sha1(text.encode("utf-8")).hexdigest().startswith(expected.lower())
+
+
+def line_changes(old_text, new_text):
+    """(añadidas, quitadas) entre dos versiones de la lista, sin orden."""
+    old_set = set(old_text.splitlines())
+    new_set = set(new_text.splitlines())
+    return sorted(new_set - old_set), sorted(old_set - new_set)
+
+
+def _try_patch(url, old_text, timeout):
+    """ListUpdate aplicando el parche de Diff-Path, o None si no se pudo."""
+    path = diff_path(old_text)
+    if not path:
+        return None
+    patch_url, name = urldefrag(urljoin(url, path))
+    try:
+        code, _, body = _fetch(patch_url, timeout=timeout)
+    except Exception as e:
+        print("[AdBlock] No se pudo descargar el parche:", e)
+        return None
+    if code == 404:
+        # Todavía no hay parche nuevo: la copia local es la última versión
+        return ListUpdate("not-modified", [], [], None)
+    try:
+        diff_lines, fields = _select_diff(body, name or None)
+        old_lines = old_text.split("\n")
+        new_lines, added, removed = apply_rcs_diff(old_lines, diff_lines)
+    except PatchError as e:
+        print("[AdBlock] Parche no aplicable, se descarga la lista completa:", e)
+        return None
+    new_text = "\n".join(new_lines)
+    checksum = fields.get("checksum")
+    if checksum and not _checksum_ok(new_text, checksum):
+        print("[AdBlock] La suma del parche no cuadra, se descarga la lista completa.")
+        return None
+    return ListUpdate("patched", added, removed, new_text)
+
+
+def update_list(url, list_path, state_path, timeout=20):
+    """
+    Pone al día la copia local de la lista. Escribe la lista nueva (de forma
+    atómica) y el estado, y devuelve un ListUpdate con los cambios.
+    """
+    state = load_state(state_path)
+    try:
+        with open(list_path, encoding="utf-8", errors="ignore", newline="") as f:
+            old_text = f.read()
+    except OSError:
+        old_text = None
+    if state.get("url") != url:
+        # Otra lista: no valen ni el ETag ni los parches de la anterior
+        state = {"url": url}
+
+    result = None
+    full_age = time.time() - state.get("full_checked", 0)
+    if old_text is not None and full_age < FULL_CHECK_INTERVAL:
+        result = _try_patch(url, old_text, timeout)
+
+    if result is None:
+        headers = {}
+        if old_text is not None:
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+        try:
+            code, resp_headers, body = _fetch(url, headers, timeout)
+        except Exception as e:
+            print("[AdBlock] Error descargando la lista:", e)
+            return ListUpdate("error", None, None, None)
+        state["full_checked"] = time.time()
+        if code == 304 and old_text is not None:
+            result = ListUpdate("not-modified", [], [], None)
+        elif code == 200 and body:
+            state["etag"] = resp_headers.get("ETag")
+            state["last_modified"] = resp_headers.get("Last-Modified")
+            if old_text is None:
+                result = ListUpdate("downloaded", None, None, body)
+            else:
+                added, removed = line_changes(old_text, body)
+                result = ListUpdate("downloaded", added, removed, body)
+        else:
+            print(f"[AdBlock] Respuesta inesperada ({code}) al descargar la lista.")
+            return ListUpdate("error", None, None, None)
+
+    if result.text is not None:
+        write_atomic(list_path, result.text)
+    state["checked"] = time.time()
+    try:
+        save_state(state_path, state)
+    except OSError as e:
+        print("[AdBlock] No se pudo guardar el estado de la lista:", e)
+    return result
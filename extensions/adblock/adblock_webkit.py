@@ -0,0 +1,395 @@
+# adblock_webkit.py
+"""
+Backend nativo: traduce el índice de filtros al formato de "content rules"
+de WebKit (el JSON de los content blockers) y lo compila una vez con
+WebKit2.UserContentFilterStore. El filtro compilado se guarda en disco y se
+añade al UserContentManager de cada pestaña, así que el bloqueo ocurre
+dentro del proceso web sin pasar por Python.
+
+Lo que el formato no puede expresar (regex con '|' o '{n}', $domain= con
+inclusiones y exclusiones a la vez, $genericblock, $webrtc...) se queda en
+un RuleIndex de respaldo que siguen consultando los manejadores de señales
+del plugin. Ese índice lleva además todas las excepciones, para que un
+filtro de respaldo nunca bloquee algo que la lista permite.
+
+Orden de las reglas (WebKit las aplica en orden y 'ignore-previous-rules'
+anula las anteriores): bloqueos, excepciones y $important; después se
+anula todo lo que afecte al marco principal y se repite la secuencia solo
+con los filtros $document (en ABP son los únicos que bloquean la navegación
+principal); por último las excepciones $document de página.
+
+Las reglas cosméticas (## / #@#) van aparte, como hojas de estilo de
+usuario (CosmeticStyles): una genérica común a todos los sitios y otra con
+lo propio de cada sitio, cacheada por eTLD+1.
+
+La traducción no depende de gi; la parte de WebKit (ContentFilterStore,
+CosmeticStyles.sheets) sí.
+"""
+import hashlib
+import json
+import re
+from collections import OrderedDict
+
+from adblock_engine import (
+    RuleIndex, host_filter,
+    TYPE_OTHER, TYPE_SCRIPT, TYPE_IMAGE, TYPE_STYLESHEET, TYPE_OBJECT, TYPE_XHR,
+    TYPE_SUBDOCUMENT, TYPE_PING, TYPE_MEDIA, TYPE_FONT, TYPE_WEBSOCKET, TYPE_WEBRTC,
+    TYPE_DOCUMENT, TYPE_POPUP, FIRST_PARTY, THIRD_PARTY, FLAG_MATCH_CASE, PAGE_DOCUMENT,
+    PAGE_GENERICBLOCK, KIND_HOST, KIND_HOST_REST, KIND_PLAIN, KIND_PATTERN, KIND_REGEX,
+)
+
+# Cambia si cambia la traducción: invalida los filtros ya compilados
+TRANSLATOR_VERSION = 1
+
+# Tipos de WebKit y los bits ABP que cubren. 'document' se trata aparte
+# (documento y subdocumento son el mismo tipo para WebKit).
+_WK_TYPES = (
+    ("script", TYPE_SCRIPT),
+    ("image", TYPE_IMAGE),
+    ("style-sheet", TYPE_STYLESHEET),
+    ("font", TYPE_FONT),
+    ("media", TYPE_MEDIA),
+    ("popup", TYPE_POPUP),
+    ("raw", TYPE_XHR | TYPE_WEBSOCKET | TYPE_PING | TYPE_OTHER | TYPE_OBJECT),
+)
+_EXPRESSIBLE_TYPES = TYPE_DOCUMENT | TYPE_SUBDOCUMENT
+for _name, _bits in _WK_TYPES:
+    _EXPRESSIBLE_TYPES |= _bits
+
+# WebKit solo acepta '^' al principio, '$' al final y sin alternativas ni
+# cuantificadores con llaves
+_URL_SPECIAL = set(".*+?()[]{}\\$|^")
+_SEPARATOR_CLASS = "[^a-zA-Z0-9_.%-]"
+_HOST_PREFIX = r"^[^:]+:(//)?([^/]+\.)?"
+_REGEX_UNSUPPORTED = re.compile(r"\||\{|\(\?|\\[dDwWsSbB0-9]")
+
+
+def _escape(text):
+    """Escapa un literal para url-filter; None si no es ASCII."""
+    if not text.isascii():
+        return None
+    return ''.join('\\' + ch if ch in _URL_SPECIAL else ch for ch in text)
+
+
+def _pattern_url_filter(pattern):
+    """Traduce un patrón ABP con comodines/anclas a url-filter, o None."""
+    out, start = [], ''
+    if pattern.startswith('||'):
+        return None   # ||*.algo y similares: no hay forma segura
+    if pattern.startswith('|'):
+        start, pattern = '^', pattern[1:]
+    end = ''
+    if pattern.endswith('|'):
+        end, pattern = '$', pattern[:-1]
+    for i, ch in enumerate(pattern):
+        if ch == '*':
+            out.append('.*')
+        elif ch == '^':
+            if i == len(pattern) - 1 and not end:
+                # '^' final también coincide con el final de la URL
+                out.append(f"({_SEPARATOR_CLASS}.*)?$")
+            else:
+                out.append(_SEPARATOR_CLASS)
+        else:
+            escaped = _escape(ch)
+            if escaped is None:
+                return None
+            out.append(escaped)
+    return start + ''.join(out) + end
+
+
+def _host_url_filter(host, rest):
+    escaped = _escape(host)
+    if escaped is None:
+        return None
+    prefix = _HOST_PREFIX + escaped
+    if rest is None:
+        return prefix + "[/:]"
+    tail = _pattern_url_filter(rest)
+    return None if tail is None else prefix + tail
+
+
+def _regex_url_filter(body):
+    if not body.isascii() or _REGEX_UNSUPPORTED.search(body):
+        return None
+    # '^' solo al principio (o negando una clase) y '$' solo al final
+    for i, ch in enumerate(body):
+        escaped = i > 0 and body[i - 1] == '\\'
+        if ch == '^' and i > 0 and not escaped and body[i - 1] != '[':
+            return None
+        if ch == '$' and i < len(body) - 1 and not escaped:
+            return None
+    return body
+
+
+def url_filter(f):
+    """url-filter de WebKit equivalente al patrón del filtro, o None."""
+    if f.kind == KIND_HOST:
+        return _host_url_filter(f.host, None)
+    if f.kind == KIND_HOST_REST:
+        return _host_url_filter(f.host, f.pattern)
+    if f.kind == KIND_PLAIN:
+        # Sin patrón (p.ej. '$script,domain=x'): vale cualquier URL
+        return _escape(f.pattern) or ".*"
+    if f.kind == KIND_PATTERN:
+        return _pattern_url_filter(f.pattern)
+    if f.kind == KIND_REGEX:
+        return _regex_url_filter(f.pattern)
+    return None
+
+
+def _domains(domains):
+    out = []
+    for d in sorted(domains):
+        if not d.isascii() or d.endswith('.*'):
+            return None
+        out.append('*' + d)
+    return out
+
+
+def trigger(f):
+    """
+    'trigger' de WebKit equivalente al filtro, o None si no se puede
+    expresar. Subdocumentos y documentos van los dos como 'document': el
+    marco principal se descarta después con _TOP_FRAME_RESET.
+    """
+    # WebRTC no pasa por el cargador de WebKit: no hay nada que bloquear ahí
+    types = f.types & ~TYPE_WEBRTC
+    if not types or types & ~_EXPRESSIBLE_TYPES or f.flags & PAGE_GENERICBLOCK:
+        return None
+    if f.include is not None and f.exclude is not None:
+        return None
+    pattern = url_filter(f)
+    if pattern is None:
+        return None
+    result = {"url-filter": pattern}
+    if f.flags & FLAG_MATCH_CASE:
+        result["url-filter-is-case-sensitive"] = True
+    resource_types = [name for name, bits in _WK_TYPES if types & bits]
+    if types & (TYPE_DOCUMENT | TYPE_SUBDOCUMENT):
+        resource_types.append("document")
+    result["resource-type"] = resource_types
+    if f.party == THIRD_PARTY:
+        result["load-type"] = ["third-party"]
+    elif f.party == FIRST_PARTY:
+        result["load-type"] = ["first-party"]
+    if f.include is not None or f.exclude is not None:
+        domains = _domains(f.include if f.include is not None else f.exclude)
+        if domains is None:
+            return None
+        result["if-domain" if f.include is not None else "unless-domain"] = domains
+    return result
+
+
+# Deshace los bloqueos anteriores de la navegación principal: en ABP un
+# filtro solo se aplica al documento principal si lleva $document
+_TOP_FRAME_RESET = {
+    "trigger": {"url-filter": ".*", "resource-type": ["document"], "load-context": ["top-frame"]},
+    "action": {"type": "ignore-previous-rules"},
+}
+
+
+def _rule(action, t):
+    return {"trigger": t, "action": {"type": action}}
+
+
+def _top_frame(t):
+    return dict(t, **{"resource-type": ["document"], "load-context": ["top-frame"]})
+
+
+def _translate_blocks(filter_index, fallback_index, stats):
+    """(reglas, reglas $document para el marco principal) de un FilterIndex de bloqueo."""
+    rules, documents = [], []
+    for f, _, _ in filter_index.filters():
+        t = trigger(f)
+        if t is None:
+            fallback_index.add(f)
+            stats["fallback"] += 1
+            continue
+        rules.append(_rule("block", t))
+        if f.types & TYPE_DOCUMENT:
+            documents.append(_rule("block", _top_frame(t)))
+        stats["native"] += 1
+    return rules, documents
+
+
+def content_rules(index):
+    """
+    Traduce un RuleIndex. Devuelve (reglas para WebKit, RuleIndex de
+    respaldo, contadores {'native', 'fallback', 'unsafe_exceptions'}).
+    """
+    fallback = RuleIndex()
+    fallback.badfilters = set(index.badfilters)
+    stats = {"native": 0, "fallback": 0, "unsafe_exceptions": 0}
+
+    host_rule = trigger(host_filter("example.com"))
+    host_prefix = host_rule["url-filter"][:-len(_escape("example.com") + "[/:]")]
+    blocks = []
+    for host in sorted(index.blocks.pure_hosts()):
+        escaped = _escape(host)
+        if escaped is None:
+            fallback.blocks.add(host_filter(host), pure_hosts=True)
+            stats["fallback"] += 1
+            continue
+        blocks.append(_rule("block", dict(host_rule, **{"url-filter": host_prefix + escaped + "[/:]"})))
+        stats["native"] += 1
+    rules, block_documents = _translate_blocks(index.blocks, fallback.blocks, stats)
+    blocks += rules
+    important, important_documents = _translate_blocks(index.important, fallback.important, stats)
+
+    # Las excepciones van siempre también al respaldo
+    exceptions, exception_documents = [], []
+    for f, _, _ in index.exceptions.filters():
+        fallback.exceptions.add(f)
+        t = trigger(f)
+        if t is None:
+            stats["unsafe_exceptions"] += 1
+            continue
+        exceptions.append(_rule("ignore-previous-rules", t))
+        if f.types & TYPE_DOCUMENT:
+            exception_documents.append(_rule("ignore-previous-rules", _top_frame(t)))
+    documents = []
+    for f, _, _ in index.page_exceptions.filters():
+        fallback.page_exceptions.add(f)
+        if not f.flags & PAGE_DOCUMENT:
+            continue   # elemhide/generichide: solo afectan a las cosméticas
+        # La excepción vale para todo lo que carga una página de ese host
+        domains = _domains((f.host,)) if f.kind == KIND_HOST else None
+        if domains is None or f.include is not None or f.exclude is not None:
+            stats["unsafe_exceptions"] += 1
+            continue
+        documents.append(_rule("ignore-previous-rules", {"url-filter": ".*", "if-domain": domains}))
+
+    # Tras el reinicio del marco principal se repite la misma secuencia solo
+    # con lo que lleva $document
+    return (blocks + exceptions + important + [_TOP_FRAME_RESET]
+            + block_documents + exception_documents + important_documents + documents,
+            fallback, stats)
+
+
+def filter_identifier(list_digest):
+    """Identificador del filtro compilado para una versión de la lista."""
+    h = hashlib.sha256(list_digest + bytes([TRANSLATOR_VERSION])).hexdigest()
+    return f"easylist-{h[:16]}"
+
+
+def rules_json(rules):
+    return json.dumps(rules, separators=(",", ":")).encode("utf-8")
+
+
+class ContentFilterStore:
+    """
+    Filtros compilados en disco (WebKit2.UserContentFilterStore). Todas las
+    llamadas deben hacerse desde el hilo principal de GTK.
+    """
+
+    def __init__(self, path):
+        from gi.repository import WebKit2
+        self.store = WebKit2.UserContentFilterStore.new(str(path))
+
+    def load_or_compile(self, identifier, json_bytes, callback):
+        """
+        Llama a callback(filtro) con el filtro 'identifier'; si no estaba
+        compilado lo compila desde json_bytes. callback(None) si falla.
+        """
+        from gi.repository import GLib
+
+        def on_saved(store, result):
+            try:
+                flt = store.save_finish(result)
+            except GLib.Error as e:
+                print("[AdBlock] WebKit no pudo compilar las reglas:", e.message)
+                flt = None
+            else:
+                self._remove_others(identifier)
+            callback(flt)
+
+        def on_loaded(store, result):
+            try:
+                flt = store.load_finish(result)
+            except GLib.Error:
+                print("[AdBlock] Compilando reglas nativas de WebKit...")
+                store.save(identifier, GLib.Bytes.new(json_bytes), None, on_saved)
+                return
+            callback(flt)
+
+        self.store.load(identifier, None, on_loaded)
+
+    def _remove_others(self, keep):
+        """Borra del disco los filtros de versiones anteriores de la lista."""
+        def on_identifiers(store, result):
+            try:
+                identifiers = store.fetch_identifiers_finish(result) or []
+            except Exception:
+                return
+            for identifier in identifiers:
+                if identifier != keep and identifier.startswith("easylist-"):
+                    store.remove(identifier, None, None)
+        self.store.fetch_identifiers(None, on_identifiers)
+
+
+# Se declara por selector: un selector que WebKit no entienda invalida solo
+# su regla, no el grupo entero
+HIDE_DECLARATION = " { display: none !important; }\n"
+
+
+def hiding_css(selectors):
+    """Hoja de estilo que oculta los elementos de los selectores."""
+    return ''.join(sel + HIDE_DECLARATION for sel in selectors)
+
+
+class CosmeticStyles:
+    """
+    Hojas de ocultación de un índice: la genérica común (se construye una
+    vez) y, por clave de sitio (RuleIndex.cosmetic_site_key: eTLD+1 salvo
+    subdominios con reglas propias), la del sitio. Un índice nuevo lleva su
+    propio CosmeticStyles, así que nunca se mezclan hojas de dos listas.
+    """
+
+    def __init__(self, index, capacity=64):
+        self.index = index
+        self.capacity = capacity
+        self._shared_css = None
+        self._shared_sheet = None
+        self._sites = OrderedDict()   # clave -> (hoja genérica o None, hoja del sitio o None)
+
+    def shared_css(self):
+        """CSS de los genéricos comunes; puede llamarse fuera del hilo de GTK."""
+        if self._shared_css is None:
+            self._shared_css = hiding_css(self.index.cosmetic.shared_generic())
+        return self._shared_css
+
+    def key(self, page_url):
+        return self.index.cosmetic_site_key(page_url)
+
+    def sheets(self, page_url, key=None):
+        """
+        WebKit2.UserStyleSheet para la página (hilo de GTK). La genérica va
+        a todos los marcos; la del sitio solo al principal, porque sus
+        dominios son los de la página y no los de los iframes.
+        """
+        from gi.repository import WebKit2
+        if key is None:
+            key = self.key(page_url)
+        cached = self._sites.get(key)
+        if cached is not None:
+            self._sites.move_to_end(key)
+            return [sheet for sheet in cached if sheet is not None]
+
+        def new_sheet(css, frames):
+            return WebKit2.UserStyleSheet.new(css, frames, WebKit2.UserStyleLevel.USER, None, None)
+
+        generic, site = self.index.cosmetic_site_selectors(page_url)
+        if generic is True:
+            if self._shared_sheet is None:
+                self._shared_sheet = new_sheet(self.shared_css(), WebKit2.UserContentInjectedFrames.ALL_FRAMES)
+            generic_sheet = self._shared_sheet
+        elif generic:
+            generic_sheet = new_sheet(hiding_css(generic), WebKit2.UserContentInjectedFrames.ALL_FRAMES)
+        else:
+            generic_sheet = None
+        site_sheet = new_sheet(hiding_css(site), WebKit2.UserContentInjectedFrames.TOP_FRAME) if site else None
+        self._sites[key] = (generic_sheet, site_sheet)
+        if len(self._sites) > self.capacity:
+            self._sites.popitem(last=False)
+        return [sheet for sheet in (generic_sheet, site_sheet) if sheet is not None]
@@ -0,0 +1,401 @@
+# bench.py
+"""
+Clasificación de URLs por lotes y banco de pruebas del motor de AdBlock.
+
+Carga la lista (easylist_cached.txt por defecto), clasifica un archivo de
+URLs y mide tiempo de parseo, memoria del conjunto de reglas, rendimiento
+(URLs/s) y latencia por URL (p50/p99). Con varios --engine compara los
+motores sobre la misma entrada y cuenta los veredictos distintos.
+
+Entrada:
+    - texto: una petición por línea, 'url [tipo [página]]' ('#' = comentario)
+    - HAR (.har o JSON con log.entries): URL, tipo (_resourceType) y página
+
+Motores:
+    cached   el de matches_block(): RuleIndex con las caches de decisiones
+    index    RuleIndex sin caches
+    legacy   referencia lineal: el parser y la búsqueda regex a regex originales
+    ruta.py:funcion   cualquier otro; funcion(ruta_lista) devuelve
+                      match(url, tipo, pagina) -> bool
+
+Ejemplos:
+    python3 bench.py urls.txt
+    python3 bench.py sesion.har --engine cached --engine legacy --diff 20
+    python3 bench.py urls.txt --repeat 5 --json
+    python3 bench.py --conformance
+    python3 bench.py --budget
+    python3 bench.py --scaling --repeat 3
+
+Presupuesto de memoria (--budget): con la lista completa y el motor por
+defecto, el conjunto de reglas vivo no debe pasar de RULES_BUDGET_MB ni lo
+que crece el RSS máximo del proceso al cargarla de RSS_BUDGET_MB (se resta
+lo que ya ocupaba el intérprete, que depende de la máquina). Si se pasa,
+sale con código 2.
+
+Escalado (--scaling): parsea la lista con parse_parallel() con 1, 2, 4...
+procesos hasta el número de núcleos, comprueba que el índice sea idéntico
+al del parseo en serie y da el tiempo y la aceleración de cada uno.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import pathlib
+import re
+import resource
+import sys
+import time
+import tracemalloc
+
+_EXT_DIR = pathlib.Path(__file__).resolve().parent
+if str(_EXT_DIR) not in sys.path:
+    sys.path.insert(0, str(_EXT_DIR))
+import adblock_cache
+from adblock_engine import RuleIndex, CachedMatcher, INDEX_VERSION, run_conformance, parse_parallel
+
+DEFAULT_LIST = _EXT_DIR / "easylist_cached.txt"
+
+# Presupuesto de memoria con EasyList completa (unas 80.000 líneas)
+RULES_BUDGET_MB = 10
+# Crecimiento del RSS máximo al cargarla: medido 26,4 MB (python3 bench.py
+# --budget, 3 veces, CPython 3 en Linux x86-64); el resto es margen
+RSS_BUDGET_MB = 32
+
+# _resourceType de los HAR de Chrome/WebKit -> tipos ABP
+_HAR_TYPES = {
+    "document": "document", "script": "script", "stylesheet": "stylesheet",
+    "image": "image", "media": "media", "font": "font", "xhr": "xmlhttprequest",
+    "fetch": "xmlhttprequest", "websocket": "websocket", "ping": "ping",
+    "beacon": "ping", "texttrack": "media", "manifest": "other", "other": "other",
+}
+
+
+# --- Entrada ---
+
+def read_requests(path):
+    """Lista de (url, tipo o None, página o None) de un archivo de texto o HAR."""
+    text = pathlib.Path(path).read_text(encoding="utf-8", errors="ignore")
+    if path.endswith(".har") or text.lstrip().startswith("{"):
+        return _read_har(json.loads(text))
+    requests = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        url, rtype, page = (line.split() + ['-', '-'])[:3]
+        requests.append((url, None if rtype == '-' else rtype, None if page == '-' else page))
+    return requests
+
+
+def _read_har(har):
+    log = har.get("log", {})
+    pages = {p.get("id"): p.get("title") for p in log.get("pages", [])}
+    requests, first_document = [], None
+    for entry in log.get("entries", []):
+        url = entry.get("request", {}).get("url")
+        if not url or not url.startswith(("http:", "https:", "ws:", "wss:")):
+            continue
+        rtype = _HAR_TYPES.get(str(entry.get("_resourceType", "")).lower())
+        if rtype == "document" and first_document is None:
+            first_document = url
+        page = pages.get(entry.get("pageref"))
+        if not page or "://" not in page:
+            page = first_document
+        requests.append((url, rtype, None if rtype == "document" else page))
+    return requests
+
+
+# --- Motores ---
+
+class LegacyEngine:
+    """
+    Referencia lineal: reproduce el parser y la búsqueda originales del
+    plugin (una regex por regla, probadas una a una).
+    """
+
+    def __init__(self, list_path):
+        self.rules, self.whitelist = [], []
+        text = pathlib.Path(list_path).read_text(encoding="utf-8", errors="ignore")
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith('!'):
+                continue
+            if line.startswith('@@'):
+                m = re.search(r'\|\|([^\^/]+)', line[2:].strip())
+                if m:
+                    self.whitelist.append(re.compile(re.escape(m.group(1))))
+                continue
+            m = re.match(r'\|\|([^\^/]+)', line)
+            if m:
+                self.rules.append(re.compile(r'(^|\.)' + re.escape(m.group(1)), re.IGNORECASE))
+                continue
+            if '/' in line or '*' in line:
+                token = re.sub(r'[\*\^]+', '', line).strip()
+                if len(token) >= 3 and not token.startswith('@'):
+                    self.rules.append(re.compile(re.escape(token), re.IGNORECASE))
+                continue
+            if re.match(r'^[\w\.\-]{3,}$', line):
+                self.rules.append(re.compile(re.escape(line), re.IGNORECASE))
+
+    def match(self, url, resource_type=None, source_url=None):
+        if not url:
+            return False
+        # Como el original: todo sobre la URL en minúsculas, también la lista blanca
+        lower = url.lower()
+        if any(w.search(lower) for w in self.whitelist):
+            return False
+        return any(r.search(lower) for r in self.rules)
+
+
+def _load_index(list_path):
+    return RuleIndex().add_lines(
+        pathlib.Path(list_path).read_text(encoding="utf-8", errors="ignore").splitlines())
+
+
+def _custom_engine(spec):
+    path, _, func = spec.rpartition(':')
+    module_spec = importlib.util.spec_from_file_location(pathlib.Path(path).stem, path)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return getattr(module, func)
+
+
+def build_engine(name, list_path):
+    """Función match(url, tipo, página) del motor 'name'."""
+    if name == "cached":
+        return CachedMatcher(_load_index(list_path)).match
+    if name == "index":
+        return _load_index(list_path).match
+    if name == "legacy":
+        return LegacyEngine(list_path).match
+    if ':' in name:
+        return _custom_engine(name)(str(list_path))
+    raise SystemExit(f"Motor desconocido: {name}")
+
+
+# --- Medidas ---
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    pos = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[pos]
+
+
+def measure_build(name, list_path, memory=True):
+    """(match, segundos de parseo, bytes que ocupa el motor o None)."""
+    start = time.perf_counter()
+    match = build_engine(name, list_path)
+    parse_s = time.perf_counter() - start
+    rules_bytes = None
+    if memory:
+        # Segunda carga bajo tracemalloc: lo que queda vivo es el conjunto de reglas
+        del match
+        tracemalloc.start()
+        match = build_engine(name, list_path)
+        rules_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return match, parse_s, rules_bytes
+
+
+def classify(match, requests, repeat=1):
+    """(veredictos de la primera pasada, latencias en ns de todas, segundos totales)."""
+    verdicts, latencies = [], []
+    clock = time.perf_counter_ns
+    total_start = time.perf_counter()
+    for i in range(repeat):
+        for url, rtype, page in requests:
+            start = clock()
+            blocked = match(url, rtype, page)
+            latencies.append(clock() - start)
+            if i == 0:
+                verdicts.append(bool(blocked))
+    return verdicts, latencies, time.perf_counter() - total_start
+
+
+def cache_load_time(list_path):
+    """
+    Segundos en cargar el índice precompilado que el plugin dejó junto a la
+    lista (INDEX_NAME), o None si no existe o no corresponde a SOURCES_NAME.
+    """
+    ext_dir = pathlib.Path(list_path).resolve().parent
+    start = time.perf_counter()
+    tables = adblock_cache.load_tables(ext_dir / adblock_cache.INDEX_NAME,
+                                       ext_dir / adblock_cache.SOURCES_NAME, INDEX_VERSION)
+    if tables is None:
+        return None
+    RuleIndex.from_tables(tables)
+    return time.perf_counter() - start
+
+
+def run_engine(name, list_path, requests, repeat=1, memory=True):
+    match, parse_s, rules_bytes = measure_build(name, list_path, memory)
+    verdicts, latencies, total_s = classify(match, requests, repeat)
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "engine": name,
+        "parse_s": parse_s,
+        "rules_bytes": rules_bytes,
+        "requests": len(requests),
+        "blocked": sum(verdicts),
+        "urls_per_s": n / total_s if total_s else 0.0,
+        "p50_us": _percentile(latencies, 0.50) / 1000,
+        "p99_us": _percentile(latencies, 0.99) / 1000,
+        "max_us": (latencies[-1] / 1000) if n else 0.0,
+        "verdicts": verdicts,
+    }
+
+
+def check_budget(list_path, rules_mb=RULES_BUDGET_MB, rss_mb=RSS_BUDGET_MB):
+    """
+    Carga la lista con el motor por defecto y compara su memoria con el
+    presupuesto. Devuelve (bytes de reglas, crecimiento del RSS máximo,
+    dentro del presupuesto).
+    """
+    # El RSS se mide sin tracemalloc, que lo infla por su cuenta
+    baseline = _max_rss_bytes()
+    match = build_engine("cached", list_path)
+    rss_bytes = _max_rss_bytes() - baseline
+    del match
+    tracemalloc.start()
+    match = build_engine("cached", list_path)
+    rules_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del match
+    ok = rules_bytes <= rules_mb * 1024 * 1024 and rss_bytes <= rss_mb * 1024 * 1024
+    return rules_bytes, rss_bytes, ok
+
+
+def _same_tables(a, b):
+    return a.keys() == b.keys() and all(list(a[k]) == list(b[k]) for k in a)
+
+
+def scaling(list_path, max_workers=None, repeat=1):
+    """
+    [(procesos, segundos, idéntico al serie)] parseando la lista con
+    parse_parallel(); se toma el mejor de 'repeat' intentos.
+    """
+    lines = pathlib.Path(list_path).read_text(encoding="utf-8", errors="ignore").splitlines()
+    max_workers = max_workers or os.cpu_count() or 1
+    counts = sorted({1, max_workers} | {n for n in (2, 4, 8, 16, 32, 64) if n < max_workers})
+    serial_tables = None
+    results = []
+    for workers in counts:
+        best, index = None, None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            index = parse_parallel(lines, workers, min_lines=0)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        tables = index.export_tables()
+        if serial_tables is None:
+            serial_tables = tables
+        results.append((workers, best, _same_tables(serial_tables, tables)))
+    return results
+
+
+def _max_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _mb(n):
+    return "-" if n is None else f"{n / (1024 * 1024):.1f} MB"
+
+
+def print_report(results, requests, diff_limit, idx_load_s):
+    for r in results:
+        print(f"== {r['engine']}")
+        print(f"   parseo            {r['parse_s'] * 1000:.0f} ms")
+        print(f"   reglas en memoria {_mb(r['rules_bytes'])}")
+        print(f"   bloqueadas        {r['blocked']}/{r['requests']}")
+        print(f"   rendimiento       {r['urls_per_s']:.0f} URLs/s")
+        print(f"   latencia          p50 {r['p50_us']:.1f} µs  p99 {r['p99_us']:.1f} µs  "
+              f"máx {r['max_us']:.1f} µs")
+    if idx_load_s is not None:
+        print(f"Índice precompilado: {idx_load_s * 1000:.0f} ms")
+    print(f"RSS máximo del proceso: {_mb(_max_rss_bytes())}")
+    base = results[0]
+    for other in results[1:]:
+        diffs = [i for i, (a, b) in enumerate(zip(base["verdicts"], other["verdicts"])) if a != b]
+        print(f"Diferencias {base['engine']} vs {other['engine']}: {len(diffs)}")
+        for i in diffs[:diff_limit]:
+            url, rtype, page = requests[i]
+            a = "block" if base["verdicts"][i] else "allow"
+            b = "block" if other["verdicts"][i] else "allow"
+            print(f"   {a:5} {b:5} {url} {rtype or '-'} {page or '-'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clasifica URLs y mide el motor de AdBlock.")
+    parser.add_argument("input", nargs="?", help="archivo de URLs o HAR")
+    parser.add_argument("--list", default=str(DEFAULT_LIST), help="lista de filtros")
+    parser.add_argument("--engine", action="append",
+                        help="cached, index, legacy o ruta.py:funcion (repetible)")
+    parser.add_argument("--repeat", type=int, default=1, help="pasadas sobre la entrada")
+    parser.add_argument("--diff", type=int, default=10, help="diferencias a mostrar")
+    parser.add_argument("--verdicts", help="escribe 'block|allow url' del primer motor")
+    parser.add_argument("--no-memory", action="store_true", help="no mide la memoria de las reglas")
+    parser.add_argument("--json", action="store_true", help="informe en JSON")
+    parser.add_argument("--conformance", nargs="?", const=str(_EXT_DIR / "conformance.txt"),
+                        help="comprueba el corpus de conformidad y sale")
+    parser.add_argument("--budget", action="store_true",
+                        help="comprueba el presupuesto de memoria y sale")
+    parser.add_argument("--max-rules-mb", type=float, default=RULES_BUDGET_MB,
+                        help="presupuesto del conjunto de reglas (MB)")
+    parser.add_argument("--max-rss-mb", type=float, default=RSS_BUDGET_MB,
+                        help="presupuesto del crecimiento del RSS máximo al cargar la lista (MB)")
+    parser.add_argument("--scaling", action="store_true",
+                        help="mide el parseo en paralelo por número de procesos y sale")
+    parser.add_argument("--workers", type=int, help="procesos máximos para --scaling (por defecto, núcleos)")
+    args = parser.parse_args(argv)
+
+    if args.conformance:
+        total, failures = run_conformance(args.conformance)
+        for line, expected, got in failures:
+            print(f"FALLO: esperado {expected}, obtenido {got}: {line}")
+        print(f"{total - len(failures)}/{total} casos correctos")
+        return 1 if failures else 0
+    if args.budget:
+        rules_bytes, rss_bytes, ok = check_budget(args.list, args.max_rules_mb, args.max_rss_mb)
+        print(f"Reglas en memoria {_mb(rules_bytes)} (presupuesto {args.max_rules_mb:g} MB)")
+        print(f"Crecimiento RSS   {_mb(rss_bytes)} (presupuesto {args.max_rss_mb:g} MB)")
+        print("Dentro del presupuesto" if ok else "Presupuesto de memoria superado")
+        return 0 if ok else 2
+    if args.scaling:
+        results = scaling(args.list, args.workers, args.repeat)
+        base = results[0][1]
+        print(f"Núcleos: {os.cpu_count()}")
+        print("procesos  tiempo     aceleración  idéntico")
+        for workers, elapsed, same in results:
+            print(f"{workers:8}  {elapsed * 1000:6.0f} ms  {base / elapsed:10.2f}x  {'sí' if same else 'NO'}")
+        return 0 if all(same for _, _, same in results) else 1
+    if not args.input:
+        parser.error("falta el archivo de entrada")
+
+    requests = read_requests(args.input)
+    engines = args.engine or ["cached"]
+    results = [run_engine(name, args.list, requests, args.repeat, not args.no_memory)
+               for name in engines]
+    idx_load_s = cache_load_time(args.list)
+
+    if args.verdicts:
+        with open(args.verdicts, "w", encoding="utf-8") as f:
+            for (url, _, _), blocked in zip(requests, results[0]["verdicts"]):
+                f.write(f"{'block' if blocked else 'allow'}\t{url}\n")
+    if args.json:
+        report = {"results": [{k: v for k, v in r.items() if k != "verdicts"} for r in results],
+                  "index_load_s": idx_load_s, "max_rss_bytes": _max_rss_bytes()}
+        if len(results) > 1:
+            base = results[0]["verdicts"]
+            report["differences"] = {r["engine"]: sum(a != b for a, b in zip(base, r["verdicts"]))
+                                     for r in results[1:]}
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(results, requests, args.diff, idx_load_s)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
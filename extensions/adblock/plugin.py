@@ -1,196 +1,513 @@
 # plugin.py
-import os
-import re
 import time
 import threading
 import pathlib
 import json
+import sys
+from collections import Counter
+from itertools import count
 
+# El motor vive junto al plugin; el ExtensionManager carga este archivo por ruta
+_EXT_DIR = pathlib.Path(__file__).resolve().parent
+if str(_EXT_DIR) not in sys.path:
+    sys.path.insert(0, str(_EXT_DIR))
+from adblock_engine import RuleIndex, CachedMatcher, CacheStats, INDEX_VERSION, parse_parallel
+import adblock_cache
+import adblock_lists
+import adblock_stats
+import adblock_webkit
+
+# Suscripción por defecto si el manifest no declara ninguna (ver adblock_lists)
 EASYLIST_URL = "https://easylist.to/easylist/easylist.txt"
 CACHE_NAME = "easylist_cached.txt"
-CACHE_TTL = 60 * 60 * 24   # 24 horas
+INDEX_NAME = adblock_cache.INDEX_NAME
+SOURCES_NAME = adblock_cache.SOURCES_NAME
+# Por encima de esta fracción de líneas cambiadas sale más a cuenta reparsear
+MAX_INCREMENTAL_RATIO = 0.25
+FILTER_STORE_NAME = "content_filters"   # filtros compilados por WebKit (ver adblock_webkit)
+
+URL_CACHE_SIZE = 4096    # decisiones por URL
+HOST_CACHE_SIZE = 1024   # decisiones de reglas ||dominio por host
+
+# Contadores de las caches de decisiones, acumulados entre recargas
+url_cache_stats = CacheStats()
+host_cache_stats = CacheStats()
+
+def _new_matcher(index):
+    return CachedMatcher(index, URL_CACHE_SIZE, HOST_CACHE_SIZE, url_cache_stats, host_cache_stats)
+
+# Reglas indexadas y sus caches (se reemplaza entero al recargar, nunca se modifica en sitio)
+rule_index = RuleIndex()
+matcher = _new_matcher(rule_index)
+rules_loaded = False
+# Evita dos actualizaciones a la vez (arranque, recarga y cambios de listas desde la UI)
+_update_lock = threading.Lock()
+
+# Listas suscritas (las fija setup()) y peticiones bloqueadas por texto de
+# regla, para repartirlas entre las listas en list_stats()
+subscriptions = []
+rule_hits = Counter()
+
+# Tiempos y contadores por petición de los manejadores (desactivados por
+# defecto) y número de pestaña de cada WebView para ellos
+request_stats = adblock_stats.RequestStats()
+tab_ids = {}
+_next_tab_id = count(1)
+
+# Backend nativo: filtro compilado por WebKit y, mientras está puesto, el
+# matcher de Python solo con lo que WebKit no sabe aplicar
+content_store_dir = None   # lo fija setup(); sin él no se usa el backend nativo
+content_store = None
+native_filter = None
+fallback_matcher = None
+native_webviews = []
 
-# Reglas compiladas
-compiled_rules = []
-whitelist_rules = []
+# Hojas de ocultación (reglas ## / #@#) del índice publicado y, por WebView,
+# (CosmeticStyles, clave de sitio, hojas puestas)
+cosmetic_styles = None
+cosmetic_webviews = {}
 
-def download_easylist(dest_path):
-    """Intenta descargar EasyList (usa requests si está, si no urllib)."""
+# WebViews a los que ya se engancharon los manejadores (ver attach_webview)
+attached_webviews = set()
+
+def parse_lists(subs):
+    """
+    Parsea las listas en un único RuleIndex (ver adblock_engine); una línea
+    que está en varias listas se parsea e indexa una sola vez:
+    - Ignora comentarios y filtros con opciones que no soportamos.
+    - "||domain^" -> dominio o subdominio, indexado por etiqueta.
+    - Patrones ABP ('*', '^', '|', /regex/) con sus opciones ($script,
+      $third-party, $domain=, $important...) -> indexados por host o n-gramas.
+    - Excepciones que empiezan con @@ -> índice de whitelist.
+    - Reglas cosméticas (##, #@#) -> índice aparte, no bloquean peticiones.
+    Las listas grandes se parsean en varios procesos (parse_parallel).
+    """
+    return parse_parallel(adblock_lists.union_lines(subs))
+
+def save_rule_index(index, subs, ext_dir):
+    """Guarda el índice compartido ligado a las listas de las que sale."""
+    sources_path = ext_dir / SOURCES_NAME
     try:
-        import requests
-        r = requests.get(EASYLIST_URL, timeout=20)
-        r.raise_for_status()
-        dest_path.write_text(r.text, encoding="utf-8")
-        return True
-    except Exception:
+        adblock_lists.write_sources(sources_path, subs)
+        adblock_cache.save_tables(ext_dir / INDEX_NAME, index.export_tables(), sources_path, INDEX_VERSION)
+    except OSError as e:
+        print("[AdBlock] No se pudo guardar el índice precompilado:", e)
+
+def load_rule_index(subs, ext_dir):
+    """
+    Carga el índice precompilado si corresponde a las listas actuales; si
+    no, las parsea y deja el índice guardado para el próximo arranque.
+    """
+    sources_path = ext_dir / SOURCES_NAME
+    try:
+        adblock_lists.write_sources(sources_path, subs)
+        tables = adblock_cache.load_tables(ext_dir / INDEX_NAME, sources_path, INDEX_VERSION)
+    except OSError:
+        tables = None
+    if tables is not None:
         try:
-            from urllib.request import urlopen
-            with urlopen(EASYLIST_URL, timeout=20) as resp:
-                data = resp.read().decode("utf-8", errors="ignore")
-                dest_path.write_text(data, encoding="utf-8")
-                return True
-        except Exception as e:
-            print("[AdBlock] Error descargando EasyList:", e)
-            return False
+            return RuleIndex.from_tables(tables)
+        except (KeyError, ValueError) as e:
+            print("[AdBlock] Índice precompilado inválido, se regenera:", e)
+    index = parse_lists(subs)
+    save_rule_index(index, subs, ext_dir)
+    return index
 
-def parse_easylist(filepath):
-    """
-    Parsea de forma simple reglas útiles:
-    - Ignora comentarios y reglas complejas.
-    - Captura líneas con "||domain^" -> convierte a regex r'(^|\\.)domain'
-    - Captura líneas que contienen dominos o texto con wildcards.
-    - Ignora excepciones que empiezan con @@ (las guarda en whitelist).
-    """
-    rules = []
-    whitelist = []
-    text = filepath.read_text(encoding="utf-8", errors="ignore")
-    for line in text.splitlines():
-        line = line.strip()
-        if not line or line.startswith('!'):
-            continue
-        if line.startswith('@@'):
-            rule = line[2:].strip()
-            # Simplificar: extraer dominio-like
-            m = re.search(r'\|\|([^\^/]+)', rule)
-            if m:
-                whitelist.append(re.compile(re.escape(m.group(1))))
-            continue
-
-        # domain rule: ||domain^
-        m = re.match(r'\|\|([^\^/]+)', line)
-        if m:
-            domain = re.escape(m.group(1))
-            # regex match subdomain or exact
-            regex = re.compile(r'(^|\.)' + domain, re.IGNORECASE)
-            rules.append(regex)
-            continue
-
-        # simple contains rule (e.g. ads.example.com/ads.js or /adbanner)
-        if '/' in line or '*' in line:
-            # try to create a contains regex for the main token
-            token = re.sub(r'[\*\^]+', '', line)
-            token = token.strip()
-            if len(token) >= 3 and not token.startswith('@'):
-                try:
-                    rules.append(re.compile(re.escape(token), re.IGNORECASE))
-                except Exception:
-                    pass
-            continue
+def publish_index(index, sources_path):
+    """
+    Publica un índice nuevo. Un solo cambio de referencia: reglas y caches
+    nuevas a la vez; las consultas en curso terminan con el índice anterior.
+    Hasta que WebKit tenga compiladas las reglas nuevas, las señales
+    vuelven a comprobar la lista entera en Python.
+    """
+    global rule_index, matcher, rules_loaded, fallback_matcher, cosmetic_styles
+    styles = adblock_webkit.CosmeticStyles(index)
+    styles.shared_css()   # la hoja genérica se construye aquí, fuera del hilo de GTK
+    old_matcher = matcher
+    rule_index = index
+    matcher = _new_matcher(index)
+    fallback_matcher = None
+    rules_loaded = True
+    cosmetic_styles = styles
+    old_matcher.invalidate()
+    print(f"[AdBlock] Cargadas {index.rule_count} reglas, {index.exception_count} excepciones, "
+          f"{index.cosmetic_count} cosméticas.")
+    if content_store_dir is not None:
+        prepare_native_filter(index, sources_path)
+        refresh_cosmetic_styles()
 
-        # fallback: treat as hostname-like
-        if re.match(r'^[\w\.\-]{3,}$', line):
-            try:
-                rules.append(re.compile(re.escape(line), re.IGNORECASE))
-            except Exception:
-                pass
+def apply_changes(changes, enabled, ext_dir, incremental_only=False):
+    """
+    Índice tras cambiar unas listas ('changes': id -> (añadidas, quitadas),
+    ver adblock_lists.effective_changes): se aplican sobre una copia del
+    índice actual solo las líneas que ninguna otra lista activa tiene. Si no
+    se puede (primera carga, $badfilter, demasiados cambios) se parsean
+    todas las listas activas.
+    """
+    index = None
+    if rules_loaded and all(added is not None for added, _ in changes.values()):
+        added, removed = adblock_lists.effective_changes(changes, enabled)
+        total = rule_index.rule_count + rule_index.exception_count + rule_index.cosmetic_count
+        if incremental_only or len(added) + len(removed) <= MAX_INCREMENTAL_RATIO * max(total, 1):
+            index = rule_index.updated(added, removed)
+            if index is not None:
+                print(f"[AdBlock] Actualización incremental: +{len(added)} -{len(removed)} líneas.")
+    if index is None:
+        index = parse_lists(enabled)
+    save_rule_index(index, enabled, ext_dir)
+    return index
 
-    return rules, whitelist
+def _enabled_lists():
+    return [sub for sub in subscriptions if sub.enabled]
 
 def ensure_rules(ext_dir):
-    """Asegura que exista cache con reglas y que esté actualizada."""
-    global compiled_rules, whitelist_rules
-    cache_path = ext_dir / CACHE_NAME
-
-    need_download = True
-    if cache_path.exists():
-        age = time.time() - cache_path.stat().st_mtime
-        if age < CACHE_TTL:
-            need_download = False
-
-    if need_download:
-        print("[AdBlock] Descargando EasyList...")
-        ok = download_easylist(cache_path)
-        if not ok and not cache_path.exists():
-            print("[AdBlock] No se pudo descargar EasyList y no hay cache.")
-            return
-
-    rules, whitelist = parse_easylist(cache_path)
-    compiled_rules = rules
-    whitelist_rules = whitelist
-    print(f"[AdBlock] Cargadas {len(compiled_rules)} reglas, {len(whitelist_rules)} excepciones.")
-
-def matches_block(uri):
-    """Devuelve True si la uri coincide con alguna regla (y no está en whitelist)."""
-    if not uri:
-        return False
-    lower = uri.lower()
-    for w in whitelist_rules:
-        try:
-            if w.search(lower):
+    """Asegura que haya reglas cargadas y que cada lista activa esté al día según su TTL."""
+    with _update_lock:
+        enabled = _enabled_lists()
+        # Primero lo que ya hay en disco, para bloquear desde el arranque
+        if not rules_loaded and any(sub.cache_path.exists() for sub in enabled):
+            publish_index(load_rule_index(enabled, ext_dir), ext_dir / SOURCES_NAME)
+
+        changes = {}
+        now = time.time()
+        for sub in enabled:
+            if not sub.due(now):
+                continue
+            print(f"[AdBlock] Buscando actualizaciones de {sub.name}...")
+            update = sub.update()
+            if update.status == "error":
+                if not sub.cache_path.exists():
+                    print(f"[AdBlock] No se pudo descargar {sub.name} y no hay cache.")
+            elif update.status == "not-modified":
+                print(f"[AdBlock] {sub.name} ya está al día.")
+            else:
+                changes[sub.id] = (update.added, update.removed)
+        if changes:
+            publish_index(apply_changes(changes, enabled, ext_dir), ext_dir / SOURCES_NAME)
+
+def set_list_enabled(ext_dir, list_id, enabled):
+    """
+    Activa o desactiva una lista. El índice solo cambia en las líneas que
+    aporta esa lista (las que no está en ninguna otra activa).
+    """
+    with _update_lock:
+        sub = next((s for s in subscriptions if s.id == list_id), None)
+        if sub is None:
+            print(f"[AdBlock] No hay ninguna lista '{list_id}'.")
+            return False
+        if sub.enabled == enabled:
+            return True
+        if enabled and not sub.cache_path.exists():
+            print(f"[AdBlock] Descargando {sub.name}...")
+            if sub.update().status == "error":
+                print(f"[AdBlock] No se pudo descargar {sub.name}.")
                 return False
-        except Exception:
-            pass
-    for r in compiled_rules:
+        sub.enabled = enabled
         try:
-            if r.search(lower):
-                return True
-        except Exception:
-            pass
-    return False
+            adblock_lists.save_settings(ext_dir / adblock_lists.SETTINGS_NAME, subscriptions)
+        except OSError as e:
+            print("[AdBlock] No se pudo guardar el estado de las listas:", e)
+        lines = sub.read_lines()
+        changes = {sub.id: (lines, []) if enabled else ([], lines)}
+        publish_index(apply_changes(changes, _enabled_lists(), ext_dir, incremental_only=True),
+                      ext_dir / SOURCES_NAME)
+        print(f"[AdBlock] {sub.name} {'activada' if enabled else 'desactivada'}.")
+        return True
 
-def setup(api):
+def prepare_native_filter(index, sources_path):
     """
-    setup(api) será llamado por el ExtensionManager.
-    'api' tiene: api.window (con api.window.webview y .ucm)
+    Traduce el índice a reglas de WebKit (en este hilo) y pide al hilo de
+    GTK que las cargue del almacén o las compile y las ponga en las pestañas.
     """
-    ext_dir = pathlib.Path(__file__).resolve().parent
-    # Cargar reglas en background para no bloquear UI
-    def _load_rules():
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        return
+    rules, fallback, counts = adblock_webkit.content_rules(index)
+    identifier = adblock_webkit.filter_identifier(adblock_cache.file_digest(sources_path))
+    json_bytes = adblock_webkit.rules_json(rules)
+    print(f"[AdBlock] Reglas nativas: {counts['native']} en WebKit, {counts['fallback']} en Python "
+          f"({counts['unsafe_exceptions']} excepciones no traducibles).")
+
+    def install():
+        global content_store
         try:
-            ensure_rules(ext_dir)
+            if content_store is None:
+                content_store = adblock_webkit.ContentFilterStore(content_store_dir)
+            content_store.load_or_compile(identifier, json_bytes,
+                                          lambda flt: _native_ready(index, flt, fallback))
         except Exception as e:
-            print("[AdBlock] Error cargando reglas:", e)
-    threading.Thread(target=_load_rules, daemon=True).start()
+            print("[AdBlock] Backend nativo no disponible, se filtra desde Python:", e)
+        return False
+    GLib.idle_add(install)
 
-    webview = getattr(api.window, "webview", None)
-    if webview is None:
-        print("[AdBlock] No se encontró webview en api.window")
+def _native_ready(index, flt, fallback):
+    """Pone el filtro compilado en todas las pestañas (hilo de GTK)."""
+    global native_filter, fallback_matcher
+    if flt is None or index is not rule_index:
+        return   # falló o ya hay un índice más nuevo en camino
+    old = native_filter
+    native_filter = flt
+    for webview in list(native_webviews):
+        ucm = webview.get_user_content_manager()
+        if old is not None:
+            ucm.remove_filter(old)
+        ucm.add_filter(flt)
+    fallback_matcher = _new_matcher(fallback)
+    print(f"[AdBlock] Filtro nativo activo en {len(native_webviews)} pestaña(s).")
+
+def attach_native_filter(webview):
+    """Añade el filtro nativo (ya compilado o cuando lo esté) a un WebView."""
+    if webview in native_webviews:
         return
+    native_webviews.append(webview)
 
-    # Handler para resource-load-started (si está disponible)
-    def on_resource_load_started(wv, resource, request):
-        try:
-            uri = None
-            # request puede ser GLib.Bytes o WebKit2.Request dependiendo de versión
-            if hasattr(request, "get_uri"):
-                uri = request.get_uri()
-            else:
-                # attempt attribute access
-                uri = getattr(request, "uri", None)
-            if matches_block(uri):
-                print("[AdBlock] resource-load-started -> bloqueado:", uri)
-                # Intentar abortar recurso si el objeto lo permite
-                if hasattr(resource, "stop"):
-                    try:
-                        resource.stop()
-                    except Exception:
-                        pass
-                if hasattr(resource, "abort"):
-                    try:
-                        resource.abort()
-                    except Exception:
-                        pass
-                # No hay un 'return False/True' universal aquí
-        except Exception as e:
-            print("[AdBlock] error en resource handler:", e)
+    def on_destroy(wv):
+        if wv in native_webviews:
+            native_webviews.remove(wv)
+    webview.connect("destroy", on_destroy)
+    if native_filter is not None:
+        webview.get_user_content_manager().add_filter(native_filter)
 
-    # Handler para decide-policy (más portable)
-    def on_decide_policy(wv, decision, decision_type):
-        try:
-            # decision_type: WebKit2.PolicyDecisionType.NAVIGATION_ACTION etc; a veces se recibe como int
-            if hasattr(decision, "get_request"):
-                req = decision.get_request()
-                uri = req.get_uri() if hasattr(req, "get_uri") else None
-                if matches_block(uri):
-                    print("[AdBlock] decide-policy -> bloqueado:", uri)
-                    try:
-                        decision.ignore()
-                    except Exception:
-                        pass
-                    return True
-        except Exception as e:
-            print("[AdBlock] error en decide-policy:", e)
+def apply_cosmetic_styles(webview, page_url):
+    """
+    Pone en el WebView las hojas de ocultación de page_url (hilo de GTK).
+    Son hojas de usuario: WebKit las aplica desde el inicio del documento,
+    sin esperar a que cargue la página.
+    """
+    styles = cosmetic_styles
+    current = cosmetic_webviews.get(webview)
+    if styles is None or not page_url or not page_url.startswith(("http:", "https:")):
+        key = None
+    else:
+        key = styles.key(page_url)
+    if current is not None and current[0] is styles and current[1] == key:
+        return
+    sheets = styles.sheets(page_url, key) if key is not None else []
+    ucm = webview.get_user_content_manager()
+    if current is not None:
+        if hasattr(ucm, "remove_style_sheet"):
+            for sheet in current[2]:
+                ucm.remove_style_sheet(sheet)
+        else:
+            ucm.remove_all_style_sheets()
+    for sheet in sheets:
+        ucm.add_style_sheet(sheet)
+    cosmetic_webviews[webview] = (styles, key, sheets)
+
+def refresh_cosmetic_styles():
+    """Tras publicar un índice, cambia las hojas de las pestañas abiertas."""
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        return
+
+    def refresh():
+        for webview in list(cosmetic_webviews):
+            try:
+                apply_cosmetic_styles(webview, webview.get_uri())
+            except Exception as e:
+                print("[AdBlock] No se pudieron actualizar las reglas cosméticas:", e)
         return False
+    GLib.idle_add(refresh)
+
+def attach_cosmetic_styles(webview):
+    """Sigue las navegaciones del WebView para cambiar sus hojas de ocultación."""
+    if webview in cosmetic_webviews:
+        return
+    cosmetic_webviews[webview] = (None, None, [])
+
+    def on_load_changed(wv, load_event):
+        # Red de seguridad: la respuesta (decide-policy) ya las cambió salvo
+        # en historial o caché; al confirmar la carga la URL ya es la final
+        if getattr(load_event, "value_nick", "") == "committed":
+            try:
+                apply_cosmetic_styles(wv, wv.get_uri())
+            except Exception as e:
+                print("[AdBlock] error aplicando reglas cosméticas:", e)
+
+    def on_destroy(wv):
+        cosmetic_webviews.pop(wv, None)
+    webview.connect("load-changed", on_load_changed)
+    webview.connect("destroy", on_destroy)
+    apply_cosmetic_styles(webview, webview.get_uri())
+
+def matches_block(uri, resource_type=None, source_url=None):
+    """
+    Devuelve True si la uri coincide con alguna regla (y no está en whitelist).
+    resource_type: 'script', 'image', 'document'... (None = se deduce de la URL).
+    source_url: página que hace la petición, para $third-party y $domain=.
+    """
+    return matcher.match(uri, resource_type, source_url)
+
+def _signal_matches(uri, resource_type, source_url):
+    """Comprobación de las señales: con el filtro nativo puesto, solo el respaldo."""
+    m = fallback_matcher if fallback_matcher is not None else matcher
+    verdict = m.check(uri, resource_type, source_url)
+    if verdict.blocked and verdict.filter is not None:
+        rule_hits[verdict.filter.text] += 1
+    return verdict.blocked
+
+def _is_response(decision_type):
+    name = getattr(decision_type, "value_nick", None) or str(decision_type).lower()
+    return "response" in name
+
+def cosmetic_selectors(page_url):
+    """Selectores CSS a ocultar en la página según las reglas ## / #@#."""
+    return rule_index.cosmetic_selectors(page_url)
+
+def list_stats():
+    """
+    Por lista: reglas, reglas que solo ella aporta y peticiones bloqueadas
+    (las que bloquea WebKit con el filtro nativo no pasan por aquí).
+    """
+    return adblock_lists.list_stats(subscriptions, dict(rule_hits))
+
+def _tab_id(webview):
+    """Número de pestaña del WebView para las estadísticas."""
+    tab = tab_ids.get(webview)
+    if tab is None:
+        tab = tab_ids[webview] = next(_next_tab_id)
+
+        def on_destroy(wv):
+            tab_ids.pop(wv, None)
+            request_stats.forget_tab(tab)
+        webview.connect("destroy", on_destroy)
+    return tab
+
+def request_stats_snapshot():
+    """Tiempos, histograma, contadores por página y pestaña y reglas que más bloquean."""
+    return request_stats.snapshot(rule_hits)
+
+def set_stats_enabled(enabled):
+    request_stats.enabled = bool(enabled)
+
+def reset_stats():
+    request_stats.reset()
+    rule_hits.clear()
+
+def stats_sections():
+    """Las estadísticas como secciones de (etiqueta, valor) para el gestor de extensiones."""
+    snap = request_stats_snapshot()
+    total = snap["total"]
+    sections = [("Resumen", [
+        ("Registro", "activo" if snap["enabled"] else "desactivado"),
+        ("Peticiones", str(total["requests"])),
+        ("Bloqueadas / permitidas", f"{total['blocked']} / {total['allowed']}"),
+        ("Tiempo total en manejadores", f"{total['total_ms']:.1f} ms"),
+    ])]
+    for name, timing in snap["handlers"].items():
+        rows = [
+            ("Peticiones", str(timing["requests"])),
+            ("Media / p50 / p99 / máx", f"{timing['mean_us']:.1f} / {timing['p50_us']:g} / "
+                                        f"{timing['p99_us']:g} / {timing['max_us']:.0f} µs"),
+        ]
+        rows += [(label, str(n)) for label, n in zip(snap["buckets"], timing["histogram"]) if n]
+        sections.append((name, rows))
+    sections.append(("Pestañas", [(f"Pestaña {t['tab']}: {t['page'] or '-'}",
+                                   f"{t['blocked']} bloqueadas / {t['allowed']} permitidas")
+                                  for t in snap["tabs"]]))
+    sections.append(("Páginas recientes", [(p["page"], f"{p['blocked']} bloqueadas / {p['allowed']} permitidas")
+                                           for p in snap["pages"]]))
+    sections.append(("Reglas que más bloquean", [(text, str(n)) for text, n in snap["top_rules"]]))
+    return sections
+
+def cache_stats():
+    """Aciertos/fallos/expulsiones de las caches de decisiones (por URL y por host)."""
+    return matcher.stats()
+
+def _decision_type(decision, decision_type):
+    """Tipo de recurso ABP de una decisión de decide-policy."""
+    name = getattr(decision_type, "value_nick", None) or str(decision_type).lower()
+    if "new-window" in name or "new_window" in name:
+        return "popup"
+    if "response" in name:
+        if hasattr(decision, "is_main_frame_main_resource") and not decision.is_main_frame_main_resource():
+            return "subdocument"
+        return "document"
+    # Navegación: la del marco principal no trae nombre de marco
+    action = decision.get_navigation_action() if hasattr(decision, "get_navigation_action") else None
+    frame = action.get_frame_name() if action is not None and hasattr(action, "get_frame_name") else None
+    return "subdocument" if frame else "document"
+
+# Handler para resource-load-started (si está disponible)
+def on_resource_load_started(wv, resource, request):
+    # Con las estadísticas desactivadas el único coste extra es esta comprobación
+    start = time.perf_counter_ns() if request_stats.enabled else 0
+    blocked, page = False, None
+    try:
+        uri = None
+        # request puede ser GLib.Bytes o WebKit2.Request dependiendo de versión
+        if hasattr(request, "get_uri"):
+            uri = request.get_uri()
+        else:
+            # attempt attribute access
+            uri = getattr(request, "uri", None)
+        page = wv.get_uri() if hasattr(wv, "get_uri") else None
+        # El recurso principal es la propia página: se trata como documento
+        rtype = "document" if uri and uri == page else None
+        blocked = _signal_matches(uri, rtype, page)
+        if blocked:
+            print("[AdBlock] resource-load-started -> bloqueado:", uri)
+            # Intentar abortar recurso si el objeto lo permite
+            if hasattr(resource, "stop"):
+                try:
+                    resource.stop()
+                except Exception:
+                    pass
+            if hasattr(resource, "abort"):
+                try:
+                    resource.abort()
+                except Exception:
+                    pass
+            # No hay un 'return False/True' universal aquí
+    except Exception as e:
+        print("[AdBlock] error en resource handler:", e)
+    if start:
+        request_stats.record("resource-load-started", _tab_id(wv), page,
+                             time.perf_counter_ns() - start, blocked)
+
+# Handler para decide-policy (más portable)
+def on_decide_policy(wv, decision, decision_type):
+    start = time.perf_counter_ns() if request_stats.enabled else 0
+    blocked, page = False, None
+    try:
+        # decision_type: WebKit2.PolicyDecisionType.NAVIGATION_ACTION etc; a veces se recibe como int
+        if hasattr(decision, "get_request"):
+            req = decision.get_request()
+            uri = req.get_uri() if hasattr(req, "get_uri") else None
+            rtype = _decision_type(decision, decision_type)
+            page = wv.get_uri() if hasattr(wv, "get_uri") else None
+            if rtype in ("document", "popup"):
+                page = uri
+            blocked = _signal_matches(uri, rtype, None if rtype in ("document", "popup") else page)
+            if blocked:
+                print("[AdBlock] decide-policy -> bloqueado:", uri)
+                try:
+                    decision.ignore()
+                except Exception:
+                    pass
+            elif rtype == "document" and _is_response(decision_type):
+                # Respuesta del marco principal: la URL ya es la final
+                apply_cosmetic_styles(wv, uri)
+    except Exception as e:
+        print("[AdBlock] error en decide-policy:", e)
+    if start:
+        request_stats.record("decide-policy", _tab_id(wv), page,
+                             time.perf_counter_ns() - start, blocked)
+    return blocked
+
+def attach_webview(webview):
+    """
+    Engancha el bloqueo a un WebView (una vez por WebView). Todas las
+    pestañas comparten los mismos manejadores, el mismo índice de reglas con
+    su cache de decisiones, el filtro nativo y las hojas de ocultación: abrir
+    una pestaña más solo cuesta conectar las señales.
+    """
+    if webview in attached_webviews:
+        return
+    attached_webviews.add(webview)
+    webview.connect("destroy", lambda wv: attached_webviews.discard(wv))
 
     # Intentamos conectar múltiples señales con guardias para evitar excepciones si no existen
     try:
@@ -209,6 +526,60 @@ def setup(api):
     except Exception:
         print("[AdBlock] No se pudo conectar a decide-policy; puede que el bloqueo no funcione en esta versión.")
 
+    try:
+        attach_native_filter(webview)
+    except Exception as e:
+        print("[AdBlock] No se pudo usar el filtro nativo en esta pestaña:", e)
+
+    try:
+        attach_cosmetic_styles(webview)
+    except Exception as e:
+        print("[AdBlock] No se pudieron aplicar las reglas cosméticas en esta pestaña:", e)
+
+def _known_webviews(window):
+    """WebViews de la ventana: api.window.webview o los de sus pestañas."""
+    webview = getattr(window, "webview", None)
+    if webview is not None:
+        return [webview]
+    return [tab[0].webview for tab in getattr(window, "tabs", []) if getattr(tab[0], "webview", None)]
+
+def setup(api):
+    """
+    setup(api) será llamado por el ExtensionManager.
+    'api' tiene: api.window y, si el navegador lo ofrece, api.on_webview_created
+    (si no, se usan api.window.webview o api.window.tabs)
+    """
+    global content_store_dir, subscriptions
+    ext_dir = pathlib.Path(__file__).resolve().parent
+    content_store_dir = ext_dir / FILTER_STORE_NAME
+    try:
+        with open(ext_dir / "manifest.json", encoding="utf-8") as f:
+            declared = json.load(f).get("subscriptions") or []
+    except (OSError, ValueError):
+        declared = []
+    if not declared:
+        declared = [{"id": "easylist", "name": "EasyList", "url": EASYLIST_URL, "cache": CACHE_NAME}]
+    settings = adblock_lists.load_settings(ext_dir / adblock_lists.SETTINGS_NAME)
+    subscriptions = adblock_lists.load_subscriptions(ext_dir, declared, settings)
+    # Cargar reglas en background para no bloquear UI
+    def _load_rules():
+        try:
+            ensure_rules(ext_dir)
+        except Exception as e:
+            print("[AdBlock] Error cargando reglas:", e)
+    threading.Thread(target=_load_rules, daemon=True).start()
+
+    hook = getattr(api, "on_webview_created", None)
+    if hook is not None:
+        # Cada pestaña (las abiertas y las que se creen) avisa con su WebView
+        hook(attach_webview)
+    else:
+        webviews = _known_webviews(api.window)
+        if not webviews:
+            print("[AdBlock] No se encontró ningún webview en api.window")
+        for webview in webviews:
+            attach_webview(webview)
+
     # Método expuesto para recargar reglas desde UI o desde host
     def reload_rules():
         try:
@@ -220,5 +591,18 @@ def setup(api):
     # Si deseas permitir que la página pida recargar reglas desde JS, podríamos registrar un message handler.
     # Por ahora solo lo dejamos en el plugin.
     api.adblock_reload = reload_rules
+    api.adblock_cache_stats = cache_stats
+    api.adblock_list_stats = list_stats
+    api.adblock_stats = request_stats_snapshot
+    api.adblock_stats_enable = set_stats_enabled
+    api.adblock_stats_reset = reset_stats
+    # Lo que usa la vista de estadísticas del gestor de extensiones
+    api.stats_sections = stats_sections
+    api.stats_enabled = lambda: request_stats.enabled
+    api.stats_set_enabled = set_stats_enabled
+    api.stats_reset = reset_stats
+    api.adblock_set_list_enabled = lambda list_id, enabled: threading.Thread(
+        target=set_list_enabled, args=(ext_dir, list_id, enabled), daemon=True).start()
+    api.adblock_cosmetic_selectors = cosmetic_selectors
 
     print("[AdBlock] Extensión cargada.")
@@ -2,144 +2,351 @@ import os
 import gi
 gi.require_version("Gtk", "3.0")
 gi.require_version("WebKit2", "4.1")
-from gi.repository import Gtk, WebKit2, Gio, Gdk, GLib, GdkPixbuf
+from gi.repository import Gtk, WebKit2, Gio, Gdk, GLib, GdkPixbuf, Pango
 
 
 class DownloadWindow(Gtk.Window):
+    # Una fila por descarga que se actualiza en su sitio; los avisos de
+    # progreso solo marcan la ventana y se pinta una vez por fotograma.
     def __init__(self, browser):
         super().__init__(title="Descargas")
-        self.set_default_size(400, 300)
+        self.set_default_size(560, 300)
         self.browser = browser
+        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        # Resumen de la cola: activas, en espera y velocidad total
+        self.summary = Gtk.Label(xalign=0)
+        vbox.pack_start(self.summary, False, False, 0)
         self.listbox = Gtk.ListBox()
-        self.add(self.listbox)
+        self.listbox.set_selection_mode(Gtk.SelectionMode.NONE)
+        placeholder = Gtk.Label(label="No hay descargas activas.")
+        placeholder.show()
+        self.listbox.set_placeholder(placeholder)
+        # Mismo orden que la cola (que se puede reordenar)
+        self.order = {}
+        self.listbox.set_sort_func(lambda a, b: self.order.get(a.item, 0) - self.order.get(b.item, 0))
+        vbox.pack_start(self.listbox, True, True, 0)
+        self.add(vbox)
         self.set_border_width(10)
+        self.rows = {}   # QueuedDownload -> DownloadRow
         self._timer = None
+        self._tick = 0
+        self.connect("destroy", self.on_destroy)
         self.refresh()
         self.show_all()
         self.start_auto_refresh()
 
+    def on_destroy(self, widget):
+        if self._timer:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        if self._tick:
+            self.remove_tick_callback(self._tick)
+            self._tick = 0
+
     def refresh(self):
-        self.listbox.foreach(lambda row: self.listbox.remove(row))
-        if not self.browser.active_downloads:
-            self.listbox.add(Gtk.Label(label="No hay descargas activas."))
-        else:
-            for download in self.browser.active_downloads:
-                # Descarga manual: dict con claves 'manual', 'filename', 'progress', 'cancel', 'thread'
-                if isinstance(download, dict) and download.get('manual'):
-                    fname = download.get('filename', 'descarga')
-                    row = Gtk.ListBoxRow()
-                    hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-                    lbl = Gtk.Label(label=fname, xalign=0)
-                    hbox.pack_start(lbl, True, True, 0)
-                    progress = Gtk.ProgressBar()
-                    prog = download.get('progress', 0)
-                    progress.set_fraction(prog)
-                    progress.set_text(f"{int(prog*100)}%" if prog > 0 else "Descargando...")
-                    hbox.pack_start(progress, False, False, 0)
-                    btn_cancel = Gtk.Button(label="Cancelar")
-                    def cancelar_manual(btn, d=download):
-                        d['cancel'][0] = True
-                    btn_cancel.connect("clicked", cancelar_manual)
-                    hbox.pack_start(btn_cancel, False, False, 0)
-                    row.add(hbox)
-                    self.listbox.add(row)
-                else:
-                    fname = download.get_suggested_filename() or "descarga"
-                    row = Gtk.ListBoxRow()
-                    hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-                    lbl = Gtk.Label(label=fname, xalign=0)
-                    hbox.pack_start(lbl, True, True, 0)
-                    progress = Gtk.ProgressBar()
-                    prog = 0
-                    show_text = "Descargando..."
-                    if hasattr(download, 'get_estimated_progress'):
-                        try:
-                            prog = download.get_estimated_progress()
-                            progress.set_fraction(prog)
-                            show_text = f"{int(prog*100)}%"
-                        except Exception:
-                            progress.set_fraction(0)
-                    else:
-                        progress.set_fraction(0)
-                    progress.set_text(show_text)
-                    hbox.pack_start(progress, False, False, 0)
-                    btn_pause = Gtk.Button(label="Pausar")
-                    btn_pause.connect("clicked", lambda _, d=download: d.pause() if hasattr(d, 'pause') and callable(getattr(d, 'pause', None)) else None)
-                    hbox.pack_start(btn_pause, False, False, 0)
-                    btn_resume = Gtk.Button(label="Reanudar")
-                    btn_resume.connect("clicked", lambda _, d=download: d.resume() if hasattr(d, 'resume') and callable(getattr(d, 'resume', None)) else None)
-                    hbox.pack_start(btn_resume, False, False, 0)
-                    btn_cancel = Gtk.Button(label="Cancelar")
-                    btn_cancel.connect("clicked", lambda _, d=download: d.cancel())
-                    hbox.pack_start(btn_cancel, False, False, 0)
-                    row.add(hbox)
-                    self.listbox.add(row)
-        self.listbox.show_all()
+        queue = self.browser.downloads
+        items = queue.items
+        for item in [item for item in self.rows if item not in items]:
+            self.listbox.remove(self.rows.pop(item))
+        order = {item: i for i, item in enumerate(items)}
+        reordered = order != self.order
+        self.order = order
+        for item in items:
+            row = self.rows.get(item)
+            if row is None:
+                row = self.rows[item] = DownloadRow(queue, item)
+                self.listbox.add(row)
+            row.update()
+        if reordered:
+            self.listbox.invalidate_sort()
+        self.summary.set_text(f"{len(queue.active())} activas, {len(queue.queued())} en cola · "
+                              f"{format_rate(queue.throughput())}")
 
     def update_progress(self):
+        # Se junta todo lo que llegue hasta el próximo fotograma
+        if not self._tick:
+            self._tick = self.add_tick_callback(self._on_tick)
+        if self._timer is None and self.browser.downloads.items:
+            self.start_auto_refresh()
+
+    def _on_tick(self, widget, frame_clock):
+        self._tick = 0
         self.refresh()
+        return False
 
     def start_auto_refresh(self):
         if self._timer:
             GLib.source_remove(self._timer)
+        # Las de WebKit no avisan del progreso: velocidad y tiempo restante cada segundo
         self._timer = GLib.timeout_add_seconds(1, self._auto_refresh)
 
     def _auto_refresh(self):
         self.refresh()
-        # Si no hay descargas activas, detener el timer
-        if not self.browser.active_downloads:
+        # Si no hay descargas, detener el timer
+        if not self.browser.downloads.items:
             self._timer = None
             return False
         return True
 
+
+class DownloadRow(Gtk.ListBoxRow):
+    # Los widgets se crean una vez; update() solo cambia lo que cambió
+    def __init__(self, queue, item):
+        super().__init__()
+        self.item = item
+        self.meter = RateMeter(DOWNLOAD_SPEED_WINDOW)
+        self.shown = {}
+        hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
+        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=2)
+        self.name = Gtk.Label(xalign=0)
+        self.name.set_ellipsize(Pango.EllipsizeMode.MIDDLE)
+        self.detail = Gtk.Label(xalign=0)
+        self.detail.get_style_context().add_class("dim-label")
+        vbox.pack_start(self.name, False, False, 0)
+        vbox.pack_start(self.detail, False, False, 0)
+        hbox.pack_start(vbox, True, True, 0)
+        self.progress = Gtk.ProgressBar(show_text=True, valign=Gtk.Align.CENTER)
+        hbox.pack_start(self.progress, False, False, 0)
+        # Reordenar la cola
+        self.btn_up = Gtk.Button(label="↑")
+        self.btn_up.connect("clicked", lambda _: queue.move(item, -1))
+        self.btn_down = Gtk.Button(label="↓")
+        self.btn_down.connect("clicked", lambda _: queue.move(item, 1))
+        # Las de WebKit no se pueden pausar
+        self.btn_pause = Gtk.Button(label="Pausar")
+        self.btn_pause.connect("clicked", lambda _: item.job.pause())
+        self.btn_resume = Gtk.Button(label="Reanudar")
+        self.btn_resume.connect("clicked", lambda _: queue.resume(item))
+        btn_cancel = Gtk.Button(label="Cancelar")
+        btn_cancel.connect("clicked", lambda _: queue.cancel(item))
+        for button in (self.btn_up, self.btn_down, self.btn_pause, self.btn_resume, btn_cancel):
+            hbox.pack_start(button, False, False, 0)
+        # Su visibilidad la decide update(): que show_all() no la cambie
+        for button in (self.btn_up, self.btn_down, self.btn_pause, self.btn_resume):
+            button.set_no_show_all(True)
+            button.hide()
+        self.add(hbox)
+        self.show_all()
+
+    def _set(self, key, value, setter):
+        if self.shown.get(key) != value:
+            self.shown[key] = value
+            setter(value)
+
+    def update(self):
+        item = self.item
+        received, total = download_bytes(item)
+        if item.state == "active":
+            speed = self.meter.add(received)
+        else:
+            speed = 0.0
+            self.meter.reset()   # al reanudar no cuenta el rato parado
+        fraction = min(1.0, received / total) if total else 0.0
+        if item.state == "queued":
+            text, detail = "En cola", ""
+        elif item.state == "paused":
+            text, detail = f"En pausa ({int(fraction*100)}%)", format_size(received, total)
+        else:
+            text = f"{int(fraction*100)}%" if fraction > 0 else "Descargando..."
+            detail = f"{format_size(received, total)} · {format_rate(speed)}"
+            if total and speed > 0:
+                detail += f" · quedan {format_eta((total - received) / speed)}"
+        self._set("name", download_name(item), self.name.set_text)
+        self._set("fraction", round(fraction, 3), self.progress.set_fraction)
+        self._set("text", text, self.progress.set_text)
+        self._set("detail", detail, self.detail.set_text)
+        queued = item.state == "queued"
+        manual = item.kind == "manual" and not queued
+        self._set("queued", queued, lambda v: (self.btn_up.set_visible(v), self.btn_down.set_visible(v)))
+        self._set("pause", manual and item.state == "active", self.btn_pause.set_visible)
+        self._set("resume", manual and item.state == "paused", self.btn_resume.set_visible)
+
+
+def download_name(item):
+    import urllib.parse
+    if item.kind == "manual":
+        return item.job.filename
+    destination = item.job.get_destination() if item.job is not None else None
+    if destination:
+        return os.path.basename(urllib.parse.unquote(destination))
+    response = item.job.get_response() if item.job is not None else None
+    if response is not None and response.get_suggested_filename():
+        return response.get_suggested_filename()
+    return os.path.basename(urllib.parse.urlsplit(item.url or "").path) or "descarga"
+
+
+def download_bytes(item):
+    """(bytes recibidos, tamaño total o 0) de una descarga de la cola."""
+    if item.job is None:
+        return 0, 0
+    if item.kind == "manual":
+        return item.job.downloaded, item.job.total or 0
+    response = item.job.get_response()
+    return item.job.get_received_data_length(), response.get_content_length() if response is not None else 0
+
+
+def format_size(received, total):
+    if total:
+        return f"{received / (1024 * 1024):.1f} de {total / (1024 * 1024):.1f} MB"
+    return f"{received / (1024 * 1024):.1f} MB"
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def format_rate(bytes_per_second):
+    if bytes_per_second >= 1024 * 1024:
+        return f"{bytes_per_second / (1024 * 1024):.1f} MB/s"
+    return f"{bytes_per_second / 1024:.0f} KB/s"
+
 class BrowserTab(Gtk.Box):
-    def __init__(self, browser, url="https://duckduckgo.com"):
+    def __init__(self, browser, url="https://duckduckgo.com", lazy=False, title=None, session_state=None):
         super().__init__(orientation=Gtk.Orientation.VERTICAL)
         self.browser = browser
+        self.webview = None
+        # Lo que se recuerda de la pestaña mientras no tiene WebView
+        self.url = url
+        self.title = title
+        self.favicon = None
+        self.session_state = session_state  # GLib.Bytes de get_session_state().serialize()
+        self.label = None  # etiqueta de la barra de pestañas (la pone create_tab)
+        self.session_id = None  # id de la pestaña en el diario de sesión (lo pone create_tab)
+        self.pending_transition = None  # tipo de la próxima visita, para el historial
+        self.last_active = time.monotonic()
+        # Una pestaña perezosa no crea el WebView hasta que se selecciona
+        if not lazy:
+            self.ensure_webview()
+
+    def ensure_webview(self):
+        # Crea el WebView si la pestaña está en reposo y recupera su historial
+        if self.webview is not None:
+            return self.webview
+        # Contexto, ajustes y proxy son los compartidos del navegador (ver WebContextFactory)
+        self.webview = self.browser.web_contexts.create_webview()
+        # Las extensiones se enganchan al WebView antes de la primera carga
+        self.browser.notify_webview_created(self.webview)
 
-        # Configurar proxy si está definido
-        self.webview = WebKit2.WebView()
-        # Desactivar el anuncio de reproducción de medios en el sistema
-        settings = self.webview.get_settings()
-        if hasattr(settings, 'set_enable_media_stream'):  # WebKit2 >= 2.24
-            settings.set_enable_media_stream(False)
-        if hasattr(settings, 'set_enable_mediasource'):  # WebKit2 >= 2.24
-            settings.set_enable_mediasource(False)
-        if hasattr(settings, 'set_autoplay'):  # WebKit2 >= 2.28
-            settings.set_autoplay(False)
-        proxy_uri = browser.data.get("proxy", "").strip()
-        if proxy_uri:
-            context = self.webview.get_context()
-            settings = context.get_settings()
-            # Configuración de proxy para WebKit2GTK
-            # Solo funciona si se usa GIO y el entorno soporta la variable
-            os.environ["http_proxy"] = proxy_uri
-            os.environ["https_proxy"] = proxy_uri
-        self.webview.load_uri(url)
+        # Conectar señal de política para gestionar descargas
+        self.webview.connect("decide-policy", self.on_decide_policy)
+        self.webview.connect("notify::title", self.on_title_changed)
+        self.webview.connect("notify::uri", self.on_uri_changed)
+        self.webview.connect("notify::favicon", self.on_favicon_changed)
+        self.webview.connect("load-changed", self.on_load_changed)
+
+        if not self.restore_session_state():
+            self.webview.load_uri(self.url)
         self.pack_start(self.webview, True, True, 0)
         self.show_all()
+        return self.webview
 
-        # Conectar señal de política para gestionar descargas
-        self.webview.connect("decide-policy", self.on_decide_policy)
+    def restore_session_state(self):
+        # Historial de atrás/adelante guardado al descartar la pestaña
+        data, self.session_state = self.session_state, None
+        if data is None or not hasattr(WebKit2, "WebViewSessionState"):
+            return False
+        try:
+            self.webview.restore_session_state(WebKit2.WebViewSessionState.new(data))
+            item = self.webview.get_back_forward_list().get_current_item()
+        except Exception as e:
+            print(f"[Pestañas] No se pudo restaurar el historial de la pestaña: {e}")
+            return False
+        if item is None:
+            return False
+        self.webview.go_to_back_forward_list_item(item)
+        return True
+
+    def can_discard(self):
+        # No se descartan pestañas sin WebView ni las que están sonando
+        if self.webview is None:
+            return False
+        if hasattr(self.webview, "is_playing_audio") and self.webview.is_playing_audio():
+            return False
+        return True
+
+    def discard(self):
+        # Destruye el WebView (y libera su proceso web) guardando lo necesario para recrearlo
+        if not self.can_discard():
+            return False
+        webview, self.webview = self.webview, None
+        self.url = webview.get_uri() or self.url
+        self.title = webview.get_title() or self.title
+        try:
+            self.session_state = webview.get_session_state().serialize()
+        except Exception:
+            self.session_state = None
+        self.remove(webview)
+        webview.destroy()
+        return True
+
+    def get_title(self):
+        if self.webview is not None:
+            return self.webview.get_title() or self.title
+        return self.title
+
+    def get_uri(self):
+        if self.webview is not None:
+            return self.webview.get_uri() or self.url
+        return self.url
+
+    def get_session_bytes(self):
+        # Historial de atrás/adelante serializado, para el diario de sesión
+        if self.webview is not None:
+            try:
+                return self.webview.get_session_state().serialize().get_data()
+            except Exception:
+                return None
+        return self.session_state.get_data() if self.session_state is not None else None
+
+    def on_title_changed(self, webview, _):
+        self.title = webview.get_title() or self.title
+        if webview.get_title() and self.url:
+            self.browser.record_title(self.url, self.title)
+        if self.label is not None:
+            self.browser.update_tab_label(self.label, self)
+        self.browser.mark_session_dirty(self)
+
+    def on_uri_changed(self, webview, _):
+        self.url = webview.get_uri() or self.url
+        self.browser.update_url_entry(webview, _)
+        self.browser.mark_session_dirty(self)
+
+    def on_load_changed(self, webview, event):
+        if event == WebKit2.LoadEvent.COMMITTED:
+            transition = self.pending_transition
+            self.pending_transition = None
+            self.browser.record_visit(self, webview.get_uri(),
+                                      storage.TRANSITION_OTHER if transition is None else transition)
+        # Al terminar una carga cambia el historial de atrás/adelante
+        elif event == WebKit2.LoadEvent.FINISHED:
+            self.browser.mark_session_dirty(self)
+
+    def on_favicon_changed(self, webview, _):
+        self.favicon = webview.get_favicon()
+
+    def note_navigation(self, decision, decision_type):
+        # Tipo de transición de la navegación del marco principal que empieza
+        if decision_type != WebKit2.PolicyDecisionType.NAVIGATION_ACTION:
+            return
+        action = decision.get_navigation_action()
+        if action is None or action.get_frame_name():
+            return
+        transition = NAVIGATION_TRANSITIONS.get(action.get_navigation_type(), storage.TRANSITION_OTHER)
+        # Una carga del programa no pisa lo que ya se sabía (p. ej. escrita en la barra)
+        if transition != storage.TRANSITION_OTHER or self.pending_transition is None:
+            self.pending_transition = transition
 
     def on_decide_policy(self, webview, decision, decision_type):
+        self.note_navigation(decision, decision_type)
         print(f"[DEBUG] decide-policy llamada. decision_type={decision_type}, is_download={getattr(decision, 'is_download', None)}")
         # Compatibilidad: detectar descargas usando is_download()
         if hasattr(decision, 'is_download') and decision.is_download():
             print(f"[DEBUG] ¡Descarga detectada! decision={decision}")
             download = decision.download()
-            download.connect("decide-destination", self.on_decide_destination)
-            self.browser.active_downloads.append(download)
-            def remove_download(d, *args):
-                if d in self.browser.active_downloads:
-                    self.browser.active_downloads.remove(d)
-                if hasattr(self.browser, 'download_window') and self.browser.download_window:
-                    self.browser.download_window.update_progress()
-            download.connect("finished", remove_download)
-            download.connect("failed", remove_download)
-            download.connect("progress-changed", lambda d, *_: self.browser.download_window.update_progress() if hasattr(self.browser, 'download_window') and self.browser.download_window else None)
-            if hasattr(self.browser, 'download_window') and self.browser.download_window:
-                self.browser.download_window.update_progress()
+            self.browser.track_webkit_download(download, self.on_decide_destination)
             return True
         # Forzar descarga si el tipo de decisión es RESPONSE y el MIME es de archivo
         # Esto cubre casos donde is_download es No pero el servidor envía un archivo
@@ -158,18 +365,7 @@ class BrowserTab(Gtk.Box):
                 if hasattr(decision, 'download'):
                     download = decision.download()
                     if download is not None:
-                        download.connect("decide-destination", self.on_decide_destination)
-                        self.browser.active_downloads.append(download)
-                        def remove_download(d, *args):
-                            if d in self.browser.active_downloads:
-                                self.browser.active_downloads.remove(d)
-                            if hasattr(self.browser, 'download_window') and self.browser.download_window:
-                                self.browser.download_window.update_progress()
-                        download.connect("finished", remove_download)
-                        download.connect("failed", remove_download)
-                        download.connect("progress-changed", lambda d, *_: self.browser.download_window.update_progress() if hasattr(self.browser, 'download_window') and self.browser.download_window else None)
-                        if hasattr(self.browser, 'download_window') and self.browser.download_window:
-                            self.browser.download_window.update_progress()
+                        self.browser.track_webkit_download(download, self.on_decide_destination)
                         return True
                     else:
                         print(f"[DEBUG] No se pudo crear el objeto de descarga para MIME={mime_type}")
@@ -199,66 +395,18 @@ class BrowserTab(Gtk.Box):
                                 if not hasattr(browser, 'download_window') or browser.download_window is None:
                                     browser.download_window = DownloadWindow(browser)
                                     browser.download_window.connect("destroy", lambda w: setattr(browser, 'download_window', None))
-                                # Descargar el archivo manualmente con progreso y cancelación
-                                import threading
-                                cancel_flag = [False]
-                                manual_download = {
-                                    'manual': True,
-                                    'filename': os.path.basename(dest),
-                                    'progress': 0,
-                                    'cancel': cancel_flag,
-                                    'thread': None
-                                }
-                                browser.active_downloads.append(manual_download)
-                                def descargar_manual():
-                                    import requests
-                                    try:
-                                        r = requests.get(url, stream=True, timeout=30)
-                                        r.raise_for_status()
-                                        total = int(r.headers.get('content-length', 0))
-                                        downloaded = 0
-                                        with open(dest, "wb") as f:
-                                            for chunk in r.iter_content(chunk_size=8192):
-                                                if cancel_flag[0]:
-                                                    print("Descarga manual cancelada por el usuario.")
-                                                    break
-                                                if chunk:
-                                                    f.write(chunk)
-                                                    downloaded += len(chunk)
-                                                    prog = downloaded / total if total > 0 else 0
-                                                    manual_download['progress'] = prog
-                                                    if hasattr(browser, 'download_window') and browser.download_window:
-                                                        GLib.idle_add(browser.download_window.update_progress)
-                                        if not cancel_flag[0]:
-                                            print(f"Descarga manual completada: {dest}")
-                                            GLib.idle_add(lambda: browser.mostrar_mensaje(f"Descarga completada: {os.path.basename(dest)}"))
-                                        else:
-                                            GLib.idle_add(lambda: browser.mostrar_mensaje(f"Descarga cancelada: {os.path.basename(dest)}"))
-                                    except Exception as exc:
-                                        print(f"Error en descarga manual: {exc}")
-                                        GLib.idle_add(lambda exc=exc: browser.mostrar_mensaje(f"Error al descargar: {exc}"))
-                                    # Eliminar de la lista al terminar
-                                    if manual_download in browser.active_downloads:
-                                        browser.active_downloads.remove(manual_download)
-                                        if hasattr(browser, 'download_window') and browser.download_window:
-                                            GLib.idle_add(browser.download_window.update_progress)
-                                t = threading.Thread(target=descargar_manual, daemon=True)
-                                manual_download['thread'] = t
-                                t.start()
-                                if hasattr(browser, 'download_window') and browser.download_window:
-                                    GLib.idle_add(browser.download_window.update_progress)
+                                # Por rangos en paralelo y reanudable (ver downloader.py)
+                                manual_download = SegmentedDownload(
+                                    url, dest, limiter=browser.downloads.limiter,
+                                    on_progress=lambda d: GLib.idle_add(browser.on_manual_download_progress, d))
+                                browser.downloads.add_manual(manual_download, url)  # empieza cuando haya hueco
                                 return True
                             else:
                                 dialog.destroy()
         return False
 
     def on_download_started(self, webview, download):
-        if download not in self.browser.active_downloads:
-            self.browser.active_downloads.append(download)
-        download.connect("decide-destination", self.on_decide_destination)
-        download.connect("progress-changed", lambda d, *_: self.browser.download_window.update_progress() if hasattr(self.browser, 'download_window') and self.browser.download_window else None)
-        if hasattr(self.browser, 'download_window') and self.browser.download_window:
-            self.browser.download_window.update_progress()
+        self.browser.track_webkit_download(download, self.on_decide_destination)
 
     def on_decide_destination(self, download, suggested_filename):
         browser = self.browser
@@ -288,25 +436,158 @@ class BrowserTab(Gtk.Box):
 
 import json
 import threading
-import requests
+import time
+from download_queue import DEFAULT_MAX_ACTIVE, DEFAULT_PER_HOST, DownloadQueue, RateMeter
+from downloader import SegmentedDownload
+from persist import PersistWriter
+from session import SessionJournal
+import storage
+from storage import BrowserStore
+from omnibox import LocalIndex, RemoteSuggester
 
 
 CONFIG_FILE = os.path.expanduser("~/.foxgtk_config.json")
-DATA_FILE = os.path.expanduser("~/.foxgtk_data.json")
-
-def load_data():
-    try:
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    except Exception:
-        return {"history": [], "bookmarks": [], "homepage": "https://duckduckgo.com", "proxy": ""}
-
-def save_data(data):
-    try:
-        with open(DATA_FILE, "w") as f:
-            json.dump(data, f)
-    except Exception as e:
-        print(f"Error guardando datos: {e}")
+DATA_FILE = os.path.expanduser("~/.foxgtk_data.json")  # formato antiguo, se migra a DB_FILE
+DB_FILE = os.path.expanduser("~/.foxgtk_data.db")
+SESSION_FILE = os.path.expanduser("~/.foxgtk_session.bin")
+# Los cambios de las pestañas se juntan y se escriben en el diario cada tanto
+SESSION_FLUSH_MS = 1000
+URL_LIST_PAGE = 200  # filas que se piden de cada vez en el historial y los marcadores
+DOWNLOAD_SPEED_WINDOW = 5.0  # segundos para la velocidad y el tiempo restante de cada descarga
+# Sugerencias: las locales salen al momento; las remotas, tras una pausa al escribir
+SUGGEST_DEBOUNCE_MS = 150
+SUGGEST_LOCAL_LIMIT = 5
+SUGGEST_REMOTE_LIMIT = 6
+
+# Tipo de navegación de WebKit -> tipo de transición de la visita (ver storage.py)
+NAVIGATION_TRANSITIONS = {
+    WebKit2.NavigationType.LINK_CLICKED: storage.TRANSITION_LINK,
+    WebKit2.NavigationType.FORM_SUBMITTED: storage.TRANSITION_FORM,
+    WebKit2.NavigationType.FORM_RESUBMITTED: storage.TRANSITION_FORM,
+    WebKit2.NavigationType.BACK_FORWARD: storage.TRANSITION_BACK_FORWARD,
+    WebKit2.NavigationType.RELOAD: storage.TRANSITION_RELOAD,
+}
+
+# Descarte de pestañas en segundo plano (se pueden cambiar en DATA_FILE con
+# "tab_discard_minutes" y "tab_memory_limit_mb"; 0 desactiva cada criterio)
+TAB_DISCARD_MINUTES = 30
+TAB_MEMORY_LIMIT_MB = 2048
+TAB_CHECK_SECONDS = 30
+
+# Perfiles de procesos y caches de WebKit ("web_profile" en DATA_FILE). Cada
+# valor se puede cambiar por separado con "web_cache_model",
+# "web_process_limit" (0 = sin límite) y "web_process_swap".
+WEB_PROFILES = {
+    # Un proceso por sitio y caches grandes: más memoria, menos CPU
+    "rendimiento": {"cache_model": "web_browser", "process_limit": 0, "process_swap": True},
+    "equilibrado": {"cache_model": "web_browser", "process_limit": 8, "process_swap": True},
+    # Pocos procesos compartidos y caches pequeñas: menos memoria con muchas pestañas
+    "memoria": {"cache_model": "document_browser", "process_limit": 3, "process_swap": False},
+}
+DEFAULT_WEB_PROFILE = "equilibrado"
+
+def process_tree_rss_mb(pid=None):
+    # Memoria residente del navegador y de sus procesos hijos (los procesos web de WebKit)
+    pending = [pid or os.getpid()]
+    total_kb = 0
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total_kb / 1024
+
+class WebContextFactory:
+    # Contexto WebKit único para todas las pestañas: cache, cookies y datos
+    # en disco compartidos, un único objeto de ajustes y el reparto de
+    # pestañas entre procesos web según el perfil elegido.
+
+    CACHE_MODELS = {
+        "web_browser": "WEB_BROWSER",
+        "document_browser": "DOCUMENT_BROWSER",
+        "document_viewer": "DOCUMENT_VIEWER",
+    }
+
+    def __init__(self, data):
+        self.data = data
+        profile = WEB_PROFILES.get(data.get("web_profile"), WEB_PROFILES[DEFAULT_WEB_PROFILE])
+        self.cache_model = data.get("web_cache_model", profile["cache_model"])
+        self.process_limit = max(0, int(data.get("web_process_limit", profile["process_limit"])))
+        self.process_swap = bool(data.get("web_process_swap", profile["process_swap"]))
+        self.process_owners = []  # WebViews con proceso propio (con límite de procesos)
+        self._next_owner = 0
+
+        cache_dir = data.get("web_cache_dir") or os.path.join(GLib.get_user_cache_dir(), "navia")
+        data_dir = os.path.join(GLib.get_user_data_dir(), "navia")
+        self.data_manager = WebKit2.WebsiteDataManager(base_cache_directory=cache_dir,
+                                                       base_data_directory=data_dir)
+        props = {"website_data_manager": self.data_manager}
+        # Cambiar de proceso al navegar a otro sitio (WebKitGTK >= 2.28)
+        if any(p.name == "process-swap-on-cross-site-navigation-enabled"
+               for p in WebKit2.WebContext.list_properties()):
+            props["process_swap_on_cross_site_navigation_enabled"] = self.process_swap
+        self.context = WebKit2.WebContext(**props)
+        self.set_cache_model(self.cache_model)
+        if self.process_limit and hasattr(self.context, "set_web_process_count_limit"):
+            # Solo lo respetan versiones antiguas; en las nuevas se usa related_view
+            self.context.set_web_process_count_limit(self.process_limit)
+        self.set_proxy(data.get("proxy", ""))
+
+        self.settings = WebKit2.Settings()
+        # Desactivar el anuncio de reproducción de medios en el sistema
+        if hasattr(self.settings, 'set_enable_media_stream'):  # WebKit2 >= 2.24
+            self.settings.set_enable_media_stream(False)
+        if hasattr(self.settings, 'set_enable_mediasource'):  # WebKit2 >= 2.24
+            self.settings.set_enable_mediasource(False)
+        if hasattr(self.settings, 'set_autoplay'):  # WebKit2 >= 2.28
+            self.settings.set_autoplay(False)
+
+    def set_cache_model(self, name):
+        model = self.CACHE_MODELS.get(name, "WEB_BROWSER")
+        self.cache_model = name if name in self.CACHE_MODELS else "web_browser"
+        self.context.set_cache_model(getattr(WebKit2.CacheModel, model))
+
+    def set_proxy(self, proxy_uri):
+        # Proxy de la sesión de red compartida (WebKitGTK >= 2.32 en el gestor de datos)
+        proxy_uri = (proxy_uri or "").strip()
+        target = self.data_manager if hasattr(self.data_manager, "set_network_proxy_settings") else self.context
+        if not hasattr(target, "set_network_proxy_settings"):
+            return
+        if proxy_uri:
+            settings = WebKit2.NetworkProxySettings.new(proxy_uri, None)
+            target.set_network_proxy_settings(WebKit2.NetworkProxyMode.CUSTOM, settings)
+        else:
+            target.set_network_proxy_settings(WebKit2.NetworkProxyMode.DEFAULT, None)
+
+    def create_webview(self):
+        # Cada WebView tiene su gestor de contenido (reglas y hojas por pestaña);
+        # con límite de procesos, a partir del límite comparte proceso con otro
+        props = {
+            "web_context": self.context,
+            "settings": self.settings,
+            "user_content_manager": WebKit2.UserContentManager(),
+        }
+        if self.process_limit and len(self.process_owners) >= self.process_limit:
+            self._next_owner = (self._next_owner + 1) % len(self.process_owners)
+            props["related_view"] = self.process_owners[self._next_owner]
+            return WebKit2.WebView(**props)
+        webview = WebKit2.WebView(**props)
+        if self.process_limit:
+            self.process_owners.append(webview)
+            webview.connect("destroy", self.on_owner_destroyed)
+        return webview
+
+    def on_owner_destroyed(self, webview):
+        if webview in self.process_owners:
+            self.process_owners.remove(webview)
 
 class Navia(Gtk.Window):
 
@@ -325,6 +606,8 @@ class Navia(Gtk.Window):
             )
         else:
             print(f"No se encontró el archivo de estilos: {css_path}")
+        # Los JSON y el diario de sesión se escriben en este hilo, no en el de GTK
+        self.writer = PersistWriter()
         # Leer tamaño guardado
         width, height = self.load_window_size()
         # Establecer tamaño mínimo permitido usando geometry hints correctamente
@@ -410,13 +693,24 @@ class Navia(Gtk.Window):
         self.tabs_bar.pack_start(self.btn_new_tab, False, False, 0)
 
         # Contenedor para el contenido de la pestaña activa
-        self.tab_content = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        # Cada pestaña es una página del Gtk.Stack: cambiar de pestaña solo cambia la visible
+        self.tab_content = Gtk.Stack()
+        self.tab_content.set_transition_type(Gtk.StackTransitionType.NONE)
         self.main_box.pack_start(self.tab_content, True, True, 0)
 
         self.tabs = []  # Lista de (tab_widget, tab_button, tab_box)
+        self.webview_hooks = {}  # extensión -> funciones a llamar con cada WebView nuevo
         self.current_tab_index = -1
+        self.active_tab = None  # (BrowserTab, tab_box) de la pestaña visible
+        self.session = SessionJournal(SESSION_FILE)  # tras load(), solo lo toca self.writer
+        self.next_session_id = 1
+        self.session_dirty = set()  # pestañas con cambios sin escribir en el diario
+        self.session_flush_id = 0
 
-        self.data = load_data()
+        # Ajustes, historial y marcadores (ver storage.py); self.data son los ajustes
+        self.store = BrowserStore(DB_FILE, legacy_json=DATA_FILE)
+        self.data = self.store.load_settings()
+        self.web_contexts = WebContextFactory(self.data)
 
         # Botón de traducción
         self.btn_translate = self.make_button("icons/traductor.png", self.translate_page)
@@ -426,12 +720,73 @@ class Navia(Gtk.Window):
         # Forzar DuckDuckGo como página principal si no está configurada
         if self.data.get("homepage", "") != "https://duckduckgo.com":
             self.data["homepage"] = "https://duckduckgo.com"
-            save_data(self.data)
+            self.store.save_settings(self.data)
+
+        # Sugerencias como popup
+        self.suggest_popup = Gtk.Window(type=Gtk.WindowType.POPUP)
+        self.suggest_popup.set_decorated(False)
+        self.suggest_popup.set_transient_for(self)
+        self.suggest_popup.set_resizable(False)
+        self.suggest_popup.set_border_width(0)
+        self.suggest_list = Gtk.ListBox()
+        self.suggest_list.set_selection_mode(Gtk.SelectionMode.NONE)
+        self.suggest_popup.add(self.suggest_list)
+        self.suggest_popup.set_visible(False)
+        # Historial y marcadores en memoria, y las remotas con cache y una sola sesión HTTP
+        self.local_suggestions = LocalIndex()
+        self.local_suggestions.load(self.store)
+        self.remote_suggestions = RemoteSuggester()
+        self.suggest_version = 0  # solo se pintan los resultados de la última consulta
+        self.suggest_timer = 0
+        self.suggest_local = []
+        self.suggest_items = []
+
+        self.entry.connect("changed", self.on_entry_changed)
+        self.entry.connect("focus-out-event", self.hide_suggestions)
+        self.suggest_list.connect("row-activated", self.on_suggestion_clicked)
+
+        # Todas las descargas pasan por la cola: límites de concurrencia y de ancho de banda
+        self.download_window = None
+        self.downloads = DownloadQueue(start_webkit=self.restart_webkit_download,
+                                       on_change=self.on_downloads_changed)
+        self.configure_downloads()
 
-        self.create_tab()
+        # Las extensiones antes que las pestañas: sus ganchos (p. ej. el filtro
+        # del bloqueador) tienen que estar puestos antes de la primera carga
         self.load_active_extensions()
+        if not self.restore_session():
+            self.create_tab()
+        GLib.timeout_add_seconds(TAB_CHECK_SECONDS, self.discard_background_tabs)
+    def make_extension_api(self, nombre):
+        # Objeto que recibe setup(api): la ventana y el gancho de WebViews nuevos
+        api = type("API", (), {"window": self})()
+        self.webview_hooks.pop(nombre, None)  # los de una carga anterior
+
+        def on_webview_created(callback):
+            # callback(webview) se llama con cada pestaña nueva y ahora con las ya abiertas
+            self.webview_hooks.setdefault(nombre, []).append(callback)
+            for tab, _, _ in self.tabs:
+                # Las pestañas en reposo avisarán cuando creen su WebView
+                if tab.webview is not None:
+                    self.run_webview_hook(nombre, callback, tab.webview)
+
+        api.on_webview_created = on_webview_created
+        return api
+
+    def run_webview_hook(self, nombre, callback, webview):
+        try:
+            callback(webview)
+        except Exception as e:
+            print(f"[Extensiones] Error de '{nombre}' con la pestaña nueva: {e}")
+
+    def notify_webview_created(self, webview):
+        for nombre, callbacks in list(self.webview_hooks.items()):
+            for callback in list(callbacks):
+                self.run_webview_hook(nombre, callback, webview)
+
     def load_active_extensions(self):
         self.loaded_extensions = {}
+        self.extension_apis = {}
         ext_dir = os.path.join(os.path.dirname(__file__), "extensions")
         if not os.path.isdir(ext_dir):
             return
@@ -457,8 +812,9 @@ class Navia(Gtk.Window):
                     spec.loader.exec_module(mod)
                     # Llamar setup si existe
                     if hasattr(mod, "setup"):
-                        api = type("API", (), {"window": self})()
+                        api = self.make_extension_api(nombre)
                         mod.setup(api)
+                        self.extension_apis[nombre] = api
                         print(f"[Extensiones] '{nombre}' cargada correctamente.")
                         self.loaded_extensions[nombre] = mod
                 # Cargar scripts JS si existen en manifest
@@ -475,23 +831,6 @@ class Navia(Gtk.Window):
             except Exception as e:
                 print(f"[Extensiones] Error cargando '{nombre}': {e}")
 
-        # Sugerencias como popup
-        self.suggest_popup = Gtk.Window(type=Gtk.WindowType.POPUP)
-        self.suggest_popup.set_decorated(False)
-        self.suggest_popup.set_transient_for(self)
-        self.suggest_popup.set_resizable(False)
-        self.suggest_popup.set_border_width(0)
-        self.suggest_list = Gtk.ListBox()
-        self.suggest_list.set_selection_mode(Gtk.SelectionMode.NONE)
-        self.suggest_popup.add(self.suggest_list)
-        self.suggest_popup.set_visible(False)
-
-        self.entry.connect("changed", self.on_entry_changed)
-        self.entry.connect("focus-out-event", self.hide_suggestions)
-        self.suggest_list.connect("row-activated", self.on_suggestion_clicked)
-
-        self.active_downloads = []
-
     def translate_page(self, widget):
         webview = self.get_current_webview()
         if not webview:
@@ -613,29 +952,55 @@ class Navia(Gtk.Window):
             })(%s);
         ''' % json.dumps(traducciones)
         GLib.idle_add(lambda: webview.run_javascript(js_replace, None, None))
-        # Forzar DuckDuckGo como página principal si no está configurada
-        if self.data.get("homepage", "") != "https://duckduckgo.com":
-            self.data["homepage"] = "https://duckduckgo.com"
-            save_data(self.data)
-
-        self.create_tab()
-
-        # Sugerencias como popup
-        self.suggest_popup = Gtk.Window(type=Gtk.WindowType.POPUP)
-        self.suggest_popup.set_decorated(False)
-        self.suggest_popup.set_transient_for(self)
-        self.suggest_popup.set_resizable(False)
-        self.suggest_popup.set_border_width(0)
-        self.suggest_list = Gtk.ListBox()
-        self.suggest_list.set_selection_mode(Gtk.SelectionMode.NONE)
-        self.suggest_popup.add(self.suggest_list)
-        self.suggest_popup.set_visible(False)
 
-        self.entry.connect("changed", self.on_entry_changed)
-        self.entry.connect("focus-out-event", self.hide_suggestions)
-        self.suggest_list.connect("row-activated", self.on_suggestion_clicked)
+    def configure_downloads(self):
+        self.downloads.configure(self.data.get("download_max_active", DEFAULT_MAX_ACTIVE),
+                                 self.data.get("download_per_host", DEFAULT_PER_HOST),
+                                 self.data.get("download_rate_kbps", 0) * 1024)
 
-        self.active_downloads = []
+    def track_webkit_download(self, download, decide_destination):
+        # Las descargas de WebKit también pasan por la cola (puede hacerlas esperar)
+        if self.downloads.find(download) is not None:
+            return
+        request = download.get_request()
+        url = request.get_uri() if request is not None else None
+        self.watch_webkit_download(download, decide_destination)
+        self.downloads.add_webkit(download, url, decide_destination)
+
+    def watch_webkit_download(self, download, decide_destination):
+        download.connect("decide-destination", decide_destination)
+        download.connect("received-data", lambda d, length: self.downloads.limiter.record(length))
+        download.connect("notify::estimated-progress", lambda d, pspec: self.on_downloads_changed())
+        download.connect("finished", self.downloads.finished)
+        download.connect("failed", lambda d, error: self.downloads.finished(d))
+
+    def restart_webkit_download(self, item):
+        # Una descarga de WebKit que esperaba en la cola: se pide de nuevo con las mismas cookies
+        download = self.web_contexts.context.download_uri(item.url)
+        self.watch_webkit_download(download, item.decide)
+        return download
+
+    def on_downloads_changed(self):
+        if self.download_window is not None:
+            self.download_window.update_progress()
+
+    def on_manual_download_progress(self, download):
+        # Llega de los hilos de la descarga por GLib.idle_add
+        if download.state == "paused":
+            self.downloads.paused(download)
+        elif download.state in ("done", "cancelled", "failed") and self.downloads.find(download) is not None:
+            self.downloads.finished(download)
+            if download.state == "done":
+                print(f"Descarga manual completada: {download.dest}")
+                self.mostrar_mensaje(f"Descarga completada: {download.filename}")
+            elif download.state == "cancelled":
+                self.mostrar_mensaje(f"Descarga cancelada: {download.filename}")
+            else:
+                print(f"Error en descarga manual: {download.error}")
+                self.mostrar_mensaje(f"Error al descargar: {download.error}")
+        if self.download_window is not None:
+            self.download_window.update_progress()
+        return False
 
     def open_downloads_window(self, widget):
         if not hasattr(self, 'download_window') or self.download_window is None:
@@ -673,17 +1038,19 @@ class Navia(Gtk.Window):
         url = self.entry.get_text()
         if not url.startswith("http"):
             url = "https://duckduckgo.com/?q=" + url.replace(" ", "+")
+        # La visita que resulte cuenta como escrita (más peso en la frecency)
+        self.tabs[self.current_tab_index][0].pending_transition = storage.TRANSITION_TYPED
         self.get_current_webview().load_uri(url)
-        # Guardar en historial si es diferente al último
-        if url:
-            history = self.data.get("history", [])
-            if not history or history[-1] != url:
-                history.append(url)
-                # Limitar historial a 100 entradas
-                if len(history) > 100:
-                    history = history[-100:]
-                self.data["history"] = history
-                save_data(self.data)
+
+    def record_visit(self, tab, uri, transition):
+        # Cada carga confirmada del marco principal es una visita (la escribe el hilo del almacén)
+        if uri and uri.startswith(("http:", "https:", "file:")):
+            self.store.add_visit(uri, transition)
+            self.local_suggestions.add_visit(uri, transition)
+
+    def record_title(self, uri, title):
+        self.store.set_title(uri, title)
+        self.local_suggestions.set_title(uri, title)
 
     def go_home(self, widget):
         homepage = self.data.get("homepage", "https://duckduckgo.com")
@@ -706,11 +1073,9 @@ class Navia(Gtk.Window):
         web = self.get_current_webview()
         uri = web.get_uri()
         if uri:
-            bookmarks = self.data.get("bookmarks", [])
-            if uri not in bookmarks:
-                bookmarks.append(uri)
-                self.data["bookmarks"] = bookmarks
-                save_data(self.data)
+            if not self.store.has_bookmark(uri):
+                self.store.add_bookmark(uri)
+                self.local_suggestions.add_bookmark(uri)
                 print(f"Favorito guardado: {uri}")
             else:
                 print("La página ya está en marcadores.")
@@ -769,6 +1134,11 @@ class Navia(Gtk.Window):
                 btn_restart = Gtk.Button(label="Reiniciar")
                 btn_restart.connect("clicked", self.restart_extension, ext)
                 hbox.pack_start(btn_restart, False, False, 0)
+                # Las extensiones que exponen estadísticas tienen su propia vista
+                if hasattr(self.extension_apis.get(ext), "stats_sections"):
+                    btn_stats = Gtk.Button(label="Estadísticas")
+                    btn_stats.connect("clicked", lambda w, e=ext: self.show_extension_stats(e))
+                    hbox.pack_start(btn_stats, False, False, 0)
                 vbox.pack_start(hbox, False, False, 0)
         else:
             vbox.pack_start(Gtk.Label(label="No se encontraron extensiones."), False, False, 0)
@@ -779,6 +1149,74 @@ class Navia(Gtk.Window):
         win.add(vbox)
         win.show_all()
 
+    def show_extension_stats(self, ext_name):
+        # Ventana con las estadísticas de una extensión; se refresca cada segundo
+        api = self.extension_apis.get(ext_name)
+        if api is None:
+            return
+        win = Gtk.Window(title=f"Estadísticas de {ext_name}")
+        win.set_default_size(560, 480)
+        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+        vbox.set_border_width(15)
+
+        controls = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
+        chk_enabled = Gtk.CheckButton(label="Registrar tiempos por petición")
+        if hasattr(api, "stats_enabled"):
+            chk_enabled.set_active(api.stats_enabled())
+        if hasattr(api, "stats_set_enabled"):
+            chk_enabled.connect("toggled", lambda w: api.stats_set_enabled(w.get_active()))
+        else:
+            chk_enabled.set_sensitive(False)
+        controls.pack_start(chk_enabled, True, True, 0)
+        if hasattr(api, "stats_reset"):
+            btn_reset = Gtk.Button(label="Reiniciar contadores")
+            btn_reset.connect("clicked", lambda w: (api.stats_reset(), refresh()))
+            controls.pack_start(btn_reset, False, False, 0)
+        vbox.pack_start(controls, False, False, 0)
+
+        grid = Gtk.Grid(column_spacing=20, row_spacing=4)
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.add(grid)
+        vbox.pack_start(scrolled, True, True, 0)
+
+        def refresh():
+            for child in grid.get_children():
+                grid.remove(child)
+            row = 0
+            try:
+                sections = api.stats_sections()
+            except Exception as e:
+                print(f"[Extensiones] Error leyendo estadísticas de '{ext_name}': {e}")
+                sections = []
+            for title, rows in sections:
+                header = Gtk.Label()
+                header.set_markup(f"<b>{GLib.markup_escape_text(title)}</b>")
+                header.set_xalign(0)
+                grid.attach(header, 0, row, 2, 1)
+                row += 1
+                for name, value in rows:
+                    name_lbl = Gtk.Label(label=name)
+                    name_lbl.set_xalign(0)
+                    name_lbl.set_ellipsize(Pango.EllipsizeMode.MIDDLE)
+                    name_lbl.set_max_width_chars(60)
+                    value_lbl = Gtk.Label(label=value)
+                    value_lbl.set_xalign(1)
+                    grid.attach(name_lbl, 0, row, 1, 1)
+                    grid.attach(value_lbl, 1, row, 1, 1)
+                    row += 1
+            grid.show_all()
+            return True
+
+        refresh()
+        timer = GLib.timeout_add(1000, refresh)
+        win.connect("destroy", lambda w: GLib.source_remove(timer))
+
+        btn_close = Gtk.Button(label="Cerrar")
+        btn_close.connect("clicked", lambda w: win.destroy())
+        vbox.pack_end(btn_close, False, False, 0)
+        win.add(vbox)
+        win.show_all()
+
     def toggle_extension(self, widget, ext_name):
         # Cambia el estado de la extensión (activar/suspender) en tiempo real
         estado = self.extensions_state.get(ext_name, True)
@@ -819,8 +1257,9 @@ class Navia(Gtk.Window):
                 mod = importlib.util.module_from_spec(spec)
                 spec.loader.exec_module(mod)
                 if hasattr(mod, "setup"):
-                    api = type("API", (), {"window": self})()
+                    api = self.make_extension_api(nombre)
                     mod.setup(api)
+                    self.extension_apis[nombre] = api
                     print(f"[Extensiones] '{nombre}' activada en tiempo real.")
                 self.loaded_extensions[nombre] = mod
             for script in manifest.get("content_scripts", []):
@@ -840,6 +1279,8 @@ class Navia(Gtk.Window):
         # Descarga la extensión si es posible (solo elimina referencia, no descarga JS)
         if hasattr(self, "loaded_extensions") and nombre in self.loaded_extensions:
             del self.loaded_extensions[nombre]
+            self.extension_apis.pop(nombre, None)
+            self.webview_hooks.pop(nombre, None)
             print(f"[Extensiones] '{nombre}' suspendida en tiempo real.")
 
     def restart_extension(self, widget, ext_name):
@@ -866,75 +1307,93 @@ class Navia(Gtk.Window):
             try:
                 with open(state_path, "r") as f:
                     self.extensions_state = json.load(f)
-            except Exception:
+            except Exception as e:
+                print(f"[Extensiones] No se pudo leer {state_path}: {e}")
                 self.extensions_state = {}
         else:
             self.extensions_state = {}
 
     def save_extensions_state(self):
-        # Guarda el estado de las extensiones en un archivo
+        # Guarda el estado de las extensiones en un archivo (en segundo plano y de golpe)
         state_path = os.path.join(os.path.dirname(__file__), "extensions_state.json")
-        try:
-            with open(state_path, "w") as f:
-                json.dump(self.extensions_state, f)
-        except Exception:
-            pass
+        self.writer.write_json(state_path, self.extensions_state)
 
     def show_history(self, widget):
-        dialog = Gtk.Dialog(title="Historial", transient_for=self, flags=0)
-        dialog.set_default_size(500, 350)
-        dialog.add_button("Cerrar", Gtk.ResponseType.CLOSE)
-        box = dialog.get_content_area()
-        listbox = Gtk.ListBox()
-        box.pack_start(listbox, True, True, 0)
-        history = self.data.get("history", [])
-        if not history:
-            listbox.add(Gtk.Label(label="No hay historial."))
-        else:
-            for url in history:
-                row = Gtk.ListBoxRow()
-                hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-                lbl = Gtk.Label(label=url, xalign=0)
-                hbox.pack_start(lbl, True, True, 0)
-                row.add(hbox)
-                listbox.add(row)
-        listbox.show_all()
-
-        def on_row_activated(listbox, row):
-            if row:
-                url = row.get_child().get_children()[0].get_text()
-                self.load_url_from_history_or_bookmark(url)
-                dialog.response(Gtk.ResponseType.CLOSE)
-        listbox.connect("row-activated", on_row_activated)
-        dialog.run()
-        dialog.destroy()
+        self.show_url_list("Historial", self.store.history_page, "No hay historial.")
 
     def show_bookmarks(self, widget):
-        dialog = Gtk.Dialog(title="Marcadores", transient_for=self, flags=0)
-        dialog.set_default_size(500, 350)
+        self.show_url_list("Marcadores", self.store.bookmarks_page, "No hay marcadores.")
+
+    def show_url_list(self, title, fetch_page, empty_text):
+        # fetch_page(texto, desde, cuántas) -> [(url, título, fecha)]. La lista
+        # se rellena por páginas al acercarse al final y el TreeView solo
+        # dibuja las filas visibles, así que abrir no depende del tamaño.
+        dialog = Gtk.Dialog(title=title, transient_for=self, flags=0)
+        dialog.set_default_size(650, 420)
         dialog.add_button("Cerrar", Gtk.ResponseType.CLOSE)
         box = dialog.get_content_area()
-        listbox = Gtk.ListBox()
-        box.pack_start(listbox, True, True, 0)
-        bookmarks = self.data.get("bookmarks", [])
-        if not bookmarks:
-            listbox.add(Gtk.Label(label="No hay marcadores."))
-        else:
-            for url in bookmarks:
-                row = Gtk.ListBoxRow()
-                hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-                lbl = Gtk.Label(label=url, xalign=0)
-                hbox.pack_start(lbl, True, True, 0)
-                row.add(hbox)
-                listbox.add(row)
-        listbox.show_all()
-
-        def on_row_activated(listbox, row):
-            if row:
-                url = row.get_child().get_children()[0].get_text()
-                self.load_url_from_history_or_bookmark(url)
-                dialog.response(Gtk.ResponseType.CLOSE)
-        listbox.connect("row-activated", on_row_activated)
+        search = Gtk.SearchEntry()
+        search.set_placeholder_text("Buscar por dirección o título")
+        box.pack_start(search, False, False, 4)
+
+        model = Gtk.ListStore(str, str, str)   # título, URL, fecha
+        view = Gtk.TreeView(model=model)
+        view.set_headers_visible(False)
+        view.set_enable_search(False)
+        for i, expand in ((0, True), (1, True), (2, False)):
+            renderer = Gtk.CellRendererText(ellipsize=Pango.EllipsizeMode.END)
+            column = Gtk.TreeViewColumn(None, renderer, text=i)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(250 if expand else 130)
+            column.set_expand(expand)
+            view.append_column(column)
+        view.set_fixed_height_mode(True)   # no mide cada fila para saber la altura
+        scroller = Gtk.ScrolledWindow()
+        scroller.add(view)
+        box.pack_start(scroller, True, True, 0)
+        empty = Gtk.Label(label=empty_text)
+        box.pack_start(empty, False, False, 8)
+
+        state = {"text": "", "loaded": 0, "done": False}
+
+        def load_more():
+            rows = fetch_page(state["text"], state["loaded"], URL_LIST_PAGE)
+            for url, page_title, when in rows:
+                model.append([page_title or url, url,
+                              time.strftime("%d/%m/%Y %H:%M", time.localtime(when)) if when else ""])
+            state["loaded"] += len(rows)
+            state["done"] = len(rows) < URL_LIST_PAGE
+
+        def reload(*args):
+            state.update(text=search.get_text(), loaded=0, done=False)
+            model.clear()
+            load_more()
+            empty.set_visible(state["loaded"] == 0)
+
+        def on_scroll(adjustment):
+            # Otra página cuando falta menos de una pantalla para el final
+            remaining = adjustment.get_upper() - adjustment.get_value() - adjustment.get_page_size()
+            if not state["done"] and remaining < adjustment.get_page_size():
+                load_more()
+
+        def on_row_activated(view, path, column):
+            url = model[path][1]
+            self.load_url_from_history_or_bookmark(url)
+            dialog.response(Gtk.ResponseType.CLOSE)
+
+        def refresh():
+            # Lo que aún estaba en la cola del escritor (la visita de ahora
+            # mismo) ya está confirmado; se recarga si no se ha pasado de página
+            if state["loaded"] <= URL_LIST_PAGE and dialog.get_visible():
+                reload()
+            return False
+
+        scroller.get_vadjustment().connect("value-changed", on_scroll)
+        search.connect("search-changed", reload)   # ya espera a que se deje de escribir
+        view.connect("row-activated", on_row_activated)
+        box.show_all()
+        reload()
+        self.store.after_writes(lambda: GLib.idle_add(refresh))
         dialog.run()
         dialog.destroy()
 
@@ -1044,8 +1503,43 @@ class Navia(Gtk.Window):
         page_downloads.pack_start(lbl_mode, False, False, 5)
         page_downloads.pack_start(radio_ask, False, False, 0)
         page_downloads.pack_start(radio_auto, False, False, 0)
+
+        # Límites de la cola de descargas
+        grid_limits = Gtk.Grid(column_spacing=10, row_spacing=5)
+        spin_active = Gtk.SpinButton.new_with_range(1, 20, 1)
+        spin_active.set_value(self.data.get("download_max_active", DEFAULT_MAX_ACTIVE))
+        spin_host = Gtk.SpinButton.new_with_range(0, 20, 1)
+        spin_host.set_value(self.data.get("download_per_host", DEFAULT_PER_HOST))
+        spin_rate = Gtk.SpinButton.new_with_range(0, 1000000, 100)
+        spin_rate.set_value(self.data.get("download_rate_kbps", 0))
+        limits = (("Descargas a la vez:", spin_active),
+                  ("Del mismo servidor (0 = sin límite):", spin_host),
+                  ("Velocidad máxima en KB/s (0 = sin límite):", spin_rate))
+        for row, (text, spin) in enumerate(limits):
+            grid_limits.attach(Gtk.Label(label=text, xalign=0), 0, row, 1, 1)
+            grid_limits.attach(spin, 1, row, 1, 1)
+        page_downloads.pack_start(grid_limits, False, False, 5)
         notebook.append_page(page_downloads, Gtk.Label(label="Descargas"))
 
+        # --- Pestaña Rendimiento ---
+        page_perf = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+        page_perf.set_border_width(10)
+        lbl_profile = Gtk.Label(label="Pestañas y memoria:")
+        combo_profile = Gtk.ComboBoxText()
+        profile_labels = {
+            "rendimiento": "Rendimiento (un proceso por sitio, más memoria)",
+            "equilibrado": "Equilibrado",
+            "memoria": "Ahorro de memoria (procesos compartidos, caches pequeñas)",
+        }
+        for key in WEB_PROFILES:
+            combo_profile.append(key, profile_labels.get(key, key))
+        combo_profile.set_active_id(self.data.get("web_profile", DEFAULT_WEB_PROFILE))
+        lbl_profile_note = Gtk.Label(label="El reparto de procesos se aplica al reiniciar el navegador.")
+        page_perf.pack_start(lbl_profile, False, False, 5)
+        page_perf.pack_start(combo_profile, False, False, 5)
+        page_perf.pack_start(lbl_profile_note, False, False, 5)
+        notebook.append_page(page_perf, Gtk.Label(label="Rendimiento"))
+
         box.show_all()
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
@@ -1053,18 +1547,27 @@ class Navia(Gtk.Window):
             self.data["proxy"] = entry_proxy.get_text()
             self.data["download_path"] = entry_path.get_text()
             self.data["download_mode"] = "auto" if radio_auto.get_active() else "ask"
-            save_data(self.data)
+            self.data["download_max_active"] = spin_active.get_value_as_int()
+            self.data["download_per_host"] = spin_host.get_value_as_int()
+            self.data["download_rate_kbps"] = spin_rate.get_value_as_int()
+            self.data["web_profile"] = combo_profile.get_active_id() or DEFAULT_WEB_PROFILE
+            self.store.save_settings(self.data)
+            # El proxy y el modelo de cache se pueden cambiar en caliente
+            self.web_contexts.set_proxy(self.data["proxy"])
+            profile = WEB_PROFILES[self.data["web_profile"]]
+            self.web_contexts.set_cache_model(self.data.get("web_cache_model", profile["cache_model"]))
+            self.configure_downloads()
             print("Ajustes guardados")
         dialog.destroy()
 
     def clear_history(self, widget):
-        self.data["history"] = []
-        save_data(self.data)
+        self.store.clear_history()
+        self.local_suggestions.clear_history()
         print("Historial limpiado")
 
     def clear_bookmarks(self, widget):
-        self.data["bookmarks"] = []
-        save_data(self.data)
+        self.store.clear_bookmarks()
+        self.local_suggestions.clear_bookmarks()
         print("Marcadores limpiados")
 
     def show_about(self, widget):
@@ -1094,10 +1597,15 @@ class Navia(Gtk.Window):
 
 
 
-    def create_tab(self, widget=None, url=None):
+    def create_tab(self, widget=None, url=None, background=False, title=None, session_state=None,
+                   session_id=None):
+        # background: la pestaña se queda en reposo (sin WebView) hasta que se seleccione
         if url is None:
             url = self.data.get("homepage", "https://duckduckgo.com")
-        tab = BrowserTab(self, url)
+        tab = BrowserTab(self, url, lazy=background, title=title, session_state=session_state)
+        tab.session_id = session_id if session_id is not None else self.next_session_id
+        self.next_session_id = max(self.next_session_id, tab.session_id + 1)
+        self.write_session(self.session.tab, tab.session_id, tab.get_uri(), tab.get_title())
 
         # Contenedor de la pestaña (tipo Chrome)
         tab_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=0)
@@ -1115,7 +1623,20 @@ class Navia(Gtk.Window):
         tab_label.set_margin_start(4)
         tab_label.set_margin_end(4)
         tab_label.get_style_context().add_class("chrome-tab-label")
-        tab_box.pack_start(tab_label, True, True, 0)
+        # Un Gtk.Box no tiene ventana propia: el clic lo recoge un EventBox
+        label_events = Gtk.EventBox()
+        label_events.set_visible_window(False)
+        label_events.add(tab_label)
+        tab_box.pack_start(label_events, True, True, 0)
+        tab.label = tab_label
+        self.update_tab_label(tab_label, tab)
+
+        def on_label_pressed(widget, event):
+            if event.button != 1:
+                return False
+            self.select_tab([t for t, _, _ in self.tabs].index(tab))
+            return True
+        label_events.connect("button-press-event", on_label_pressed)
 
         # Botón cerrar
         btn_close = Gtk.Button()
@@ -1148,60 +1669,129 @@ class Navia(Gtk.Window):
         else:
             self.tabs_bar.pack_start(tab_box, False, False, 0)
         self.tabs.append((tab, tab_box, tab_box))
-        self.tabs_bar.show_all()
+        tab_box.show_all()
+        tab.show()
+        self.tab_content.add(tab)
 
         # Seleccionar la nueva pestaña
-        self.select_tab(len(self.tabs) - 1)
-
-        tab.webview.connect("notify::title", lambda webview, _: self.update_tab_label(tab_label, webview))
-        tab.webview.connect("notify::uri", self.update_url_entry)
-        self.show_all()
+        if not background:
+            self.select_tab(len(self.tabs) - 1)
+            self.show_all()
 
     def remove_tab(self, idx):
         if idx < 0 or idx >= len(self.tabs):
             return
         tab, tab_box, _ = self.tabs.pop(idx)
         self.tabs_bar.remove(tab_box)
-        if tab in self.tab_content.get_children():
+        if tab.get_parent() is self.tab_content:
             self.tab_content.remove(tab)
         # Destruir el WebView para detener audio/video
         if hasattr(tab, 'webview') and tab.webview:
             tab.webview.destroy()
+        self.session_dirty.discard(tab)
+        self.write_session(self.session.close_tab, tab.session_id)
+        if self.active_tab is not None and self.active_tab[0] is not tab:
+            # Se cerró una pestaña de fondo: la visible sigue siéndolo
+            self.current_tab_index = [t for t, _, _ in self.tabs].index(self.active_tab[0])
+            return
+        self.active_tab = None
         # Seleccionar otra pestaña si quedan
         if self.tabs:
             new_idx = min(idx, len(self.tabs) - 1)
             self.select_tab(new_idx)
         else:
             self.current_tab_index = -1
-            for child in self.tab_content.get_children():
-                self.tab_content.remove(child)
 
     def select_tab(self, idx):
         if idx < 0 or idx >= len(self.tabs):
             return
+        now = time.monotonic()
+        tab, tab_box, _ = self.tabs[idx]
+        previous = self.active_tab
         self.current_tab_index = idx
-        for child in self.tab_content.get_children():
-            self.tab_content.remove(child)
-        self.tab_content.pack_start(self.tabs[idx][0], True, True, 0)
-        self.tab_content.show_all()
-        # Resaltar la pestaña activa
-        for i, (_, tab_box, _) in enumerate(self.tabs):
-            if i == idx:
-                tab_box.get_style_context().add_class("active-tab")
-            else:
-                tab_box.get_style_context().remove_class("active-tab")
+        self.active_tab = (tab, tab_box)
+        tab.last_active = now
+        tab.ensure_webview()
+        self.tab_content.set_visible_child(tab)
+        self.write_session(self.session.set_current, tab.session_id)
+        if previous is not None and previous[0] is tab:
+            return
+        # Resaltar la pestaña activa: solo cambian la anterior y la nueva
+        if previous is not None:
+            previous[0].last_active = now
+            previous[1].get_style_context().remove_class("active-tab")
+        tab_box.get_style_context().add_class("active-tab")
+
+    def restore_session(self):
+        # Reabre las pestañas del diario de sesión; solo la actual crea su WebView
+        try:
+            saved, current = self.session.load()
+        except OSError as e:
+            print(f"[Sesión] No se pudo leer la sesión: {e}")
+            return False
+        self.next_session_id = self.session.next_id()
+        if not self.data.get("restore_session", True):
+            for saved_tab in saved:
+                self.write_session(self.session.close_tab, saved_tab.id)
+            return False
+        if not saved:
+            return False
+        selected = 0
+        for i, saved_tab in enumerate(saved):
+            state = GLib.Bytes.new(saved_tab.state) if saved_tab.state else None
+            self.create_tab(url=saved_tab.url or None, background=True, title=saved_tab.title or None,
+                            session_state=state, session_id=saved_tab.id)
+            if saved_tab.id == current:
+                selected = i
+        self.select_tab(selected)
+        self.show_all()
+        print(f"[Sesión] {len(saved)} pestaña(s) restaurada(s).")
+        return True
 
-    # Ya no se usa on_tab_selected, ahora se selecciona con select_tab
+    def write_session(self, method, *args):
+        # El diario lo escribe self.writer, en el mismo orden en que se pide
+        self.writer.call(self._write_session, method, args)
 
-    # Manejar clic en la barra de pestañas para cambiar de pestaña
-    def connect_tab_bar_events(self):
-        def on_tab_box_event(tab_box, event):
-            if event.type == Gdk.EventType.BUTTON_PRESS:
-                idx = self.tabs_bar.get_children().index(tab_box)
-                self.select_tab(idx)
-        for _, tab_box, _ in self.tabs:
-            tab_box.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
-            tab_box.connect("button-press-event", on_tab_box_event)
+    @staticmethod
+    def _write_session(method, args):
+        try:
+            method(*args)
+        except OSError as e:
+            print(f"[Sesión] Error escribiendo la sesión: {e}")
+
+    def mark_session_dirty(self, tab):
+        self.session_dirty.add(tab)
+        if not self.session_flush_id:
+            self.session_flush_id = GLib.timeout_add(SESSION_FLUSH_MS, self.flush_session)
+
+    def flush_session(self):
+        # Escribe en el diario lo que cambió de cada pestaña desde la última vez
+        self.session_flush_id = 0
+        dirty, self.session_dirty = self.session_dirty, set()
+        for tab in dirty:
+            self.write_session(self.session.tab, tab.session_id, tab.get_uri(), tab.get_title())
+            self.write_session(self.session.state, tab.session_id, tab.get_session_bytes())
+        return False
+
+    def discard_background_tabs(self):
+        # Descarta las pestañas de fondo sin usar desde hace un rato y, si la
+        # memoria pasa del límite, la usada hace más tiempo
+        idle = self.data.get("tab_discard_minutes", TAB_DISCARD_MINUTES) * 60
+        limit_mb = self.data.get("tab_memory_limit_mb", TAB_MEMORY_LIMIT_MB)
+        now = time.monotonic()
+        background = [tab for i, (tab, _, _) in enumerate(self.tabs)
+                      if i != self.current_tab_index and tab.can_discard()]
+        for tab in background:
+            if idle and now - tab.last_active >= idle and tab.discard():
+                print(f"[Pestañas] Descartada por inactividad: {tab.get_uri()}")
+        if limit_mb:
+            rss_mb = process_tree_rss_mb()
+            live = sorted((tab for tab in background if tab.webview is not None),
+                          key=lambda tab: tab.last_active)
+            # Una por vez: la memoria de un proceso web tarda en liberarse
+            if rss_mb > limit_mb and live and live[0].discard():
+                print(f"[Pestañas] {rss_mb:.0f} MB > {limit_mb} MB, descartada: {live[0].get_uri()}")
+        return True
 
     def update_tab_label(self, label, webview):
         max_len = 18
@@ -1226,26 +1816,18 @@ class Navia(Gtk.Window):
             uri = webview.get_uri()
             if uri:
                 self.entry.set_text(uri)
-                # Guardar en historial si es diferente al último
-                history = self.data.get("history", [])
-        icon_path = os.path.join(os.path.dirname(__file__), "icons", "icon.png")
-        self.set_icon_from_file(icon_path)
-        if not history or history[-1] != uri:
-                    history.append(uri)
-                    # Limitar historial a 100 entradas
-                    if len(history) > 100:
-                        history = history[-100:]
-                    self.data["history"] = history
-                    save_data(self.data)
 
     def on_destroy(self, widget):
         # Guardar el último tamaño conocido
         width, height = self._last_size
-        try:
-            with open(CONFIG_FILE, "w") as f:
-                json.dump({"width": width, "height": height}, f)
-        except Exception as e:
-            print(f"Error guardando tamaño de ventana: {e}")
+        self.writer.write_json(CONFIG_FILE, {"width": width, "height": height})
+        # Lo pendiente de la sesión, para reabrir las pestañas al volver
+        if self.session_flush_id:
+            GLib.source_remove(self.session_flush_id)
+        self.flush_session()
+        self.write_session(self.session.close)
+        self.writer.close()  # escribe todo lo pendiente antes de salir
+        self.store.close()
         Gtk.main_quit()
 
     def on_configure_event(self, widget, event):
@@ -1266,49 +1848,73 @@ class Navia(Gtk.Window):
             return 1024, 720
 
     def on_entry_changed(self, entry, *args):
+        self.suggest_version += 1
+        version = self.suggest_version
+        if self.suggest_timer:
+            GLib.source_remove(self.suggest_timer)
+            self.suggest_timer = 0
         # Solo mostrar sugerencias si el entry tiene el foco
-        if not entry.is_focus():
-            self.hide_suggestions()
-            return
         text = entry.get_text().strip()
-        if not text:
-            self.hide_suggestions()
+        if not entry.is_focus() or not text:
+            self.remote_suggestions.cancel(version)
+            self.suggest_popup.set_visible(False)
             return
+        # Primero el historial y los marcadores, sin red ni disco
+        self.suggest_local = self.local_suggestions.search(text, SUGGEST_LOCAL_LIMIT)
+        remote = self.remote_suggestions.cached(text)
+        self.show_suggestions(version, self.suggest_local, remote or [])
+        if remote is None:
+            # Las remotas solo cuando se deja de escribir un momento
+            self.suggest_timer = GLib.timeout_add(SUGGEST_DEBOUNCE_MS, self.request_remote_suggestions,
+                                                  version, text)
+
+    def request_remote_suggestions(self, version, text):
+        self.suggest_timer = 0
+        self.remote_suggestions.request(
+            version, text, lambda v, remote: GLib.idle_add(self.on_remote_suggestions, v, remote))
+        return False
 
-        def fetch_suggestions():
-            try:
-                res = requests.get(f"https://duckduckgo.com/ac/?q={requests.utils.quote(text)}", timeout=2)
-                data = res.json()
-                GLib.idle_add(self.show_suggestions, data)
-            except Exception:
-                GLib.idle_add(self.hide_suggestions)
-
-        threading.Thread(target=fetch_suggestions, daemon=True).start()
+    def on_remote_suggestions(self, version, remote):
+        self.show_suggestions(version, self.suggest_local, remote)
+        return False
 
-    def show_suggestions(self, data):
+    def show_suggestions(self, version, local, remote):
+        # Respuestas de una consulta ya superada no se pintan
+        if version != self.suggest_version:
+            return
+        targets = {item.target for item in local}
+        items = list(local) + [item for item in remote if item.target not in targets][:SUGGEST_REMOTE_LIMIT]
         self.suggest_list.foreach(lambda row: self.suggest_list.remove(row))
-        if not isinstance(data, list) or not data:
-            self.hide_suggestions()
+        self.suggest_items = items
+        if not items:
+            self.suggest_popup.set_visible(False)
             return
-        for item in data:
-            phrase = item.get("phrase")
-            if phrase:
-                row = Gtk.ListBoxRow()
-                label = Gtk.Label(label=phrase, xalign=0)
-                row.add(label)
-                self.suggest_list.add(row)
+        for item in items:
+            row = Gtk.ListBoxRow()
+            text = item.text if item.kind == "search" else f"{item.text} — {item.target}"
+            label = Gtk.Label(label=text, xalign=0)
+            label.set_ellipsize(Pango.EllipsizeMode.END)
+            row.add(label)
+            self.suggest_list.add(row)
         self.suggest_list.show_all()
         self.position_suggestions()
         self.suggest_popup.set_visible(True)
 
     def on_suggestion_clicked(self, listbox, row):
-        phrase = row.get_child().get_text()
-        self.entry.set_text(phrase)
+        item = self.suggest_items[row.get_index()]
+        self.entry.set_text(item.target)
         self.hide_suggestions()
         self.load_url()
 
     def hide_suggestions(self, *args):
+        # Lo que llegue después de cerrar la lista ya no se enseña
+        self.suggest_version += 1
+        self.remote_suggestions.cancel(self.suggest_version)
+        if self.suggest_timer:
+            GLib.source_remove(self.suggest_timer)
+            self.suggest_timer = 0
         self.suggest_popup.set_visible(False)
+        return False
 
     def position_suggestions(self):
         # Posiciona el popup justo debajo del Gtk.Entry
@@ -0,0 +1,207 @@
+# omnibox.py
+"""
+Sugerencias de la barra de direcciones.
+
+Dos proveedores:
+
+- LocalIndex: historial y marcadores en memoria, ordenados por clave para
+  buscar por prefijo con bisect (la URL sin esquema ni "www." y cada
+  palabra del título). Se carga una vez del almacén y luego se actualiza
+  con cada visita, sin tocar el disco al escribir.
+- RemoteSuggester: las sugerencias de DuckDuckGo, con una sola
+  requests.Session (conexiones reutilizadas), una cache LRU por consulta
+  y un único hilo que solo atiende la última consulta pedida; lo que
+  llega de una consulta ya superada no se entrega.
+
+El que pinta (main.py) numera cada consulta (versión) y descarta los
+resultados que no sean de la última.
+"""
+import heapq
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+import storage
+
+LOCAL_LIMIT = 20000        # URLs del historial que se cargan (las de más frecency)
+BOOKMARK_BONUS = 5.0       # puntos extra de un marcador frente al historial
+REMOTE_URL = "https://duckduckgo.com/ac/"
+REMOTE_CACHE_SIZE = 128
+REMOTE_TIMEOUT = 2
+
+
+class Suggestion:
+    """Una sugerencia: qué se enseña y qué se carga al elegirla."""
+
+    __slots__ = ("kind", "text", "target")
+
+    def __init__(self, kind, text, target):
+        self.kind = kind       # "history", "bookmark" o "search"
+        self.text = text
+        self.target = target   # URL o texto de búsqueda
+
+    def __repr__(self):
+        return f"Suggestion({self.kind!r}, {self.target!r})"
+
+
+class LocalIndex:
+    """Índice de prefijos del historial y los marcadores (hilo de GTK)."""
+
+    def __init__(self):
+        self.keys = []        # (clave, url) ordenado
+        self.entries = {}     # url -> [título, puntos, es_marcador]
+
+    def load(self, store, limit=LOCAL_LIMIT):
+        entries = {url: [title, score, False] for url, title, score in store.top_urls(limit)}
+        for url in store.bookmarks():
+            entry = entries.setdefault(url, [None, 0.0, False])
+            entry[2] = True
+        self.entries = entries
+        self.keys = sorted((key, url) for url, entry in entries.items()
+                           for key in self._keys(url, entry[0]))
+
+    @staticmethod
+    def _keys(url, title):
+        keys = {storage.url_key(url)}
+        if title:
+            keys.update(word for word in title.lower().split() if len(word) > 1)
+        return keys
+
+    def _reindex(self, url, old_title, new_title):
+        old = self._keys(url, old_title)
+        new = self._keys(url, new_title)
+        for key in old - new:
+            i = bisect_left(self.keys, (key, url))
+            if i < len(self.keys) and self.keys[i] == (key, url):
+                del self.keys[i]
+        for key in new - old:
+            insort(self.keys, (key, url))
+
+    def add_visit(self, url, transition):
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = self.entries[url] = [None, 0.0, False]
+            for key in self._keys(url, None):
+                insort(self.keys, (key, url))
+        entry[1] += storage.TRANSITION_WEIGHTS.get(transition, 1.0)
+
+    def set_title(self, url, title):
+        entry = self.entries.get(url)
+        if entry is None or entry[0] == title:
+            return
+        self._reindex(url, entry[0], title)
+        entry[0] = title
+
+    def add_bookmark(self, url):
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = self.entries[url] = [None, 0.0, False]
+            for key in self._keys(url, None):
+                insort(self.keys, (key, url))
+        entry[2] = True
+
+    def clear_history(self):
+        # Solo quedan los marcadores
+        self.entries = {url: [entry[0], 0.0, True] for url, entry in self.entries.items() if entry[2]}
+        self.keys = sorted((key, url) for url, entry in self.entries.items()
+                           for key in self._keys(url, entry[0]))
+
+    def clear_bookmarks(self):
+        for url, entry in list(self.entries.items()):
+            entry[2] = False
+
+    def search(self, text, limit=6):
+        """Las 'limit' URLs con alguna clave que empieza por 'text', por puntos."""
+        text = text.strip().lower()
+        if not text:
+            return []
+        prefixes = {storage.url_key(text)}
+        if " " not in text:
+            prefixes.add(text)
+        found = set()
+        for prefix in prefixes:
+            i = bisect_left(self.keys, (prefix, ""))
+            while i < len(self.keys) and self.keys[i][0].startswith(prefix):
+                found.add(self.keys[i][1])
+                i += 1
+
+        def score(url):
+            entry = self.entries[url]
+            return entry[1] + (BOOKMARK_BONUS if entry[2] else 0.0)
+        best = heapq.nlargest(limit, found, key=score)
+        return [Suggestion("bookmark" if self.entries[url][2] else "history",
+                           self.entries[url][0] or url, url) for url in best]
+
+
+class RemoteSuggester:
+    """
+    Sugerencias remotas. request(version, text, callback) sustituye a la
+    consulta pendiente; callback(version, sugerencias) se llama desde el
+    hilo de trabajo (quien pinta lo pasa al de GTK).
+    """
+
+    def __init__(self, url=REMOTE_URL, cache_size=REMOTE_CACHE_SIZE, timeout=REMOTE_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.session = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = None      # (versión, texto, callback) de la última consulta
+        self._latest = 0          # versión de la última consulta pedida
+        self._thread = None
+
+    def cached(self, text):
+        with self._lock:
+            result = self.cache.get(text)
+            if result is not None:
+                self.cache.move_to_end(text)
+            return result
+
+    def request(self, version, text, callback):
+        with self._lock:
+            self._latest = version
+            self._pending = (version, text, callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="navia-suggest", daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def cancel(self, version):
+        """Olvida lo pendiente: nada anterior a 'version' se entregará."""
+        with self._lock:
+            self._latest = version
+            self._pending = None
+
+    def _fetch(self, text):
+        import requests
+        if self.session is None:
+            self.session = requests.Session()
+        res = self.session.get(self.url, params={"q": text}, timeout=self.timeout)
+        data = res.json()
+        phrases = [item.get("phrase") for item in data if isinstance(item, dict)] if isinstance(data, list) else []
+        return [Suggestion("search", phrase, phrase) for phrase in phrases if phrase]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._pending is None:
+                    self._wakeup.wait()
+                version, text, callback = self._pending
+                self._pending = None
+                result = self.cache.get(text)
+            if result is None:
+                try:
+                    result = self._fetch(text)
+                except Exception:
+                    result = None
+                if result is not None:
+                    with self._lock:
+                        self.cache[text] = result
+                        if len(self.cache) > self.cache_size:
+                            self.cache.popitem(last=False)
+            with self._lock:
+                stale = version != self._latest
+            if not stale:
+                callback(version, result or [])
@@ -0,0 +1,123 @@
+# persist.py
+"""
+Escritura del estado del navegador fuera del hilo de GTK.
+
+Un solo hilo (PersistWriter) hace todo lo que antes se escribía en el
+hilo de GTK: los JSON de la ventana y de las extensiones y el diario de
+sesión. Lo que llega en ráfaga se junta: después de la primera petición
+espera WRITE_INTERVAL segundos y entonces escribe de una vez todo lo
+pendiente. De cada archivo solo se escribe lo último que se pidió; las
+llamadas (call) se hacen todas y en orden.
+
+Los archivos se escriben con write_atomic: un temporal en la misma
+carpeta, fsync y os.replace, así que un cierre brusco deja el archivo
+anterior o el nuevo, nunca uno a medias. flush() y close() no esperan al
+intervalo.
+"""
+import json
+import os
+import threading
+import time
+
+WRITE_INTERVAL = 0.5   # segundos que se esperan para juntar una ráfaga
+
+
+def write_atomic(path, data):
+    """Sustituye el archivo por 'data' (bytes) de golpe."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # Que el cambio de nombre también llegue al disco
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+class PersistWriter:
+    """Hilo que escribe archivos y hace llamadas de escritura por el hilo de GTK."""
+
+    def __init__(self, interval=WRITE_INTERVAL):
+        self.interval = interval
+        self.requested = 0    # archivos pedidos
+        self.written = 0      # archivos escritos de verdad (el resto se juntó)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._files = {}      # ruta -> bytes (solo lo último)
+        self._calls = []      # (función, argumentos), en orden
+        self._flushes = []    # threading.Event de quien espera en flush()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="navia-persist", daemon=True)
+        self._thread.start()
+
+    def write_json(self, path, data):
+        # Se serializa aquí: 'data' puede cambiar antes de que se escriba
+        self.write_bytes(path, json.dumps(data).encode("utf-8"))
+
+    def write_bytes(self, path, data):
+        with self._lock:
+            self.requested += 1
+            self._files[path] = data
+            self._wakeup.notify()
+
+    def call(self, fn, *args):
+        """fn(*args) en el hilo de escritura, después de las llamadas anteriores."""
+        with self._lock:
+            self._calls.append((fn, args))
+            self._wakeup.notify()
+
+    def flush(self, timeout=5):
+        """Escribe ya lo pendiente y espera a que esté hecho."""
+        event = threading.Event()
+        with self._lock:
+            self._flushes.append(event)
+            self._wakeup.notify()
+        return event.wait(timeout)
+
+    def close(self, timeout=10):
+        with self._lock:
+            self._closing = True
+            self._wakeup.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not (self._files or self._calls or self._flushes or self._closing):
+                    self._wakeup.wait()
+                deadline = time.monotonic() + self.interval
+                while not (self._flushes or self._closing):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+                files, self._files = self._files, {}
+                calls, self._calls = self._calls, []
+                flushes, self._flushes = self._flushes, []
+                closing = self._closing
+            for fn, args in calls:
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print(f"[Datos] Error en una escritura en segundo plano: {e}")
+            for path, data in files.items():
+                try:
+                    write_atomic(path, data)
+                    self.written += 1
+                except OSError as e:
+                    print(f"[Datos] Error guardando {path}: {e}")
+            for event in flushes:
+                event.set()
+            if closing:
+                with self._lock:
+                    if not (self._files or self._calls or self._flushes):
+                        return
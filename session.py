@@ -0,0 +1,237 @@
+# session.py
+"""
+Diario binario de la sesión: pestañas abiertas, pestaña actual e historial
+de atrás/adelante de cada una (WebKitWebViewSessionState serializado).
+
+El archivo empieza por MAGIC y luego va una secuencia de registros que
+solo se añaden al final:
+
+    op (1 byte) | id de pestaña (u32) | longitud (u32) | datos | crc32 (u32)
+
+    OP_TAB      datos = url y título (u32 de longitud + UTF-8 cada uno)
+    OP_STATE    datos = estado de sesión de WebKit, tal cual
+    OP_CLOSE    sin datos: la pestaña se cerró
+    OP_CURRENT  sin datos: esa es la pestaña actual
+
+Las pestañas salen en el orden de su primer OP_TAB. Al leer se para en el
+primer registro incompleto o con el crc mal (lo que deja un cierre
+brusco a medio escribir), así que lo anterior siempre se recupera. Cuando
+el diario crece mucho más que lo que describe, se reescribe entero con un
+registro por dato vivo (compact), en un temporal que sustituye al
+archivo.
+"""
+import os
+import struct
+import zlib
+
+from persist import write_atomic
+
+MAGIC = b"NAVIASJ1"
+OP_TAB = 1
+OP_STATE = 2
+OP_CLOSE = 3
+OP_CURRENT = 4
+
+_HEADER = struct.Struct("<BII")
+_CRC = struct.Struct("<I")
+_LEN = struct.Struct("<I")
+
+# Se compacta cuando el diario pasa de COMPACT_MIN_BYTES y de
+# COMPACT_RATIO veces el tamaño de lo que está vivo
+COMPACT_MIN_BYTES = 512 * 1024
+COMPACT_RATIO = 4
+
+
+class SessionTab:
+    """Lo que se guarda de una pestaña."""
+
+    __slots__ = ("id", "url", "title", "state")
+
+    def __init__(self, tab_id, url="", title="", state=None):
+        self.id = tab_id
+        self.url = url
+        self.title = title
+        self.state = state   # bytes del estado de sesión de WebKit o None
+
+    def __repr__(self):
+        return f"SessionTab({self.id}, {self.url!r})"
+
+
+def _pack_strings(*values):
+    parts = []
+    for value in values:
+        data = (value or "").encode("utf-8")
+        parts.append(_LEN.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def _unpack_strings(data, count):
+    values, pos = [], 0
+    for _ in range(count):
+        (size,) = _LEN.unpack_from(data, pos)
+        pos += _LEN.size
+        values.append(bytes(data[pos:pos + size]).decode("utf-8", errors="replace"))
+        pos += size
+    return values
+
+
+def _record(op, tab_id, payload=b""):
+    head = _HEADER.pack(op, tab_id, len(payload))
+    crc = zlib.crc32(payload, zlib.crc32(head))
+    return head + payload + _CRC.pack(crc)
+
+
+def read_session(path):
+    """
+    Lee el diario: (pestañas en orden, id de la actual o None, bytes
+    válidos). Un archivo que no existe o no es un diario da ([], None, 0).
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return [], None, 0
+    if not data.startswith(MAGIC):
+        return [], None, 0
+    view = memoryview(data)
+    tabs = {}
+    current = None
+    pos = len(MAGIC)
+    end = len(data)
+    while pos + _HEADER.size + _CRC.size <= end:
+        op, tab_id, size = _HEADER.unpack_from(view, pos)
+        body = pos + _HEADER.size
+        tail = body + size
+        if tail + _CRC.size > end:
+            break
+        (crc,) = _CRC.unpack_from(view, tail)
+        payload = view[body:tail]
+        if zlib.crc32(payload, zlib.crc32(view[pos:body])) != crc:
+            break
+        if op == OP_TAB:
+            url, title = _unpack_strings(payload, 2)
+            tab = tabs.get(tab_id)
+            if tab is None:
+                tabs[tab_id] = SessionTab(tab_id, url, title)
+            else:
+                tab.url, tab.title = url, title
+        elif op == OP_STATE:
+            tab = tabs.get(tab_id)
+            if tab is not None:
+                tab.state = bytes(payload) or None
+        elif op == OP_CLOSE:
+            tabs.pop(tab_id, None)
+        elif op == OP_CURRENT:
+            current = tab_id
+        else:
+            break
+        pos = tail + _CRC.size
+    if current not in tabs:
+        current = None
+    return list(tabs.values()), current, pos
+
+
+class SessionJournal:
+    """
+    Escritor del diario. Recuerda lo último escrito de cada pestaña y no
+    vuelve a escribir lo que no cambió.
+    """
+
+    def __init__(self, path, compact_min_bytes=COMPACT_MIN_BYTES, compact_ratio=COMPACT_RATIO):
+        self.path = path
+        self.compact_min_bytes = compact_min_bytes
+        self.compact_ratio = compact_ratio
+        self.tabs = {}        # id -> SessionTab (orden de apertura)
+        self.current = None
+        self.file = None
+        self.size = 0         # bytes del archivo
+        self.live_size = 0    # bytes que ocuparía compactado (aproximado)
+
+    def load(self):
+        """Lee el diario existente, lo compacta y lo deja abierto para añadir."""
+        tabs, current, _ = read_session(self.path)
+        self.tabs = {tab.id: tab for tab in tabs}
+        self.current = current
+        self.compact()
+        return tabs, current
+
+    def next_id(self):
+        return max(self.tabs, default=0) + 1
+
+    def _live_bytes(self):
+        total = len(MAGIC) + _HEADER.size + _CRC.size
+        for tab in self.tabs.values():
+            total += 2 * (_HEADER.size + _CRC.size) + 2 * _LEN.size
+            total += len(tab.url.encode("utf-8")) + len(tab.title.encode("utf-8"))
+            total += len(tab.state or b"")
+        return total
+
+    def _append(self, record):
+        if self.file is None:
+            self.compact()
+        self.file.write(record)
+        self.file.flush()
+        self.size += len(record)
+        if self.size > self.compact_min_bytes and self.size > self.compact_ratio * self.live_size:
+            self.compact()
+
+    def compact(self):
+        """Reescribe el diario con solo lo vivo (ver persist.write_atomic)."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        records = [MAGIC]
+        for tab in self.tabs.values():
+            records.append(_record(OP_TAB, tab.id, _pack_strings(tab.url, tab.title)))
+            if tab.state:
+                records.append(_record(OP_STATE, tab.id, tab.state))
+        if self.current in self.tabs:
+            records.append(_record(OP_CURRENT, self.current))
+        data = b"".join(records)
+        write_atomic(self.path, data)
+        self.file = open(self.path, "ab")
+        self.size = len(data)
+        self.live_size = self._live_bytes()
+
+    def tab(self, tab_id, url, title):
+        """Pestaña nueva o que cambió de URL o título."""
+        url, title = url or "", title or ""
+        tab = self.tabs.get(tab_id)
+        if tab is not None and tab.url == url and tab.title == title:
+            return
+        if tab is None:
+            tab = self.tabs[tab_id] = SessionTab(tab_id)
+        self.live_size += len(url.encode("utf-8")) + len(title.encode("utf-8"))
+        self.live_size -= len(tab.url.encode("utf-8")) + len(tab.title.encode("utf-8"))
+        tab.url, tab.title = url, title
+        self._append(_record(OP_TAB, tab_id, _pack_strings(url, title)))
+
+    def state(self, tab_id, data):
+        """Historial de atrás/adelante de la pestaña (bytes de WebKit)."""
+        tab = self.tabs.get(tab_id)
+        if tab is None or not data or tab.state == data:
+            return
+        self.live_size += len(data) - len(tab.state or b"")
+        tab.state = data
+        self._append(_record(OP_STATE, tab_id, data))
+
+    def close_tab(self, tab_id):
+        tab = self.tabs.pop(tab_id, None)
+        if tab is None:
+            return
+        self.live_size -= len(tab.state or b"") + len(tab.url.encode("utf-8")) + len(tab.title.encode("utf-8"))
+        self._append(_record(OP_CLOSE, tab_id))
+
+    def set_current(self, tab_id):
+        if tab_id == self.current:
+            return
+        self.current = tab_id
+        self._append(_record(OP_CURRENT, tab_id))
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
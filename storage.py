@@ -0,0 +1,432 @@
+# storage.py
+"""
+Almacén del navegador en SQLite: ajustes, historial y marcadores.
+
+La base va en modo WAL. Las lecturas se hacen en el hilo de GTK con su
+propia conexión y no esperan a las escrituras. Las escrituras se encolan
+y las hace un hilo escritor: toma todo lo que haya en la cola y lo
+confirma en una sola transacción, así que navegar nunca espera al disco.
+flush() espera a que lo encolado esté confirmado (para leer justo
+después lo que se acaba de escribir).
+
+Historial: una fila por URL en 'urls' (título, visitas, última visita y
+frecency) y una por visita en 'visits' (fecha y tipo de transición). La
+frecency se mantiene al añadir cada visita sin recalcular nada: cada
+visita suma peso_de_la_transición * 2^((fecha - FRECENCY_EPOCH) / vida_media),
+así que ordenar por la columna equivale a ordenar por la suma de los
+pesos decaídos hasta ahora (el factor de decaimiento es común a todas).
+Las búsquedas por prefijo usan el índice de url_key (la URL sin esquema ni
+"www.") y las de subcadena la tabla FTS5 con trigramas 'urls_fts' (o LIKE
+si el SQLite no tiene trigramas).
+
+La primera vez que se abre, si existe el JSON antiguo (DATA_FILE de
+main.py), se importa y se renombra a <archivo>.migrated. Una base de la
+versión 1 (historial como lista de URLs) se convierte a visitas.
+"""
+import json
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS urls (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    url_key TEXT NOT NULL,
+    title TEXT,
+    visit_count INTEGER NOT NULL DEFAULT 0,
+    last_visit REAL NOT NULL DEFAULT 0,
+    frecency REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS urls_key ON urls (url_key);
+CREATE INDEX IF NOT EXISTS urls_frecency ON urls (frecency);
+CREATE INDEX IF NOT EXISTS urls_last_visit ON urls (last_visit);
+CREATE TABLE IF NOT EXISTS visits (
+    id INTEGER PRIMARY KEY,
+    url_id INTEGER NOT NULL REFERENCES urls (id) ON DELETE CASCADE,
+    visited_at REAL NOT NULL,
+    transition INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS visits_url ON visits (url_id, visited_at);
+CREATE INDEX IF NOT EXISTS visits_time ON visits (visited_at);
+CREATE TABLE IF NOT EXISTS bookmarks (
+    url TEXT PRIMARY KEY,
+    added_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bookmarks_added ON bookmarks (added_at);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS urls_fts USING fts5 (
+    url, title, content='urls', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS urls_fts_insert AFTER INSERT ON urls BEGIN
+    INSERT INTO urls_fts (rowid, url, title) VALUES (new.id, new.url, new.title);
+END;
+CREATE TRIGGER IF NOT EXISTS urls_fts_delete AFTER DELETE ON urls BEGIN
+    INSERT INTO urls_fts (urls_fts, rowid, url, title) VALUES ('delete', old.id, old.url, old.title);
+END;
+CREATE TRIGGER IF NOT EXISTS urls_fts_update AFTER UPDATE OF url, title ON urls BEGIN
+    INSERT INTO urls_fts (urls_fts, rowid, url, title) VALUES ('delete', old.id, old.url, old.title);
+    INSERT INTO urls_fts (rowid, url, title) VALUES (new.id, new.url, new.title);
+END;
+"""
+
+# Tipos de transición de una visita y cuánto cuenta cada uno en la frecency
+TRANSITION_OTHER = 0        # carga del programa, redirección, JS...
+TRANSITION_LINK = 1
+TRANSITION_TYPED = 2        # escrita en la barra de direcciones
+TRANSITION_BOOKMARK = 3
+TRANSITION_RELOAD = 4
+TRANSITION_BACK_FORWARD = 5
+TRANSITION_FORM = 6
+TRANSITION_WEIGHTS = {
+    TRANSITION_OTHER: 0.5,
+    TRANSITION_LINK: 1.0,
+    TRANSITION_TYPED: 2.0,
+    TRANSITION_BOOKMARK: 1.5,
+    TRANSITION_RELOAD: 0.0,
+    TRANSITION_BACK_FORWARD: 0.25,
+    TRANSITION_FORM: 0.5,
+}
+FRECENCY_HALF_LIFE_DAYS = 30
+FRECENCY_EPOCH = 1577836800.0   # 2020-01-01: los exponentes se cuentan desde aquí
+_DECAY = math.log(2) / (FRECENCY_HALF_LIFE_DAYS * 86400)
+
+# Ajustes de un perfil nuevo (los mismos que daba load_data sin archivo)
+DEFAULT_SETTINGS = {"homepage": "https://duckduckgo.com", "proxy": ""}
+
+
+def url_key(url):
+    """La URL sin esquema ni "www." y en minúsculas (para buscar por prefijo)."""
+    key = url.strip().lower()
+    scheme = key.find("://")
+    if scheme != -1:
+        key = key[scheme + 3:]
+    if key.startswith("www."):
+        key = key[4:]
+    return key
+
+
+def visit_score(visited_at, transition):
+    """Lo que suma una visita a la frecency guardada."""
+    return TRANSITION_WEIGHTS.get(transition, 1.0) * math.exp(_DECAY * (visited_at - FRECENCY_EPOCH))
+
+
+def frecency_at(score, now=None):
+    """La frecency guardada expresada en puntos de hoy (una visita de hoy = su peso)."""
+    return score * math.exp(-_DECAY * ((now or time.time()) - FRECENCY_EPOCH))
+
+
+def _record_visit(conn, url, visited_at, transition, title=None):
+    conn.execute(
+        "INSERT INTO urls (url, url_key, title, visit_count, last_visit, frecency) "
+        "VALUES (?, ?, ?, 1, ?, ?) "
+        "ON CONFLICT (url) DO UPDATE SET visit_count = visit_count + 1, "
+        "last_visit = max(last_visit, excluded.last_visit), frecency = frecency + excluded.frecency",
+        (url, url_key(url), title, visited_at, visit_score(visited_at, transition)))
+    (url_id,) = conn.execute("SELECT id FROM urls WHERE url = ?", (url,)).fetchone()
+    conn.execute("INSERT INTO visits (url_id, visited_at, transition) VALUES (?, ?, ?)",
+                 (url_id, visited_at, transition))
+
+
+def _clear_history(conn, fts):
+    conn.execute("DELETE FROM visits")
+    if fts:
+        # Sin el disparador: vaciar el índice FTS de una vez y no fila a fila
+        conn.execute("DROP TRIGGER IF EXISTS urls_fts_delete")
+        conn.execute("DELETE FROM urls")
+        conn.execute("INSERT INTO urls_fts (urls_fts) VALUES ('delete-all')")
+        conn.execute("CREATE TRIGGER IF NOT EXISTS urls_fts_delete AFTER DELETE ON urls BEGIN "
+                     "INSERT INTO urls_fts (urls_fts, rowid, url, title) "
+                     "VALUES ('delete', old.id, old.url, old.title); END")
+    else:
+        conn.execute("DELETE FROM urls")
+
+
+def _like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Con WAL, NORMAL no pierde la integridad ante un corte, solo lo último
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+class BrowserStore:
+    """Ajustes, historial y marcadores; las escrituras van al hilo escritor."""
+
+    def __init__(self, path, legacy_json=None):
+        self.path = path
+        conn = _connect(path)
+        with conn:
+            conn.executescript(SCHEMA)
+        try:
+            with conn:
+                conn.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False   # sin FTS5 o sin trigramas: las subcadenas van con LIKE
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            migrated = False
+            with conn:
+                if version == 0 and legacy_json and os.path.exists(legacy_json):
+                    migrated = self._migrate_json(conn, legacy_json)
+                if version == 1:
+                    self._migrate_v1_history(conn)
+                conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            # El JSON se aparta solo cuando lo importado ya está confirmado:
+            # si se cae antes, el próximo arranque vuelve a migrarlo
+            if migrated:
+                try:
+                    os.replace(legacy_json, legacy_json + ".migrated")
+                except OSError as e:
+                    print(f"[Datos] No se pudo renombrar {legacy_json}: {e}")
+        self.reader = conn
+        self._saved_settings = {key: value for key, value in
+                                self.reader.execute("SELECT key, value FROM settings")}
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="navia-store", daemon=True)
+        self._writer.start()
+
+    # --- migración -----------------------------------------------------
+
+    @staticmethod
+    def _migrate_json(conn, legacy_json):
+        """Importa el JSON antiguo en la transacción abierta; True si se importó."""
+        try:
+            with open(legacy_json, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[Datos] No se pudo leer {legacy_json} para migrarlo: {e}")
+            return False
+        if not isinstance(data, dict):
+            return False
+        history = [url for url in data.pop("history", []) or [] if isinstance(url, str)]
+        bookmarks = [url for url in data.pop("bookmarks", []) or [] if isinstance(url, str)]
+        # El JSON no guardaba fechas: se reparten hacia atrás desde su última escritura
+        base = os.path.getmtime(legacy_json)
+        for i, url in enumerate(history):
+            _record_visit(conn, url, base - (len(history) - i), TRANSITION_LINK)
+        conn.executemany("INSERT OR IGNORE INTO bookmarks (url, added_at) VALUES (?, ?)",
+                         [(url, base - (len(bookmarks) - i)) for i, url in enumerate(bookmarks)])
+        conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                         [(key, json.dumps(value)) for key, value in data.items()])
+        print(f"[Datos] Migrados {len(history)} del historial, {len(bookmarks)} marcadores "
+              f"y {len(data)} ajustes desde {legacy_json}")
+        return True
+
+    @staticmethod
+    def _migrate_v1_history(conn):
+        rows = conn.execute("SELECT url, visited_at FROM history ORDER BY id").fetchall()
+        for url, visited_at in rows:
+            _record_visit(conn, url, visited_at, TRANSITION_LINK)
+        conn.execute("DROP TABLE history")
+        print(f"[Datos] Historial convertido a visitas ({len(rows)} entradas)")
+
+    # --- escritura (hilo escritor) -------------------------------------
+
+    def _write_loop(self):
+        conn = _connect(self.path)
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = [item for item in batch if callable(item)]
+            stop = any(item is None for item in batch)
+            statements = [item for item in batch if isinstance(item, tuple)]
+            if statements:
+                # Cualquier error deja el lote sin confirmar pero el hilo sigue:
+                # si muriera, cada flush() esperaría hasta su timeout
+                try:
+                    with conn:
+                        for sql, params in statements:
+                            if callable(sql):
+                                sql(conn, *params)
+                            else:
+                                conn.execute(sql, params)
+                except Exception as e:
+                    print(f"[Datos] Error guardando datos: {e}")
+            for callback in done:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"[Datos] Error en un aviso de escritura: {e}")
+            if stop:
+                conn.close()
+                return
+
+    def _write(self, sql, params=()):
+        # 'sql' también puede ser una función fn(conexión, *params)
+        self._queue.put((sql, params))
+
+    def flush(self, timeout=5):
+        """Espera a que esté confirmado todo lo encolado."""
+        event = threading.Event()
+        self._queue.put(event.set)
+        return event.wait(timeout)
+
+    def after_writes(self, callback):
+        """
+        Llama a callback() (en el hilo escritor) cuando esté confirmado todo
+        lo encolado hasta ahora; sin bloquear a quien lo pide.
+        """
+        self._queue.put(callback)
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join(timeout=10)
+        self.reader.close()
+
+    # --- ajustes -------------------------------------------------------
+
+    def load_settings(self):
+        settings = dict(DEFAULT_SETTINGS)
+        for key, value in self._saved_settings.items():
+            try:
+                settings[key] = json.loads(value)
+            except ValueError:
+                continue
+        return settings
+
+    def save_settings(self, settings):
+        """Guarda solo las claves que cambiaron desde la última vez."""
+        encoded = {key: json.dumps(value) for key, value in settings.items()}
+        for key, value in encoded.items():
+            if self._saved_settings.get(key) != value:
+                self._write("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        for key in set(self._saved_settings) - set(encoded):
+            self._write("DELETE FROM settings WHERE key = ?", (key,))
+        self._saved_settings = encoded
+
+    # --- historial -----------------------------------------------------
+
+    def add_visit(self, url, transition=TRANSITION_LINK, visited_at=None, title=None):
+        self._write(_record_visit, (url, visited_at or time.time(), transition, title))
+
+    def set_title(self, url, title):
+        self._write("UPDATE urls SET title = ? WHERE url = ? AND title IS NOT ?", (title, url, title))
+
+    def history(self, limit=100):
+        """Las 'limit' URLs visitadas más recientemente, de la más antigua a la más reciente."""
+        rows = self.reader.execute(
+            "SELECT url FROM urls ORDER BY last_visit DESC LIMIT ?", (limit,)).fetchall()
+        return [url for (url,) in reversed(rows)]
+
+    def top_urls(self, limit):
+        """Las 'limit' URLs con más frecency como (url, título, frecency de hoy)."""
+        rows = self.reader.execute(
+            "SELECT url, title, frecency FROM urls ORDER BY frecency DESC LIMIT ?", (limit,)).fetchall()
+        return [(url, title, frecency_at(score)) for url, title, score in rows]
+
+    def url_info(self, url):
+        """(título, visitas, última visita, frecency de hoy) o None."""
+        row = self.reader.execute(
+            "SELECT title, visit_count, last_visit, frecency FROM urls WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], frecency_at(row[3])
+
+    def search_history(self, text, limit=10):
+        """
+        URLs del historial para 'text', como (url, título): primero las que
+        empiezan por él (sin esquema ni "www.") y luego las que lo contienen
+        en la URL o el título, cada grupo por frecency.
+        """
+        text = text.strip()
+        if not text:
+            return []
+        prefix = url_key(text)
+        rows = self.reader.execute(
+            "SELECT url, title FROM urls WHERE url_key >= ? AND url_key < ? "
+            "ORDER BY frecency DESC LIMIT ?", (prefix, prefix + "\U0010ffff", limit)).fetchall()
+        if len(rows) < limit:
+            seen = {url for url, _ in rows}
+            if self.fts and len(text) >= 3:
+                query = '"' + text.replace('"', '""') + '"'
+                more = self.reader.execute(
+                    "SELECT u.url, u.title FROM urls_fts JOIN urls u ON u.id = urls_fts.rowid "
+                    "WHERE urls_fts MATCH ? ORDER BY u.frecency DESC LIMIT ?",
+                    (query, limit + len(rows)))
+            else:
+                pattern = f"%{_like_escape(text)}%"
+                more = self.reader.execute(
+                    "SELECT url, title FROM urls WHERE url LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\' "
+                    "ORDER BY frecency DESC LIMIT ?", (pattern, pattern, limit + len(rows)))
+            for url, title in more:
+                if url not in seen and len(rows) < limit:
+                    seen.add(url)
+                    rows.append((url, title))
+        return rows
+
+    def _history_match(self, text):
+        """Condición SQL sobre 'urls' (y parámetros): prefijo de url_key o subcadena de URL o título."""
+        prefix = url_key(text)
+        where = "(url_key >= ? AND url_key < ?)"
+        params = [prefix, prefix + "\U0010ffff"]
+        if self.fts and len(text) >= 3:
+            where += " OR id IN (SELECT rowid FROM urls_fts WHERE urls_fts MATCH ?)"
+            params.append('"' + text.replace('"', '""') + '"')
+        else:
+            pattern = f"%{_like_escape(text)}%"
+            where += " OR url LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\'"
+            params += [pattern, pattern]
+        return where, params
+
+    def history_page(self, text="", offset=0, limit=200):
+        """
+        Una página del historial como (url, título, última visita), de la
+        más reciente a la más antigua; con 'text', solo las que empiezan por
+        él o lo contienen en la URL o el título.
+        """
+        text = text.strip()
+        where, params = self._history_match(text) if text else ("1", [])
+        return self.reader.execute(
+            f"SELECT url, title, last_visit FROM urls WHERE {where} "
+            "ORDER BY last_visit DESC LIMIT ? OFFSET ?", params + [limit, offset]).fetchall()
+
+    def clear_history(self):
+        self._write(_clear_history, (self.fts,))
+
+    # --- marcadores ----------------------------------------------------
+
+    def add_bookmark(self, url):
+        self._write("INSERT OR IGNORE INTO bookmarks (url, added_at) VALUES (?, ?)", (url, time.time()))
+
+    def has_bookmark(self, url):
+        return self.reader.execute("SELECT 1 FROM bookmarks WHERE url = ?", (url,)).fetchone() is not None
+
+    def bookmarks(self):
+        return [url for (url,) in self.reader.execute("SELECT url FROM bookmarks ORDER BY added_at")]
+
+    def bookmarks_page(self, text="", offset=0, limit=200):
+        """Una página de marcadores como (url, título, fecha), del más nuevo al más antiguo."""
+        text = text.strip()
+        where, params = "1", []
+        if text:
+            # Suelen ser pocos: basta con LIKE
+            pattern = f"%{_like_escape(text)}%"
+            where, params = "b.url LIKE ? ESCAPE '\\' OR u.title LIKE ? ESCAPE '\\'", [pattern, pattern]
+        return self.reader.execute(
+            "SELECT b.url, u.title, b.added_at FROM bookmarks b LEFT JOIN urls u ON u.url = b.url "
+            f"WHERE {where} ORDER BY b.added_at DESC LIMIT ? OFFSET ?", params + [limit, offset]).fetchall()
+
+    def clear_bookmarks(self):
+        self._write("DELETE FROM bookmarks")